@@ -0,0 +1,105 @@
+"""
+Stress benchmark for using one database from several threads.
+
+Every table gets reader threads searching and counting and writer threads
+inserting and updating documents. Prints the operations per second and
+checks that no write got lost::
+
+    python benchmarks/concurrency.py --tables 4 --readers 4 --writers 2
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from puchkidb import PuchkiDB, where  # noqa: E402
+from puchkidb.storages import JSONStorage, MemoryStorage  # noqa: E402
+
+
+def reader(table, operations, counts):
+    done = 0
+    for i in range(operations):
+        if i % 2:
+            table.search(where('value') == i % 10)
+        else:
+            table.count(where('value') > 5)
+        done += 1
+
+    counts.append(done)
+
+
+def writer(table, operations, counts, start):
+    done = 0
+    for i in range(start, start + operations):
+        doc_id = table.insert({'value': i % 10, 'writer': start})
+        table.update({'updated': True}, doc_ids=[doc_id])
+        done += 2
+
+    counts.append(done)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--tables', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4,
+                        help='reader threads per table')
+    parser.add_argument('--writers', type=int, default=2,
+                        help='writer threads per table')
+    parser.add_argument('--documents', type=int, default=1000,
+                        help='documents per table to start with')
+    parser.add_argument('--operations', type=int, default=200,
+                        help='operations per thread')
+    parser.add_argument('--json', action='store_true',
+                        help='use a JSONStorage instead of memory')
+    parser.add_argument('--locking', action='store_true',
+                        help='lock the JSON file as for several processes')
+    args = parser.parse_args()
+
+    if args.json:
+        path = os.path.join(tempfile.mkdtemp(), 'db.json')
+        db = PuchkiDB(path, storage=JSONStorage, locking=args.locking)
+    else:
+        db = PuchkiDB(storage=MemoryStorage)
+
+    tables = [db.table('table{}'.format(i)) for i in range(args.tables)]
+    for table in tables:
+        table.insert_multiple({'value': i % 10}
+                              for i in range(args.documents))
+
+    counts = []
+    threads = []
+    for table in tables:
+        for _ in range(args.readers):
+            threads.append(threading.Thread(
+                target=reader, args=(table, args.operations, counts)))
+        for i in range(args.writers):
+            threads.append(threading.Thread(
+                target=writer, args=(table, args.operations, counts,
+                                     args.documents + i * args.operations)))
+
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = default_timer() - start
+
+    expected = args.documents + args.writers * args.operations
+    for table in tables:
+        assert len(table) == expected, 'lost writes in {}'.format(table.name)
+        updated = table.count(where('updated') == True)  # noqa: E712
+        assert updated == args.writers * args.operations
+
+    print('{} threads, {} operations in {:.2f}s: {:.0f} operations/s'.format(
+        len(threads), sum(counts), elapsed, sum(counts) / elapsed))
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
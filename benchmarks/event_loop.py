@@ -0,0 +1,90 @@
+"""
+Benchmark for the latency of an event loop using a database.
+
+A ticker coroutine measures how late the event loop wakes it up while
+other coroutines insert into and search a JSON database, once calling
+PuchkiDB directly and once through :mod:`puchkidb.aio`::
+
+    python benchmarks/event_loop.py --clients 20 --operations 50
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from puchkidb import PuchkiDB, where  # noqa: E402
+from puchkidb.aio import AsyncPuchkiDB  # noqa: E402
+
+TICK = 0.001
+
+
+async def ticker(lags, done):
+    while not done.is_set():
+        start = default_timer()
+        await asyncio.sleep(TICK)
+        lags.append(default_timer() - start - TICK)
+
+
+async def blocking_client(db, operations, start):
+    for i in range(start, start + operations):
+        db.insert({'value': i % 10})
+        db.search(where('value') == i % 10)
+        await asyncio.sleep(0)
+
+
+async def async_client(db, operations, start):
+    for i in range(start, start + operations):
+        await db.insert({'value': i % 10})
+        await db.search(where('value') == i % 10)
+
+
+async def measure(client, db, args):
+    lags = []
+    done = asyncio.Event()
+    tick = asyncio.ensure_future(ticker(lags, done))
+
+    start = default_timer()
+    await asyncio.gather(*(client(db, args.operations, i * args.operations)
+                           for i in range(args.clients)))
+    elapsed = default_timer() - start
+
+    done.set()
+    await tick
+    lags.sort()
+
+    return elapsed, lags[len(lags) // 2], lags[-1]
+
+
+def report(name, result):
+    print('{:8}: {:.2f}s, event loop lag median {:.1f}ms, max {:.1f}ms'
+          .format(name, result[0], result[1] * 1000, result[2] * 1000))
+
+
+async def main(args):
+    directory = tempfile.mkdtemp()
+
+    db = PuchkiDB(os.path.join(directory, 'blocking.json'))
+    report('blocking', await measure(blocking_client, db, args))
+    db.close()
+
+    async with AsyncPuchkiDB(os.path.join(directory, 'async.json'),
+                             max_workers=args.workers) as db:
+        report('async', await measure(async_client, db, args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--operations', type=int, default=50,
+                        help='operations per client')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='threads of the async database')
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main(parser.parse_args()))
+    loop.close()
@@ -23,7 +23,8 @@ Usage example:
 
 from .queries import Query, where
 from .storages import Storage, JSONStorage
-from .database import PuchkiDB
+from .database import PuchkiDB, VersionConflict
 from .version import __version__
 
-__all__ = ('PuchkiDB', 'Storage', 'JSONStorage', 'Query', 'where')
+__all__ = ('PuchkiDB', 'Storage', 'JSONStorage', 'Query', 'where',
+           'VersionConflict')
@@ -0,0 +1,149 @@
+"""
+Contains the aggregates :meth:`~puchkidb.database.Table.aggregate` computes
+over the documents matching a query.
+
+Every group of documents gets an :class:`Accumulator` that sees each
+document once and only keeps running values, so aggregating needs constant
+memory per group no matter how many documents there are:
+
+>>> acc = Accumulator(aggregate_spec(True, sum='amount', max='amount'))
+>>> for doc in [{'amount': 5}, {'amount': 7}, {}]:
+...     acc.add(doc)
+>>> acc.result() == {'count': 3, 'sum': {'amount': 12}, 'max': {'amount': 7}}
+True
+"""
+
+from .indexes import _family, field_path, resolve_path
+from .utils import string_types
+
+__all__ = ('Accumulator', 'aggregate_spec', 'field_label')
+
+#: The aggregates that can be computed for fields, in the order they appear
+#: in results
+AGGREGATES = ('sum', 'min', 'max', 'avg')
+
+
+def field_label(field):
+    """
+    Get the name of a field in aggregation results: the key for keys, the
+    dotted path for queries (``Query().address.city`` becomes
+    ``'address.city'``).
+    """
+    if isinstance(field, string_types):
+        return field
+
+    return '.'.join(str(part) for part in field_path(field))
+
+
+def _fields(fields):
+    if fields is None:
+        return []
+    elif isinstance(fields, string_types) or hasattr(fields, '_path'):
+        return [fields]
+
+    return list(fields)
+
+
+def aggregate_spec(count=False, **aggregates):
+    """
+    Get the ``(aggregate, path, label)`` triples to compute.
+
+    :param count: whether to count the documents
+    :param aggregates: the field or list of fields to compute ``sum``,
+                       ``min``, ``max`` or ``avg`` for
+    """
+    spec = []
+    if count:
+        spec.append(('count', None, None))
+
+    for name in AGGREGATES:
+        for field in _fields(aggregates.pop(name, None)):
+            spec.append((name, field_path(field), field_label(field)))
+
+    if aggregates:
+        raise TypeError('Unknown aggregates: {}'.format(
+            ', '.join(sorted(aggregates))))
+
+    return spec
+
+
+def _number(value):
+    # Booleans are no amounts
+    return _family(value) == 'number' and not isinstance(value, bool)
+
+
+class Accumulator(object):
+    """
+    The running values of the aggregates of one group of documents.
+
+    ``sum`` and ``avg`` only take numbers into account, ``min`` and ``max``
+    numbers and strings, ordered like search results are sorted (see
+    :mod:`puchkidb.sorting`). Documents without the field are skipped.
+    """
+
+    __slots__ = ('spec', 'count', 'values')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.count = 0
+        self.values = [None] * len(spec)
+
+    def add(self, doc):
+        """
+        Add a document to the aggregates.
+        """
+        self.count += 1
+
+        for i, (name, path, _) in enumerate(self.spec):
+            if path is None:
+                continue
+
+            try:
+                value = resolve_path(doc, path)
+            except (KeyError, TypeError):
+                continue
+
+            current = self.values[i]
+
+            if name in ('sum', 'avg'):
+                if not _number(value):
+                    continue
+                elif current is None:
+                    self.values[i] = [value, 1]
+                else:
+                    current[0] += value
+                    current[1] += 1
+
+            else:
+                family = _family(value)
+                if family is None:
+                    continue
+
+                key = (0 if family == 'number' else 1, value)
+                if current is None or \
+                        (key < current if name == 'min' else key > current):
+                    self.values[i] = key
+
+    def result(self):
+        """
+        Get the aggregates as a dict holding the ``count`` and a dict of
+        values by field for every other aggregate. Empty sums are ``0``,
+        other aggregates without values ``None``.
+        """
+        result = {}
+
+        for (name, _, label), value in zip(self.spec, self.values):
+            if name == 'count':
+                result['count'] = self.count
+                continue
+
+            if name == 'sum':
+                value = 0 if value is None else value[0]
+            elif name == 'avg':
+                value = None if value is None else value[0] / float(value[1])
+            elif value is not None:
+                value = value[1]
+
+            result.setdefault(name, {})[label] = value
+
+        return result
@@ -0,0 +1,356 @@
+"""
+Contains an :mod:`asyncio` interface to PuchkiDB (Python 3.5+).
+
+:class:`AsyncPuchkiDB` and :class:`AsyncTable` offer the methods of
+:class:`~puchkidb.database.PuchkiDB` and :class:`~puchkidb.database.Table` as
+coroutines. They run on a bounded pool of threads, so that storage I/O and
+long scans don't block the event loop.
+
+Writes to a table are queued and applied in the order they were made by one
+thread at a time. Inserts queued at the same time are applied as a single
+:meth:`~puchkidb.database.Table.insert_multiple`, so that many concurrent
+inserts write the storage only once. If that fails, they are applied one by
+one, so that only the failing inserts raise:
+
+>>> db = AsyncPuchkiDB('db.json')
+>>> await asyncio.gather(*(db.insert({'i': i}) for i in range(100)))
+>>> await db.search(where('i') < 10)
+"""
+
+import asyncio
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from inspect import signature
+
+from .database import PuchkiDB, Table
+
+__all__ = ('AsyncPuchkiDB', 'AsyncTable')
+
+
+def _reader(name):
+    """
+    Get a coroutine running a method of tables in the thread pool.
+    """
+    async def read(self, *args, **kwargs):
+        return await self._run(name, *args, **kwargs)
+
+    read.__name__ = name
+    read.__doc__ = getattr(Table, name).__doc__
+    return read
+
+
+def _writer(name):
+    """
+    Get a coroutine queueing a call of a method of tables changing them.
+    """
+    async def write(self, *args, **kwargs):
+        return await self._enqueue(name, args, kwargs)
+
+    write.__name__ = name
+    write.__doc__ = getattr(Table, name).__doc__
+    return write
+
+
+def _call(table, name, args, kwargs):
+    """
+    Call a method of a table, getting ``(True, result)`` or
+    ``(False, exception)``.
+    """
+    try:
+        return True, getattr(table, name)(*args, **kwargs)
+    except Exception as e:
+        return False, e
+
+
+class AsyncTable(object):
+    """
+    Gives access to a table with coroutines, see :mod:`puchkidb.aio`.
+
+    Get it with :meth:`AsyncPuchkiDB.table`. The table itself is opened in
+    the thread pool when it is used for the first time.
+    """
+
+    def __init__(self, db, name, options):
+        self._db = db
+        self._name = name
+        self._options = options
+        self._table = None
+        self._pending = []
+        self._flushing = None
+
+    @property
+    def name(self):
+        return self._name
+
+    def __repr__(self):
+        return '<{} name={!r}>'.format(type(self).__name__, self._name)
+
+    def _open(self):
+        """
+        Get the table, to be called in the thread pool.
+        """
+        if self._table is None:
+            self._table = self._db.db.table(self._name, **self._options)
+        return self._table
+
+    async def _run(self, name, *args, **kwargs):
+        """
+        Call a method of the table in the thread pool.
+        """
+        def call():
+            return getattr(self._open(), name)(*args, **kwargs)
+
+        return await self._db.run(call)
+
+    async def _enqueue(self, name, args, kwargs):
+        """
+        Queue a write and wait for it to be applied.
+        """
+        if name in ('insert', 'insert_multiple'):
+            # Inserts are merged by their positional documents, wrong
+            # arguments raise like the table's methods do
+            bound = signature(getattr(Table, name)).bind(None, *args,
+                                                         **kwargs)
+            args, kwargs = tuple(bound.arguments.values())[1:], {}
+
+        if name == 'insert' and not isinstance(args[0], Mapping):
+            # Would fail the other inserts applied with it
+            raise ValueError('Document is not a Mapping')
+        elif name == 'insert_multiple':
+            args = (list(args[0]), )
+            if not all(isinstance(doc, Mapping) for doc in args[0]):
+                raise ValueError('Document is not a Mapping')
+
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((name, args, kwargs, future))
+
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self._flush())
+
+        return await future
+
+    async def _flush(self):
+        """
+        Apply the queued writes until the queue is empty, the writes queued
+        while applying the previous ones at once.
+        """
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+
+                try:
+                    results = await self._db.run(self._apply, batch)
+                except Exception as e:
+                    results = [(False, e)] * len(batch)
+
+                for (_, _, _, future), (ok, result) in zip(batch, results):
+                    if future.cancelled():
+                        continue
+                    elif ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+        finally:
+            self._flushing = None
+
+    def _apply(self, batch):
+        """
+        Apply writes in order, merging successive inserts, to be called in
+        the thread pool.
+
+        :returns: ``(True, result)`` or ``(False, exception)`` for every
+                  write
+        """
+        table = self._open()
+        results = []
+
+        i = 0
+        while i < len(batch):
+            name, args, kwargs, _ = batch[i]
+
+            if name not in ('insert', 'insert_multiple'):
+                results.append(_call(table, name, args, kwargs))
+                i += 1
+                continue
+
+            inserts = []
+            while i < len(batch) and batch[i][0] in ('insert',
+                                                     'insert_multiple'):
+                inserts.append(batch[i])
+                i += 1
+
+            documents = []
+            for name, args, _, _ in inserts:
+                if name == 'insert':
+                    documents.append(args[0])
+                else:
+                    documents.extend(args[0])
+
+            try:
+                doc_ids = table.insert_multiple(documents)
+            except Exception as e:
+                if len(inserts) == 1:
+                    results.append((False, e))
+                else:
+                    # Apply them one by one to fail only the failing ones
+                    results.extend(_call(table, name, args, kwargs)
+                                   for name, args, kwargs, _ in inserts)
+                continue
+
+            # Hand every insert its IDs
+            position = 0
+            for name, args, _, _ in inserts:
+                if name == 'insert':
+                    results.append((True, doc_ids[position]))
+                    position += 1
+                else:
+                    count = len(args[0])
+                    results.append((True, doc_ids[position:position + count]))
+                    position += count
+
+        return results
+
+    async def wait(self):
+        """
+        Wait until the queued writes have been applied.
+        """
+        while self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+    async def length(self):
+        """
+        Get the total number of documents in the table.
+        """
+        return await self._db.run(lambda: len(self._open()))
+
+    search = _reader('search')
+    search_many = _reader('search_many')
+    count = _reader('count')
+    count_many = _reader('count_many')
+    get = _reader('get')
+    contains = _reader('contains')
+    all = _reader('all')
+    aggregate = _reader('aggregate')
+    text_search = _reader('text_search')
+    index_advice = _reader('index_advice')
+    cache_stats = _reader('cache_stats')
+    create_index = _reader('create_index')
+    drop_index = _reader('drop_index')
+    save_indexes = _reader('save_indexes')
+
+    insert = _writer('insert')
+    insert_multiple = _writer('insert_multiple')
+    update = _writer('update')
+    upsert = _writer('upsert')
+    remove = _writer('remove')
+    purge = _writer('purge')
+    write_back = _writer('write_back')
+    cas = _writer('cas')
+
+
+class AsyncPuchkiDB(object):
+    """
+    Gives access to a database with coroutines, see :mod:`puchkidb.aio`.
+
+    All arguments and keyword arguments but the ones below are passed to
+    :class:`~puchkidb.database.PuchkiDB`, which is opened right away. The
+    methods of the default table are available directly.
+
+    :param executor: The :class:`concurrent.futures.Executor` to run the
+                     database's methods on, by default a pool of
+                     ``max_workers`` threads closed with the database.
+    :param max_workers: The number of threads of the default executor.
+    """
+
+    def __init__(self, *args, **kwargs):
+        executor = kwargs.pop('executor', None)
+        max_workers = kwargs.pop('max_workers', 4)
+
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._executor = executor
+
+        #: The database the coroutines run the methods of
+        self.db = PuchkiDB(*args, **kwargs)
+
+        self._tables = {}
+        self._table = self.table(self.db._table.name)
+
+    def table(self, name=PuchkiDB.DEFAULT_TABLE, **options):
+        """
+        Get access to a table, see :meth:`PuchkiDB.table`.
+
+        :rtype: AsyncTable
+        """
+        if name not in self._tables:
+            self._tables[name] = AsyncTable(self, name, options)
+        return self._tables[name]
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a function in the thread pool, e.g. one using :attr:`db` in ways
+        this interface doesn't cover.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs))
+
+    async def tables(self):
+        """
+        Get the names of all tables in the database.
+        """
+        return await self.run(self.db.tables)
+
+    async def purge_table(self, name):
+        """
+        Purge a table from the database, after its queued writes.
+        """
+        table = self._tables.pop(name, None)
+        if table is not None:
+            await table.wait()
+        await self.run(self.db.purge_table, name)
+
+    async def purge_tables(self):
+        """
+        Purge all tables from the database, after their queued writes.
+        """
+        await self.wait()
+        self._tables.clear()
+        self._table = self.table(self.db._table.name)
+        await self.run(self.db.purge_tables)
+
+    async def join(self, *args, **kwargs):
+        """
+        Relate the documents of two tables, see :meth:`PuchkiDB.join`.
+        """
+        return await self.run(self.db.join, *args, **kwargs)
+
+    async def wait(self):
+        """
+        Wait until the queued writes of all tables have been applied.
+        """
+        for table in list(self._tables.values()):
+            await table.wait()
+
+    async def close(self):
+        """
+        Apply the queued writes and close the database.
+        """
+        await self.wait()
+        await self.run(self.db.close)
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def __getattr__(self, name):
+        """
+        Forward all unknown attribute calls to the default table.
+        """
+        return getattr(self._table, name)
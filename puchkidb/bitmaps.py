@@ -0,0 +1,254 @@
+"""
+Contains a compressed :class:`bitmap <puchkidb.bitmaps.Bitmap>` of
+non-negative integers, used by the indexes to represent sets of document IDs.
+
+The bitmap follows the layout of Roaring bitmaps: integers are split into
+chunks of 2 ** 16 by their high bits and every chunk stores the low bits of
+its members in a container that fits its density. Sparse chunks use a set,
+dense chunks use a Python integer as bitset, so combining two bitmaps with
+``&``, ``|`` and ``-`` boils down to a few operations on native objects:
+
+>>> a = Bitmap([1, 2, 3])
+>>> b = Bitmap([2, 3, 4])
+>>> list(a & b)
+[2, 3]
+>>> list(a | b)
+[1, 2, 3, 4]
+>>> list(a - b)
+[1]
+"""
+
+#: The number of bits that select the chunk of an integer
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+#: Chunks with more members than this are stored as bitsets
+SET_LIMIT = 4096
+
+
+def _popcount(bits):
+    try:
+        return bits.bit_count()
+    except AttributeError:  # pragma: no cover
+        # int.bit_count requires Python 3.10
+        return bin(bits).count('1')
+
+
+def _to_bits(lows):
+    bits = 0
+    for low in lows:
+        bits |= 1 << low
+
+    return bits
+
+
+def _to_set(bits):
+    lows = set()
+    while bits:
+        lowest = bits & -bits
+        lows.add(lowest.bit_length() - 1)
+        bits ^= lowest
+
+    return lows
+
+
+def _iter_bits(bits):
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+def _compact(container):
+    """
+    Store a container in the representation that fits its size, returns
+    ``None`` for empty containers.
+    """
+    if isinstance(container, set):
+        if not container:
+            return None
+        elif len(container) > SET_LIMIT:
+            return _to_bits(container)
+        return container
+
+    if not container:
+        return None
+    elif _popcount(container) <= SET_LIMIT:
+        return _to_set(container)
+    return container
+
+
+def _combine(left, right, op):
+    if isinstance(left, set) and isinstance(right, set):
+        return _compact(op(left, right))
+
+    if isinstance(left, set):
+        left = _to_bits(left)
+    if isinstance(right, set):
+        right = _to_bits(right)
+
+    return _compact(op(left, right))
+
+
+def _and(left, right):
+    return left & right
+
+
+def _or(left, right):
+    return left | right
+
+
+def _sub(left, right):
+    if isinstance(left, set):
+        return left - right
+    return left & ~right
+
+
+class Bitmap(object):
+    """
+    A compressed set of non-negative integers.
+
+    Supports the usual set operations (``&``, ``|``, ``-``, ``in``,
+    ``len``). Iterating a bitmap yields its members in ascending order.
+    """
+
+    __slots__ = ('_chunks', )
+
+    def __init__(self, values=()):
+        self._chunks = {}
+        for value in values:
+            self.add(value)
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        bitmap = cls()
+        bitmap._chunks = chunks
+        return bitmap
+
+    def __repr__(self):
+        return 'Bitmap({!r})'.format(list(self))
+
+    def add(self, value):
+        """
+        Add an integer to the bitmap.
+        """
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        container = self._chunks.get(high)
+
+        if container is None:
+            self._chunks[high] = {low}
+        elif isinstance(container, set):
+            container.add(low)
+            if len(container) > SET_LIMIT:
+                self._chunks[high] = _to_bits(container)
+        else:
+            self._chunks[high] = container | (1 << low)
+
+    def discard(self, value):
+        """
+        Remove an integer from the bitmap if it is a member.
+        """
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        container = self._chunks.get(high)
+
+        if container is None:
+            return
+        elif isinstance(container, set):
+            container.discard(low)
+            if not container:
+                del self._chunks[high]
+        else:
+            container = _compact(container & ~(1 << low))
+            if container is None:
+                del self._chunks[high]
+            else:
+                self._chunks[high] = container
+
+    def copy(self):
+        return self._from_chunks(dict(
+            (high, set(container) if isinstance(container, set)
+             else container)
+            for high, container in self._chunks.items()
+        ))
+
+    def __contains__(self, value):
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        container = self._chunks.get(high)
+
+        if container is None:
+            return False
+        elif isinstance(container, set):
+            return low in container
+        return bool(container >> low & 1)
+
+    def __len__(self):
+        return sum(len(container) if isinstance(container, set)
+                   else _popcount(container)
+                   for container in self._chunks.values())
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        for high in sorted(self._chunks):
+            base = high << CHUNK_BITS
+            container = self._chunks[high]
+
+            if isinstance(container, set):
+                lows = sorted(container)
+            else:
+                lows = _iter_bits(container)
+
+            for low in lows:
+                yield base | low
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __and__(self, other):
+        chunks = {}
+        for high, container in self._chunks.items():
+            if high in other._chunks:
+                combined = _combine(container, other._chunks[high], _and)
+                if combined is not None:
+                    chunks[high] = combined
+
+        return self._from_chunks(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.copy()._chunks)
+        for high, container in other._chunks.items():
+            if high in chunks:
+                chunks[high] = _combine(chunks[high], container, _or)
+            else:
+                chunks[high] = (set(container)
+                                if isinstance(container, set) else container)
+
+        return self._from_chunks(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for high, container in self._chunks.items():
+            if high in other._chunks:
+                combined = _combine(container, other._chunks[high], _sub)
+            else:
+                combined = (set(container)
+                            if isinstance(container, set) else container)
+
+            if combined is not None:
+                chunks[high] = combined
+
+        return self._from_chunks(chunks)
@@ -0,0 +1,433 @@
+"""
+Contains the cache tables keep the results of their queries in.
+
+A :class:`QueryCache` holds up to ``capacity`` results and, given a byte
+budget, evicts the least recently used results until the estimated size of
+all results fits into it. Results that match nothing are cached as well.
+
+With ``admission='tinylfu'`` a new result only replaces the least recently
+used one if its query has been asked for more often recently (see
+:class:`FrequencySketch`), so that a burst of queries run once doesn't
+evict the results of queries run all the time:
+
+>>> cache = QueryCache(capacity=1, admission='tinylfu')
+>>> for _ in range(3):
+...     cache.get('hot')
+>>> cache['hot'] = []
+>>> cache['cold'] = []
+>>> cache.lru
+['hot']
+"""
+
+from collections import OrderedDict
+import sys
+import threading
+
+from .utils import iteritems, itervalues
+
+__all__ = ('QueryCache', 'CacheView', 'FrequencySketch', 'estimate_size')
+
+#: The admission policies a :class:`QueryCache` supports
+ADMISSIONS = (None, 'tinylfu')
+
+#: The number of documents of a result the size of the result is estimated
+#: from
+SIZE_SAMPLES = 16
+
+
+def sizeof(value):
+    """
+    Estimate the memory a value takes up, including the values it contains.
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        for key, item in iteritems(value):
+            size += sizeof(key) + sizeof(item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += sizeof(item)
+
+    return size
+
+
+def estimate_size(result):
+    """
+    Estimate the memory a list of documents takes up from the size of some
+    of them.
+    """
+    size = sys.getsizeof(result)
+    if not result:
+        return size
+
+    step = max(1, len(result) // SIZE_SAMPLES)
+    samples = result[::step][:SIZE_SAMPLES]
+
+    return size + sum(sizeof(doc) for doc in samples) * len(result) // \
+        len(samples)
+
+
+#: Mixes the hash of a key for each row of a :class:`FrequencySketch`
+_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK = 2 ** 64 - 1
+
+
+class FrequencySketch(object):
+    """
+    Estimates how often keys have been seen recently with a count-min
+    sketch: every key counts in one cell of each row, its frequency is the
+    smallest of these counts. All counts are halved after ``10 * width``
+    keys have been recorded, so that old popularity fades.
+    """
+
+    DEPTH = 4
+
+    def __init__(self, width=64):
+        self.width = width
+        self.rows = [[0] * width for _ in range(self.DEPTH)]
+        self.recorded = 0
+
+    def _cells(self, key):
+        # The hash of the key is mixed again for every row, the hashes of
+        # tuples of the row number and the key are too alike for keys
+        # sharing a cell in one row not to share it in the others
+        mixed = hash(key) & _MASK
+        for row in self.rows:
+            mixed = (mixed * _MULTIPLIER + 1) & _MASK
+            yield row, (mixed >> 32) % self.width
+
+    def record(self, key):
+        """
+        Count a key as seen.
+        """
+        for row, cell in self._cells(key):
+            row[cell] += 1
+
+        self.recorded += 1
+        if self.recorded >= 10 * self.width:
+            self._age()
+
+    def frequency(self, key):
+        """
+        Estimate how often a key has been seen recently.
+        """
+        return min(row[cell] for row, cell in self._cells(key))
+
+    def _age(self):
+        for row in self.rows:
+            for cell in range(self.width):
+                row[cell] //= 2
+
+        self.recorded //= 2
+
+    def clear(self):
+        for row in self.rows:
+            row[:] = [0] * self.width
+        self.recorded = 0
+
+
+class _Space(object):
+    """
+    The keys and statistics of the results cached in one namespace.
+    """
+
+    __slots__ = ('keys', 'hits', 'misses', 'evictions', 'rejections',
+                 'bytes')
+
+    def __init__(self):
+        self.keys = set()
+        self.hits = self.misses = self.evictions = self.rejections = 0
+        self.bytes = 0
+
+
+#: Stands for all namespaces
+_ALL = object()
+
+
+class QueryCache(object):
+    """
+    A least recently used cache of query results with an optional byte
+    budget, admission policy and statistics about its use.
+
+    A cache can be shared by several tables, each keeping its results in
+    its own namespace (see :meth:`view`). The capacity and budget are
+    shared, results are evicted least recently used first no matter which
+    table they belong to, so that the tables queried most keep most of the
+    results.
+
+    :param capacity: the maximum number of results, ``None`` for no limit
+    :param max_bytes: the maximum estimated size of all results in bytes,
+                      ``None`` for no limit
+    :param admission: ``'tinylfu'`` to only cache results of queries asked
+                      for more often than the result they would evict,
+                      ``None`` to always cache them
+    """
+
+    def __init__(self, capacity=None, max_bytes=None, admission=None):
+        if admission not in ADMISSIONS:
+            raise ValueError('Unknown admission policy: {!r}'.format(
+                admission))
+
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.admission = admission
+
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._spaces = {}
+        self._sketch = None
+        if admission == 'tinylfu':
+            self._sketch = FrequencySketch(max(64, 4 * (capacity or 0)))
+
+        self.bytes = 0
+
+        # Guards the results and statistics, the cache may be used by
+        # several threads and tables at once
+        self._lock = threading.RLock()
+
+    def view(self, namespace):
+        """
+        Get access to the results cached in a namespace, e.g. for a table.
+
+        :rtype: CacheView
+        """
+        return CacheView(self, namespace)
+
+    def _space(self, namespace):
+        space = self._spaces.get(namespace)
+        if space is None:
+            space = self._spaces[namespace] = _Space()
+        return space
+
+    @property
+    def lru(self):
+        return self.keys()
+
+    def keys(self, namespace=None):
+        """
+        Get the keys of the results cached in a namespace, least recently
+        used first.
+        """
+        with self._lock:
+            return [key for found, key in self._entries if found == namespace]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return (None, key) in self._entries
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def delete(self, key, namespace=None):
+        """
+        Drop a cached result.
+        """
+        with self._lock:
+            del self._entries[namespace, key]
+
+            size = self._sizes.pop((namespace, key))
+            space = self._spaces[namespace]
+            space.keys.discard(key)
+            space.bytes -= size
+            self.bytes -= size
+
+    def items(self, namespace=None):
+        """
+        Get the cached ``(key, value)`` pairs of a namespace, least recently
+        used first, without marking them as used.
+        """
+        with self._lock:
+            space = self._spaces.get(namespace)
+            if space is None:
+                return []
+
+            return [(key, self._entries[namespace, key])
+                    for key in self.keys(namespace)]
+
+    def get(self, key, default=None, namespace=None, record=True):
+        """
+        Get a cached result and mark it as used, counting a hit or a miss.
+
+        :param record: whether to count a miss and the request for the
+                       admission policy, which callers not caching the
+                       result they compute on a miss shouldn't
+        """
+        with self._lock:
+            full_key = namespace, key
+            if record and self._sketch is not None:
+                self._sketch.record(full_key)
+
+            space = self._space(namespace)
+            try:
+                value = self._entries.pop(full_key)
+            except KeyError:
+                if record:
+                    space.misses += 1
+                return default
+
+            self._entries[full_key] = value
+            space.hits += 1
+            return value
+
+    def set(self, key, value, namespace=None):
+        """
+        Cache a result, evicting the least recently used results if the
+        cache is full.
+        """
+        size = estimate_size(value)
+
+        with self._lock:
+            full_key = namespace, key
+            if full_key in self._entries:
+                self.delete(key, namespace)
+
+            space = self._space(namespace)
+            if self.capacity == 0 or (self.max_bytes is not None and
+                                      size > self.max_bytes):
+                space.rejections += 1
+                return
+
+            while self._entries and self._full(size):
+                victim = next(iter(self._entries))
+                if self._sketch is not None and \
+                        self._sketch.frequency(full_key) <= \
+                        self._sketch.frequency(victim):
+                    space.rejections += 1
+                    return
+
+                self.delete(victim[1], victim[0])
+                self._spaces[victim[0]].evictions += 1
+
+            self._entries[full_key] = value
+            self._sizes[full_key] = size
+            space.keys.add(key)
+            space.bytes += size
+            self.bytes += size
+
+    def _full(self, size):
+        return (self.capacity is not None and
+                len(self._entries) >= self.capacity) or \
+            (self.max_bytes is not None and
+             self.bytes + size > self.max_bytes)
+
+    def resize(self, key, namespace=None):
+        """
+        Estimate the size of a result again after it has been changed in
+        place.
+        """
+        with self._lock:
+            full_key = namespace, key
+            if full_key not in self._entries:
+                # Evicted in the meantime
+                return
+
+            size = estimate_size(self._entries[full_key])
+            change = size - self._sizes[full_key]
+
+            self._sizes[full_key] = size
+            self._spaces[namespace].bytes += change
+            self.bytes += change
+
+    def clear(self, namespace=_ALL):
+        """
+        Drop the results of a namespace or, by default, all results, keeping
+        the statistics.
+        """
+        with self._lock:
+            if namespace is _ALL:
+                self._entries.clear()
+                self._sizes.clear()
+                for space in itervalues(self._spaces):
+                    space.keys.clear()
+                    space.bytes = 0
+                self.bytes = 0
+                return
+
+            space = self._spaces.get(namespace)
+            if space is not None:
+                for key in list(space.keys):
+                    self.delete(key, namespace)
+
+    def stats(self, namespace=_ALL):
+        """
+        Get statistics about the use of the cache or one of its namespaces.
+
+        :returns: a dict holding the number of ``hits`` and ``misses``, the
+                  number of results evicted to make room for others
+                  (``evictions``) and the number of results not cached
+                  because they were too large or asked for too rarely
+                  (``rejections``) as well as the number of cached
+                  ``entries`` and their estimated size (``bytes``)
+        :rtype: dict
+        """
+        with self._lock:
+            if namespace is _ALL:
+                spaces = list(itervalues(self._spaces))
+            else:
+                spaces = [self._space(namespace)]
+
+            return {
+                'hits': sum(space.hits for space in spaces),
+                'misses': sum(space.misses for space in spaces),
+                'evictions': sum(space.evictions for space in spaces),
+                'rejections': sum(space.rejections for space in spaces),
+                'entries': sum(len(space.keys) for space in spaces),
+                'bytes': sum(space.bytes for space in spaces),
+            }
+
+
+class CacheView(object):
+    """
+    The results of one namespace of a :class:`QueryCache`, with the same
+    interface as the cache itself.
+    """
+
+    def __init__(self, cache, namespace):
+        self.cache = cache
+        self.namespace = namespace
+
+    @property
+    def lru(self):
+        return self.cache.keys(self.namespace)
+
+    def __len__(self):
+        space = self.cache._spaces.get(self.namespace)
+        return 0 if space is None else len(space.keys)
+
+    def __contains__(self, key):
+        return (self.namespace, key) in self.cache._entries
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.cache.delete(key, self.namespace)
+
+    def items(self):
+        return self.cache.items(self.namespace)
+
+    def get(self, key, default=None, record=True):
+        return self.cache.get(key, default, self.namespace, record)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.namespace)
+
+    def resize(self, key):
+        self.cache.resize(key, self.namespace)
+
+    def clear(self):
+        self.cache.clear(self.namespace)
+
+    def stats(self):
+        return self.cache.stats(self.namespace)
@@ -0,0 +1,431 @@
+"""
+Contains the query compiler.
+
+Running a query walks the closures :class:`~puchkidb.queries.QueryImpl`
+builds up for every ``&``, ``|`` and ``~``, each leaf resolving its path on
+its own. The compiler turns the expression tree of a query into a single
+generated function instead: paths used by several tests are looked up once,
+prefixes shared by several paths are resolved once for all of them,
+comparisons are inlined and ``and``/``or`` short-circuit as plain ``if``
+statements.
+
+>>> test = compile_query((where('a') == 1) & (where('a') != 2))
+>>> test({'a': 1})
+True
+"""
+
+import re
+
+from .planner import normalize, order_key, reorder
+from .queries import is_sequence, query_node
+from .utils import LRUCache, regex_prefilter, string_types
+
+__all__ = ('compile_node', 'compile_queries', 'compile_query')
+
+#: Marks a path that doesn't exist in the document
+_MISSING = object()
+
+#: Marks a path that hasn't been looked up yet
+_UNSET = object()
+
+#: The operators of comparisons that can be inlined
+_COMPARISONS = ('==', '!=', '<', '<=', '>', '>=')
+
+#: The types of values that can be looked up in a set
+_SCALARS = frozenset((int, float, bool, type(None)) + string_types)
+
+#: The types of strings regexes are run against
+_TEXT = frozenset((str, type(u'')))
+
+#: Compiled queries by their hash value
+_cache = LRUCache(capacity=512)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Compiler(object):
+    """
+    Generates the source of the function testing a query.
+
+    Every node emits statements that store its result in ``r``. A path is
+    looked up in front of the first test needing it. Tests emitted later at
+    the same or a deeper level reuse the result, tests that may run with or
+    without the lookup having happened (after a short-circuiting branch)
+    check for ``_UNSET`` first.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {
+            '_MISSING': _MISSING,
+            '_UNSET': _UNSET,
+            '_is_sequence': is_sequence,
+            '_SCALARS': _SCALARS,
+            '_TEXT': _TEXT,
+        }
+        self.paths = {}
+        self.looked_up = set()
+        self.shared = set()
+
+    def line(self, depth, code):
+        self.lines.append('    ' * depth + code)
+
+    def const(self, value):
+        name = 'c{}'.format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def key(self, part):
+        if type(part) in (str, int):
+            return repr(part)
+        return self.const(part)
+
+    def compile(self, node):
+        return self.compile_many([node], combined=False)
+
+    def compile_many(self, nodes, combined=True):
+        """
+        Get a function testing several expression trees at once, returning
+        a tuple with the result of each. Paths are looked up only once for
+        all of them.
+
+        :param combined: whether to return a tuple, only allowed to be
+                         ``False`` for a single tree
+        """
+        self.shared = shared_prefixes(
+            n.path for node in nodes for n in node.walk()
+            if n.op not in ('and', 'or', 'not', 'call') and n.path)
+
+        known = frozenset()
+        for i, node in enumerate(nodes):
+            # Paths looked up at the top level by a tree are known to the
+            # following ones
+            known = self.emit(node, 1, known)
+            if combined:
+                self.line(1, 'r{} = r'.format(i))
+
+        source = ['def _query(doc):']
+        if self.paths:
+            source.append('    {} = _UNSET'.format(
+                ' = '.join(sorted(self.paths.values()))))
+        source.extend(self.lines)
+        if combined:
+            source.append('    return ({}, )'.format(
+                ', '.join('r{}'.format(i) for i in range(len(nodes)))))
+        else:
+            source.append('    return r')
+        source = '\n'.join(source) + '\n'
+
+        exec(compile(source, '<query>', 'exec'), self.namespace)
+        func = self.namespace['_query']
+        func.source = source
+
+        return func
+
+    def lookup(self, path, depth, known):
+        """
+        Emit the lookup of a path unless it is known to have happened.
+
+        If the path shares a prefix with other paths of the query, the
+        prefix is looked up first and the rest of the path is looked up in
+        its value.
+
+        :returns: the variable holding the value and the paths known to have
+                  been looked up afterwards
+        """
+        if not path:
+            return 'doc', known
+
+        var = self.paths.get(path)
+        if var is None:
+            var = self.paths[path] = 'p{}'.format(len(self.paths))
+
+        if path in known:
+            return var, known
+
+        guarded = path in self.looked_up
+        inner = depth
+        if guarded:
+            # Looked up in another branch that may or may not have run
+            self.line(depth, 'if {} is _UNSET:'.format(var))
+            inner += 1
+
+        parent = self.parent(path)
+        if parent is None:
+            source, rest, inner_known = 'doc', path, known
+        else:
+            source, inner_known = self.lookup(parent, inner, known)
+            rest = path[len(parent):]
+            self.line(inner, 'if {} is _MISSING:'.format(source))
+            self.line(inner + 1, '{} = _MISSING'.format(var))
+            self.line(inner, 'else:')
+            inner += 1
+
+        access = source + ''.join('[{}]'.format(self.key(part))
+                                  for part in rest)
+        self.line(inner, 'try:')
+        self.line(inner + 1, '{} = {}'.format(var, access))
+        self.line(inner, 'except (KeyError, TypeError):')
+        self.line(inner + 1, '{} = _MISSING'.format(var))
+
+        self.looked_up.add(path)
+        if guarded:
+            # Lookups of the prefix within the guard may not have run
+            return var, known | frozenset([path])
+        return var, inner_known | frozenset([path])
+
+    def parent(self, path):
+        """
+        Get the longest shared prefix of a path.
+        """
+        for length in range(len(path) - 1, 0, -1):
+            if path[:length] in self.shared:
+                return path[:length]
+
+        return None
+
+    def emit(self, node, depth, known):
+        """
+        Emit the statements computing the result of a node.
+
+        :returns: the paths known to have been looked up afterwards
+        """
+        op = node.op
+
+        if op == 'and' or op == 'or':
+            first, rest = node.children[0], node.children[1:]
+            known = self.emit(first, depth, known)
+            for child in rest:
+                self.line(depth, 'if r:' if op == 'and' else 'if not r:')
+                self.emit(child, depth + 1, known)
+            return known
+
+        elif op == 'not':
+            known = self.emit(node.children[0], depth, known)
+            self.line(depth, 'r = not r')
+            return known
+
+        elif op == 'call':
+            self.line(depth, 'r = {}(doc)'.format(self.const(node.operand)))
+            return known
+
+        var, known = self.lookup(node.path, depth, known)
+        test = self.test(node, var)
+        if test is None:
+            self.line(depth, 'r = {} is not _MISSING'.format(var))
+        else:
+            self.line(depth, 'r = {} is not _MISSING and {}'.format(var, test))
+
+        return known
+
+    def test(self, node, var):
+        """
+        Get the expression testing the value of a path, ``None`` if the
+        path existing is all there is to test.
+        """
+        op, operand = node.op, node.operand
+
+        if op in ('path', 'exists'):
+            return None
+
+        elif op in _COMPARISONS:
+            return '{} {} {}'.format(var, op, self.const(operand))
+
+        elif op in ('matches', 'search'):
+            regex, flags = operand
+            try:
+                pattern = re.compile(regex, flags)
+            except Exception:
+                raise _Unsupported(node)
+
+            method = 'search' if op == 'search' else 'match'
+            test = '{}.{}({})'.format(self.const(pattern), method, var)
+
+            # Reject strings without the literal text of all matches first
+            prefix, literal = regex_prefilter(regex, flags, method == 'match')
+            if prefix:
+                return '(type({0}) not in _TEXT or {0}.startswith({1})) ' \
+                    'and {2}'.format(var, self.const(prefix), test)
+            elif literal:
+                return '(type({0}) not in _TEXT or {1} in {0}) and {2}' \
+                    .format(var, self.const(literal), test)
+            return test
+
+        elif op == 'test':
+            func, args = operand
+            if not args:
+                return '{}({})'.format(self.const(func), var)
+            return '{}({}, *{})'.format(self.const(func), var,
+                                        self.const(args))
+
+        elif op in ('any', 'all'):
+            if callable(operand):
+                each = '{}(e) for e in {}'.format(
+                    self.const(compile_query(operand)), var)
+            elif op == 'any':
+                each = 'e in {} for e in {}'.format(self.const(operand), var)
+            else:
+                each = 'e in {} for e in {}'.format(var, self.const(operand))
+
+            return '_is_sequence({}) and {}({})'.format(var, op, each)
+
+        elif op == 'between':
+            low, low_inclusive, high, high_inclusive = operand
+            return '{} {} {} and {} {} {}'.format(
+                var, '>=' if low_inclusive else '>', self.const(low),
+                var, '<=' if high_inclusive else '<', self.const(high))
+
+        elif op == 'one_of':
+            if not isinstance(operand, frozenset):
+                return '{} in {}'.format(var, self.const(operand))
+
+            # Values that can't be hashed are looked for one by one
+            return '({0} in {1} if type({0}) in _SCALARS else {0} in {2})' \
+                .format(var, self.const(operand), self.const(tuple(operand)))
+
+        raise _Unsupported(node)
+
+
+def shared_prefixes(paths):
+    """
+    Find the path prefixes worth looking up once for several paths.
+
+    A prefix is shared if it leads to more than one of the paths (or is
+    one of them and leads to another). Prefixes leading to the same paths
+    as a longer shared prefix are left out.
+
+    >>> sorted(shared_prefixes([('a', 'b', 'c'), ('a', 'b', 'd'), ('e', )]))
+    [('a', 'b')]
+    """
+    paths = set(paths)
+    below = {}
+    for path in paths:
+        for length in range(1, len(path)):
+            below.setdefault(path[:length], set()).add(path)
+
+    shared = set(prefix for prefix, found in below.items()
+                 if len(found) + (prefix in paths) > 1)
+
+    return set(prefix for prefix in shared
+               if prefix in paths or not any(
+                   below[longer] == below[prefix] for longer in shared
+                   if len(longer) > len(prefix) and
+                   longer[:len(prefix)] == prefix))
+
+
+def compile_node(node):
+    """
+    Get a function that tests documents like an expression tree describes.
+
+    :param node: the expression tree (see :func:`~puchkidb.queries.query_node`)
+    :returns: a callable taking a document or ``None`` if the tree can't be
+              compiled
+    """
+    try:
+        return _Compiler().compile(node)
+    except Exception:
+        return None
+
+
+def _tree(query, stats):
+    """
+    Get the normalized and, given statistics, reordered expression tree of
+    a query and the key to cache its compiled function with.
+    """
+    node = normalize(query_node(query))
+    if stats is None:
+        return node, query.hashval
+
+    node = reorder(node, stats)
+    return node, order_key(query, node)
+
+
+def compile_queries(queries, stats=None):
+    """
+    Get a function that tests documents against several queries at once.
+
+    The function returns a tuple with the result of every query. Paths
+    tested by several queries are looked up once per document. Cached like
+    :func:`compile_query`.
+
+    :param queries: the queries to compile
+    :param stats: the statistics to reorder the tests of the queries by
+    :type stats: puchkidb.planner.Statistics
+    :returns: a callable taking a document
+    """
+    queries = list(queries)
+
+    try:
+        trees = [_tree(query, stats) for query in queries]
+        key = ('many', ) + tuple(key for _, key in trees)
+        func = _cache.get(key)
+    except Exception:
+        # Unhashable operands or queries too deeply nested
+        trees, key, func = None, None, None
+
+    if func is not None:
+        return func
+
+    try:
+        func = _Compiler().compile_many([node for node, _ in trees])
+    except Exception:
+        # Run the queries one after another
+        tests = [compile_query(query, stats) for query in queries]
+
+        def func(doc):
+            return tuple(test(doc) for test in tests)
+
+    if key is not None:
+        _cache[key] = func
+
+    return func
+
+
+def compile_query(query, stats=None):
+    """
+    Get a function that tests documents like the query does.
+
+    The expression tree of the query is simplified first (see
+    :func:`~puchkidb.planner.normalize`). Compiled functions are cached by
+    the hash value of the query. Queries without an expression tree or with
+    tests the compiler doesn't know are returned as they are.
+
+    :param query: the query to compile
+    :param stats: if given, the tests of the query are reordered based on
+                  these statistics (see :func:`~puchkidb.planner.reorder`)
+    :type stats: puchkidb.planner.Statistics
+    :returns: a callable taking a document
+    """
+    if getattr(query, '_node', None) is None:
+        return query
+
+    node = None
+    try:
+        if stats is None:
+            key = query.hashval
+        else:
+            node = reorder(normalize(query_node(query)), stats)
+            key = order_key(query, node)
+        func = _cache.get(key)
+    except TypeError:
+        # Unhashable operands, can't be cached
+        key, func = None, None
+
+    if func is not None:
+        return func
+
+    try:
+        if node is None:
+            node = normalize(query_node(query))
+        func = _Compiler().compile(node)
+    except Exception:
+        # Unknown tests or a query too deeply nested to be compiled are run
+        # as they are
+        func = query
+
+    if key is not None:
+        _cache[key] = func
+
+    return func
@@ -7,10 +7,27 @@ try:
     from collections.abc import Mapping
 except ImportError:
     from collections import Mapping
+from contextlib import contextmanager
+from copy import deepcopy
+from functools import wraps
+from itertools import islice
+import threading
+from timeit import default_timer
 import warnings
 
 from . import JSONStorage
-from .utils import LRUCache, iteritems, itervalues
+from .storages import MemoryStorage
+from .aggregates import Accumulator, aggregate_spec, field_label
+from .bitmaps import Bitmap
+from .cache import QueryCache
+from .compiler import compile_queries, compile_query
+from .indexes import (INDEX_TYPES, advise, dump_indexes, field_path,
+                      load_indexes, plan, query_shape, resolve_path)
+from .joins import HOWS, hash_join, index_join
+from .locks import RWLock, StorageLock
+from .planner import Statistics
+from .sorting import external_sort, sort_key, sort_spec, top_k
+from .utils import freeze, iteritems, itervalues, string_types
 
 
 class Document(dict):
@@ -21,6 +38,10 @@ class Document(dict):
     to provide a way to access a record's id via ``el.doc_id``.
     """
 
+    #: How often the document had been written when it was read (see
+    #: :meth:`Table.cas`)
+    version = 0
+
     def __init__(self, value, doc_id, **kwargs):
         super(Document, self).__init__(**kwargs)
 
@@ -36,6 +57,22 @@ class Document(dict):
 Element = Document
 
 
+class VersionConflict(RuntimeError):
+    """
+    Raised if a document to be changed has been written since it was read,
+    see :meth:`Table.cas`.
+    """
+
+    def __init__(self, doc_id, expected, actual):
+        super(VersionConflict, self).__init__(
+            'Document {} has version {}, expected {}'.format(
+                doc_id, actual, expected))
+
+        self.doc_id = doc_id
+        self.expected = expected
+        self.actual = actual
+
+
 def _get_doc_id(doc_id, eid):
     # Backwards-compatibility shim
     if eid is not None:
@@ -60,68 +97,290 @@ def _get_doc_ids(doc_ids, eids):
         return doc_ids
 
 
+def _field_paths(fields):
+    """
+    Get the paths of the fields to project documents to, leaving out paths
+    below other paths.
+    """
+    if fields is None:
+        return None
+    elif isinstance(fields, string_types) or hasattr(fields, '_path'):
+        fields = [fields]
+
+    found = [field_path(field) for field in fields]
+
+    paths = []
+    for path in found:
+        if path not in paths and not any(
+                len(other) < len(path) and path[:len(other)] == other
+                for other in found):
+            paths.append(path)
+
+    return paths
+
+
+def _reading(method):
+    """
+    Run a method of a table holding its lock for reading.
+
+    If another process has changed the table's storage, what the table
+    derived from the data before is dropped first (see :meth:`Table._sync`).
+    """
+
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        if not self._lock.owned() and self._changed_elsewhere():
+            with self._lock.writing():
+                self._sync()
+
+        with self._lock.reading():
+            return method(self, *args, **kwargs)
+
+    return locked
+
+
+def _writing(method):
+    """
+    Run a method of a table holding its lock for writing.
+
+    Storages shared with other processes are locked exclusively for the
+    whole method, so that the data it reads can't change before it writes.
+    """
+
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock.writing(), self._storage.exclusive():
+            self._sync()
+            return method(self, *args, **kwargs)
+
+    return locked
+
+
+def _guarded(method):
+    """
+    Run a method of a table changing its indexes or statistics, which
+    concurrent readers do as well, holding the table's state lock.
+    """
+
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._state_lock:
+            return method(self, *args, **kwargs)
+
+    return locked
+
+
+def project(value, paths):
+    """
+    Get a dict holding only the values of a document found at the given
+    paths, nested paths keep their nesting.
+
+    >>> project({'a': 1, 'b': {'c': 2, 'd': 3}}, [('a', ), ('b', 'c')])
+    {'a': 1, 'b': {'c': 2}}
+    """
+    projected = {}
+    for path in paths:
+        try:
+            found = resolve_path(value, path)
+        except (KeyError, TypeError):
+            continue
+
+        target = projected
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+        target[path[-1]] = found
+
+    return projected
+
+
 class DataProxy(dict):
     """
     A proxy to a table's data that remembers the storage's
     data dictionary.
     """
 
-    def __init__(self, table, raw_data, **kwargs):
+    def __init__(self, table, raw_data, generation=None, **kwargs):
         super(DataProxy, self).__init__(**kwargs)
         self.update(table)
         self.raw_data = raw_data
+        self.generation = generation
 
 
 class StorageProxy(object):
     """
     A proxy that only allows to read a single table from a
     storage.
+
+    All proxies of a database share a lock (see
+    :class:`~puchkidb.locks.StorageLock`) they hold while accessing the
+    storage.
     """
 
-    def __init__(self, storage, table_name):
+    def __init__(self, storage, table_name, lock=None):
         self._storage = storage
         self._table_name = table_name
+        self._lock = lock if lock is not None else StorageLock()
 
     def _new_document(self, key, val):
         doc_id = int(key)
         return Document(val, doc_id)
 
+    def _new_projection(self, doc_id, val, paths):
+        """
+        Create a document holding only the values at some paths of a stored
+        document.
+
+        Proxies of storages that decode documents lazily can override this
+        to only decode the projected fields.
+
+        :param doc_id: the document's ID
+        :param val: the stored document
+        :param paths: the paths of the fields to keep
+        """
+        return Document(project(val, paths), doc_id)
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Keep other processes from writing the storage within a ``with``
+        block, if the storage locks them out (see
+        :meth:`~puchkidb.storages.JSONStorage.exclusive`), so that data read
+        within the block can be changed and written back safely.
+
+        The storage lock is held for the whole block as well, as threads of
+        one process share the storage's locks.
+        """
+        if not getattr(self._storage, 'locking', False):
+            yield
+            return
+
+        with self._lock, self._storage.exclusive():
+            yield
+
+    def _refresh(self):
+        refresh = getattr(self._storage, 'refresh', None)
+        return refresh is not None and refresh()
+
+    def external_writes(self):
+        """
+        Get the number of times the storage noticed the data being changed
+        by another process (see :meth:`~puchkidb.storages.Storage.refresh`).
+        """
+        with self._lock:
+            self._refresh()
+            return getattr(self._storage, 'external_writes', 0)
+
     def read(self):
-        raw_data = self._storage.read() or {}
+        with self._lock:
+            raw_data = self._storage.read() or {}
+
+            if self._table_name not in raw_data:
+                with self.exclusive():
+                    if self._refresh():
+                        # Another process has written in the meantime
+                        raw_data = self._storage.read() or {}
+                    if self._table_name not in raw_data:
+                        raw_data[self._table_name] = {}
+                        self._storage.write(raw_data)
+                        self._lock.written()
 
-        try:
             table = raw_data[self._table_name]
-        except KeyError:
-            raw_data.update({self._table_name: {}})
-            self._storage.write(raw_data)
-
-            return DataProxy({}, raw_data)
+            generation = self._lock.generation
 
         docs = {}
         for key, val in iteritems(table):
             doc = self._new_document(key, val)
             docs[doc.doc_id] = doc
 
-        return DataProxy(docs, raw_data)
+        return DataProxy(docs, raw_data, generation)
 
     def write(self, data):
-        try:
-            # Try accessing the full data dict from the data proxy
-            raw_data = data.raw_data
-        except AttributeError:
-            # Not a data proxy, fall back to regular reading
-            raw_data = self._storage.read()
+        with self._lock:
+            if getattr(data, 'generation', None) == self._lock.generation \
+                    and not self._refresh():
+                # Nothing has been written since the data proxy was read
+                raw_data = data.raw_data
+            else:
+                # Read the other tables again, they may have been changed
+                # in the meantime
+                raw_data = self._storage.read() or {}
+
+            raw_data[self._table_name] = dict(data)
+            self._storage.write(raw_data)
+            self._lock.written()
 
-        raw_data[self._table_name] = dict(data)
-        self._storage.write(raw_data)
+    def read_values(self):
+        """
+        Read the documents of the table without wrapping them into
+        :class:`Document` objects.
+
+        :returns: the documents by their IDs
+        :rtype: dict
+        """
+        if not self.plain_documents:
+            return self.read()
+
+        with self._lock:
+            raw_data = self._storage.read() or {}
+        table = raw_data.get(self._table_name, {})
+
+        return dict((int(key), val) for key, val in iteritems(table))
+
+    @property
+    def plain_documents(self):
+        """
+        Whether documents are created as :class:`Document` objects with the
+        number of their key as their ID, i.e. :meth:`_new_document` hasn't
+        been overridden to create them differently (e.g. with other IDs).
+        """
+        return type(self)._new_document is StorageProxy._new_document
 
     def purge_table(self):
-        try:
-            data = self._storage.read() or {}
-            del data[self._table_name]
-            self._storage.write(data)
-        except KeyError:
-            pass
+        with self._lock, self.exclusive():
+            try:
+                data = self._storage.read() or {}
+                del data[self._table_name]
+                self._storage.write(data)
+                self._lock.written()
+            except KeyError:
+                pass
+
+    @property
+    def snapshotted(self):
+        """
+        Whether snapshots of the storage are open (see
+        :meth:`PuchkiDB.snapshot`), which share the stored documents.
+        """
+        return self._lock.snapshots > 0
+
+    @property
+    def cache_namespace(self):
+        """
+        The namespace of the table's results in a
+        :class:`~puchkidb.cache.QueryCache` shared by several tables, which
+        may belong to different databases.
+        """
+        return self._storage, self._table_name
+
+    @property
+    def persists_indexes(self):
+        return getattr(self._storage, 'persists_indexes', False)
+
+    def generation(self):
+        """
+        Get the :attr:`~puchkidb.storages.Storage.generation` of the data the
+        storage read or wrote last.
+        """
+        with self._lock:
+            return getattr(self._storage, 'generation', None)
+
+    def read_index(self):
+        with self._lock:
+            return self._storage.read_index(self._table_name)
+
+    def write_index(self, payload):
+        with self._lock:
+            self._storage.write_index(self._table_name, payload)
 
 
 class PuchkiDB(object):
@@ -145,9 +404,14 @@ class PuchkiDB(object):
         :param storage: The class of the storage to use. Will be initialized
                         with ``args`` and ``kwargs``.
         :param default_table: The name of the default table to populate.
+        :param query_cache: A :class:`~puchkidb.cache.QueryCache` all tables
+                            keep their query results in instead of caches
+                            of their own, sharing its budget. It can be
+                            shared with other databases as well.
         """
 
         storage = kwargs.pop('storage', self.DEFAULT_STORAGE)
+        self._shared_cache = kwargs.pop('query_cache', None)
         default_table = kwargs.pop('default_table', self.DEFAULT_TABLE)
         self._cls_table = kwargs.pop('table_class', self.table_class)
         self._cls_storage_proxy = kwargs.pop('storage_proxy_class',
@@ -156,6 +420,7 @@ class PuchkiDB(object):
         # Prepare the storage
         #: :type: Storage
         self._storage = storage(*args, **kwargs)
+        self._storage_lock = StorageLock()
 
         self._opened = True
 
@@ -191,10 +456,19 @@ class PuchkiDB(object):
         if name in self._table_cache:
             return self._table_cache[name]
 
-        table_class = options.pop('table_class', self._cls_table)
-        table = table_class(self._cls_storage_proxy(self._storage, name), name, **options)
+        with self._storage_lock:
+            # Another thread may have created the table in the meantime
+            if name in self._table_cache:
+                return self._table_cache[name]
+
+            table_class = options.pop('table_class', self._cls_table)
+            if self._shared_cache is not None:
+                options.setdefault('query_cache', self._shared_cache)
+            proxy = self._cls_storage_proxy(self._storage, name,
+                                            self._storage_lock)
+            table = table_class(proxy, name, **options)
 
-        self._table_cache[name] = table
+            self._table_cache[name] = table
 
         return table
 
@@ -206,15 +480,23 @@ class PuchkiDB(object):
         :rtype: set[str]
         """
 
-        return set(self._storage.read())
+        with self._storage_lock:
+            return set(self._storage.read())
 
     def purge_tables(self):
         """
         Purge all tables from the database. **CANNOT BE REVERSED!**
         """
 
-        self._storage.write({})
-        self._table_cache.clear()
+        with self._storage_lock:
+            self._storage.write({})
+            self._storage_lock.written()
+            tables = list(itervalues(self._table_cache))
+            self._table_cache.clear()
+
+        # Leaves the results of other databases sharing the cache alone
+        for table in tables:
+            table.clear_cache()
 
     def purge_table(self, name):
         """
@@ -223,18 +505,151 @@ class PuchkiDB(object):
         :param name: The name of the table.
         :type name: str
         """
+        proxy = StorageProxy(self._storage, name, self._storage_lock)
+
         if name in self._table_cache:
             del self._table_cache[name]
+        if self._shared_cache is not None:
+            self._shared_cache.clear(proxy.cache_namespace)
 
-        proxy = StorageProxy(self._storage, name)
         proxy.purge_table()
 
+    def join(self, left, right, on, where=None, how='inner'):
+        """
+        Relate the documents of two tables with equal values in a field.
+
+        >>> db.join('orders', 'users', on=('user_id', 'id'),
+        ...         where=where('total') > 100, how='left')
+        [({'user_id': 1, 'total': 120}, {'id': 1, 'name': 'John'}), ...]
+
+        If one table has a sorted or bitmap index on its join field, the
+        documents of the other table look up their partners in the index
+        (as long as there are fewer of them than documents in the indexed
+        table). Otherwise a hash table is built from the smaller side and
+        the documents of the other side are looked up in it (see
+        :mod:`puchkidb.joins`).
+
+        :param left: the left table or its name
+        :param right: the right table or its name
+        :param on: a ``(left_field, right_field)`` pair of the fields to
+                   join on or a field both tables join on
+        :param where: a condition for the left documents or a
+                      ``(left_cond, right_cond)`` pair of conditions
+        :param how: ``'inner'`` to only return documents with a partner,
+                    ``'left'`` to also return left documents without one
+                    paired with ``None``
+        :returns: ``(left_doc, right_doc)`` pairs in the order of the left
+                  documents
+        :rtype: list[(Element, Element | None)]
+        """
+
+        if how not in HOWS:
+            raise ValueError('Unknown join: {!r}'.format(how))
+
+        left, right = self._join_table(left), self._join_table(right)
+        if isinstance(on, tuple) and len(on) == 2:
+            left_path, right_path = field_path(on[0]), field_path(on[1])
+        else:
+            left_path = right_path = field_path(on)
+
+        if isinstance(where, tuple):
+            left_cond, right_cond = where
+        else:
+            left_cond, right_cond = where, None
+
+        # Only one table's lock is held at a time, so that joins can't
+        # deadlock with each other
+        with left._lock.reading():
+            left_data, left_ids = left._join_rows(left_cond)
+
+        with right._lock.reading():
+            right_data = right._join_data(right_cond)
+            index = right._join_index(right_path, right_data)
+            if index is not None and len(left_ids) <= len(right_data):
+                rows = [(doc_id, left_data[doc_id]) for doc_id in left_ids]
+                pairs = index_join(rows, right._probe(index, right_data,
+                                                      right_cond),
+                                   left_path, right_path, how)
+                return self._joined(left, left_data, right, right_data,
+                                    pairs)
+
+            right_ids = right._join_ids(right_cond, right_data)
+
+        with left._lock.reading():
+            index = left._join_index(left_path, left_data)
+            if index is not None and how == 'inner' and \
+                    len(right_ids) <= len(left_data):
+                # Looked up the other way round, restore the left order
+                rows = [(doc_id, right_data[doc_id]) for doc_id in right_ids]
+                pairs = index_join(rows, left._probe(index, left_data),
+                                   right_path, left_path)
+                position = dict((doc_id, i)
+                                for i, doc_id in enumerate(left_ids))
+                pairs = sorted(((left_id, right_id)
+                                for right_id, left_id in pairs
+                                if left_id in position),
+                               key=lambda pair: position[pair[0]])
+                return self._joined(left, left_data, right, right_data,
+                                    pairs)
+
+        pairs = hash_join([(doc_id, left_data[doc_id]) for doc_id in left_ids],
+                          [(doc_id, right_data[doc_id])
+                           for doc_id in right_ids],
+                          left_path, right_path, how)
+        return self._joined(left, left_data, right, right_data, pairs)
+
+    def _join_table(self, table):
+        if isinstance(table, string_types):
+            return self.table(table)
+        return table
+
+    @staticmethod
+    def _joined(left, left_data, right, right_data, pairs):
+        """
+        Get the documents of the ``(left_id, right_id)`` pairs of a join.
+        """
+
+        return [(left._document(left_data, left_id),
+                 None if right_id is None else
+                 right._document(right_data, right_id))
+                for left_id, right_id in pairs]
+
+    def snapshot(self):
+        """
+        Get a consistent, read-only view of all tables as they are now.
+
+        The view keeps the stored data of this moment and doesn't hold any
+        locks, so that long running reads, e.g. iterating a whole table,
+        neither wait for writers nor make them wait. Writers keep the
+        documents the view shares intact by replacing documents instead of
+        changing them in place (copy on write) while it is open.
+
+        >>> with db.snapshot() as snap:
+        ...     for doc in snap.table('orders'):
+        ...         export(doc)
+
+        :rtype: Snapshot
+        """
+
+        with self._storage_lock:
+            data = dict(self._storage.read() or {})
+            self._storage_lock.snapshots += 1
+
+        return Snapshot(self, data)
+
     def close(self):
         """
         Close the database.
         """
+        for table in itervalues(self._table_cache):
+            table.save_indexes()
+            if self._shared_cache is not None:
+                # Nothing can use the results anymore
+                table.clear_cache()
+
         self._opened = False
-        self._storage.close()
+        with self._storage_lock:
+            self._storage.close()
 
     def __enter__(self):
         return self
@@ -275,7 +690,16 @@ class Table(object):
     Represents a single PuchkiDB Table.
     """
 
-    def __init__(self, storage, name, cache_size=10):
+    #: How often a query shape has to be run before indexes are advised
+    #: for it
+    ADVICE_MIN_QUERIES = 20
+
+    #: The largest share of the scanned documents a query shape may match
+    #: on average for indexes to be advised for it
+    ADVICE_MAX_SELECTIVITY = 0.2
+
+    def __init__(self, storage, name, cache_size=10, auto_index=False,
+                 cache_bytes=None, cache_admission=None, query_cache=None):
         """
         Get access to a table.
 
@@ -283,12 +707,37 @@ class Table(object):
         :type storage: StorageProxy
         :param name: The table name
         :param cache_size: Maximum size of query cache.
+        :param cache_bytes: Maximum estimated size of the cached query
+                            results in bytes.
+        :param cache_admission: ``'tinylfu'`` to only cache the results of
+                                queries run more often than those they
+                                would evict (see :mod:`puchkidb.cache`).
+        :param auto_index: Whether to create the indexes suggested by
+                           :meth:`index_advice` automatically.
+        :param query_cache: A :class:`~puchkidb.cache.QueryCache` shared
+                            with other tables to keep the query results in,
+                            replaces the cache options above.
         """
 
         self._storage = storage
         self._name = name
-        self._query_cache = LRUCache(capacity=cache_size)
-
+        if query_cache is not None:
+            self._query_cache = query_cache.view(storage.cache_namespace)
+        else:
+            self._query_cache = QueryCache(cache_size, cache_bytes,
+                                           cache_admission)
+        self._indexes = []
+        self._indexes_loaded = False
+        self._indexes_dirty = False
+        self._auto_index = auto_index
+        self._query_stats = {}
+        self._test_stats = Statistics()
+        self._versions = {}
+        self._epoch = 0
+        self._lock = RWLock()
+        self._state_lock = threading.RLock()
+
+        self._external_writes = self._storage.external_writes()
         data = self._read()
         self._init_last_id(data)
 
@@ -307,6 +756,33 @@ class Table(object):
         else:
             self._last_id = 0
 
+    def _changed_elsewhere(self):
+        return self._storage.external_writes() != self._external_writes
+
+    def _sync(self):
+        """
+        Drop the cached query results and indexes and look for the highest
+        document ID again if another process has changed the storage since
+        the last time, to be called while holding the lock for writing.
+        """
+        writes = self._storage.external_writes()
+        if writes == self._external_writes:
+            return
+        self._external_writes = writes
+
+        self._query_cache.clear()
+        with self._state_lock:
+            for index in self._indexes:
+                index.reset()
+
+        # Any document may have been changed
+        self._epoch += 1
+
+        # IDs used by the other process must not be used again
+        last_id = self._last_id
+        self._init_last_id(self._read())
+        self._last_id = max(last_id, self._last_id)
+
     @property
     def name(self):
         """
@@ -314,6 +790,7 @@ class Table(object):
         """
         return self._name
 
+    @_writing
     def process_elements(self, func, cond=None, doc_ids=None, eids=None):
         """
         Helper function for processing all documents specified by condition
@@ -350,10 +827,9 @@ class Table(object):
             doc_ids = []
 
             # Processed documents specified by condition
-            for doc_id in list(data):
-                if cond(data[doc_id]):
-                    func(data, doc_id)
-                    doc_ids.append(doc_id)
+            for doc_id in list(self._matching(cond, data)):
+                func(data, doc_id)
+                doc_ids.append(doc_id)
         else:
             # Processed documents
             doc_ids = list(data)
@@ -361,7 +837,7 @@ class Table(object):
             for doc_id in doc_ids:
                 func(data, doc_id)
 
-        self._write(data)
+        self._write(data, doc_ids)
 
         return doc_ids
 
@@ -373,6 +849,337 @@ class Table(object):
         """
         self._query_cache.clear()
 
+    def cache_stats(self):
+        """
+        Get statistics about the use of the query cache, e.g. to size it.
+
+        :returns: a dict holding the number of cache ``hits``, ``misses``,
+                  ``evictions`` and ``rejections``, the number of cached
+                  ``entries`` and their estimated size in ``bytes`` (see
+                  :meth:`puchkidb.cache.QueryCache.stats`)
+        :rtype: dict
+        """
+        return self._query_cache.stats()
+
+    @_guarded
+    def create_index(self, field, kind='sorted', where=None):
+        """
+        Create an index on a field to speed up queries testing it.
+
+        The index is built the first time a query can make use of it and
+        kept up to date on every write from then on. Creating an index that
+        already exists returns the existing one.
+
+        >>> table.create_index('message', 'text')
+        >>> table.create_index('due', where=Query().status == 'open')
+
+        :param field: the field to index, either a key, a list of keys
+                      leading to a nested value or a query path
+                      (``Query().address.city``)
+        :param kind: the type of the index (see
+                     :data:`~puchkidb.indexes.INDEX_TYPES`)
+        :param where: only index the documents matching this query. The
+                      index is only used for queries implying it.
+        :type where: Query
+        :returns: the index
+        :rtype: puchkidb.indexes.Index
+        """
+
+        try:
+            index_cls = INDEX_TYPES[kind]
+        except KeyError:
+            raise ValueError('Unknown index type: {!r}'.format(kind))
+
+        index = index_cls(field_path(field), where)
+
+        for existing in self._indexes:
+            if existing.signature() == index.signature():
+                return existing
+
+        self._indexes.append(index)
+
+        return index
+
+    @_guarded
+    def drop_index(self, field, kind=None):
+        """
+        Remove the indexes on a field.
+
+        :param field: the indexed field
+        :param kind: only remove indexes of this type
+        """
+
+        path = field_path(field)
+        self._indexes = [index for index in self._indexes
+                         if index.path != path or
+                         (kind is not None and index.kind != kind)]
+
+    def indexes(self):
+        """
+        Get all indexes of the table.
+
+        :rtype: list[puchkidb.indexes.Index]
+        """
+
+        return list(self._indexes)
+
+    @_reading
+    def save_indexes(self):
+        """
+        Store the table's indexes next to its data, if the storage supports
+        it and they have changed since they were last stored.
+
+        Stored indexes are loaded the first time a query needs them instead
+        of being rebuilt. They are tied to the generation of the stored data
+        (see :attr:`~puchkidb.storages.Storage.generation`) and rebuilt if
+        the data has been changed in the meantime, e.g. when the process has
+        crashed before saving them. Called when the database is closed.
+        """
+
+        if self._indexes_dirty:
+            self._save_indexes()
+
+    def _save_indexes(self):
+        if not self._storage.persists_indexes:
+            self._indexes_dirty = False
+            return
+
+        # Unknown e.g. while writes haven't been flushed, saved later then
+        generation = self._stored_generation()
+        if generation is not None:
+            self._storage.write_index(dump_indexes(self._indexes, generation))
+            self._indexes_dirty = False
+
+    def _stored_generation(self):
+        """
+        Get the generation of the stored data the indexes describe or
+        ``None`` if unknown, e.g. because another process has changed the
+        data since it has been read.
+        """
+
+        generation = self._storage.generation()
+        if self._changed_elsewhere():
+            return None
+
+        return generation
+
+    @_guarded
+    def _ready_indexes(self, data):
+        """
+        Get all indexes of the table, loading or building the ones not
+        ready yet.
+        """
+
+        pending = [index for index in self._indexes if not index.ready]
+        if not pending:
+            return self._indexes
+
+        if not self._indexes_loaded and self._storage.persists_indexes:
+            # Only the first use can find up to date stored indexes
+            self._indexes_loaded = True
+            payload = self._storage.read_index()
+            generation = self._stored_generation()
+            if payload is not None and generation is not None:
+                load_indexes(payload, pending, generation)
+
+        built = False
+        for index in pending:
+            if not index.ready:
+                index.build(data)
+                built = True
+
+        if built:
+            self._indexes_dirty = True
+            self._save_indexes()
+
+        return self._indexes
+
+    def _update_indexes(self, data, doc_ids):
+        """
+        Bring the indexes up to date after a write.
+
+        :param data: the new table contents
+        :param doc_ids: the IDs of the changed documents or ``None`` if
+                        unknown
+        """
+
+        for index in self._indexes:
+            if not index.ready:
+                continue
+
+            self._indexes_dirty = True
+            if doc_ids is None:
+                index.reset()
+                continue
+
+            for doc_id in doc_ids:
+                index.remove(doc_id)
+                if doc_id in data:
+                    index.add(doc_id, data[doc_id])
+
+    def _candidates(self, cond, data):
+        """
+        Get the IDs of the documents that have to be tested against a
+        condition.
+
+        Uses the table's indexes to skip documents that can't match.
+
+        :returns: the document IDs and whether these are exactly the IDs of
+                  the matching documents
+        :rtype: (Iterable[int], bool)
+        """
+
+        hashval = getattr(cond, 'hashval', None)
+        if not self._indexes or hashval is None:
+            return data.keys(), False
+
+        found = plan(hashval, self._ready_indexes(data), lambda: Bitmap(data))
+        if found is None:
+            return data.keys(), False
+
+        return found
+
+    def _matching(self, cond, data):
+        """
+        Iterate over the IDs of all documents matching a condition.
+        """
+
+        return self._select(cond, data, *self._candidates(cond, data))
+
+    def _select(self, cond, data, doc_ids, exact):
+        """
+        Iterate over the IDs of the candidates matching a condition.
+        """
+
+        if exact:
+            return (doc_id for doc_id in doc_ids if doc_id in data)
+
+        self._sample(cond, data)
+
+        test = compile_query(cond, self._test_stats)
+        return (doc_id for doc_id in doc_ids
+                if doc_id in data and test(data[doc_id]))
+
+    @_guarded
+    def _sample(self, cond, data):
+        """
+        Sample the tests of a condition the planner has too few statistics
+        about (see :meth:`~puchkidb.planner.Statistics.sample`).
+        """
+
+        node = getattr(cond, '_node', None)
+        if node is not None and self._test_stats.wants(node):
+            self._test_stats.sample(node, itervalues(data))
+
+    def _match_many(self, conds, data):
+        """
+        Get the IDs of the documents matching each of several conditions.
+
+        Conditions answered by the indexes alone or narrowed down by them
+        are run on their own, all others are tested in a single pass over
+        the documents by one function (see
+        :func:`~puchkidb.compiler.compile_queries`).
+
+        :returns: a list of document IDs for every condition
+        :rtype: list[list[int]]
+        """
+
+        results = [None] * len(conds)
+        scanned = []
+
+        for i, cond in enumerate(conds):
+            start = default_timer()
+            doc_ids, exact = self._candidates(cond, data)
+
+            if exact or isinstance(doc_ids, Bitmap):
+                results[i] = list(self._select(cond, data, doc_ids, exact))
+                self._record_query(cond, 0 if exact else len(doc_ids),
+                                   len(results[i]), default_timer() - start)
+            else:
+                scanned.append(i)
+                results[i] = []
+
+        if not scanned:
+            return results
+
+        start = default_timer()
+        for i in scanned:
+            self._sample(conds[i], data)
+
+        test = compile_queries([conds[i] for i in scanned], self._test_stats)
+        found = [results[i] for i in scanned]
+
+        for doc_id, value in iteritems(data):
+            for matched, doc_ids in zip(test(value), found):
+                if matched:
+                    doc_ids.append(doc_id)
+
+        # The scan is shared, every condition gets its share of the time
+        elapsed = (default_timer() - start) / len(scanned)
+        for i in scanned:
+            self._record_query(conds[i], len(data), len(results[i]), elapsed)
+
+        return results
+
+    def _join_data(self, cond):
+        """
+        Read the documents of the table for a join.
+        """
+
+        if cond is None:
+            return self._storage.read_values()
+        return self._read_for(cond)
+
+    def _join_ids(self, cond, data):
+        """
+        Get the IDs of the documents taking part in a join.
+        """
+
+        if cond is None:
+            return list(data)
+        return list(self._matching(cond, data))
+
+    def _join_rows(self, cond):
+        data = self._join_data(cond)
+        return data, self._join_ids(cond, data)
+
+    def _join_index(self, path, data):
+        """
+        Get an index the partners of documents joining on a path can be
+        looked up in, ``None`` if there is none.
+        """
+
+        if not self._indexes:
+            return None
+
+        for index in self._ready_indexes(data):
+            if index.kind in ('sorted', 'bitmap') and index.where is None \
+                    and index.path == path:
+                return index
+
+        return None
+
+    def _probe(self, index, data, cond=None):
+        """
+        Get a function returning the ``(doc_id, document)`` pairs of the
+        documents that may have a join value, looked up in an index.
+        """
+
+        test = None if cond is None else compile_query(cond,
+                                                       self._test_stats)
+
+        def probe(key):
+            found = index.lookup(('==', index.path, key))
+            # Values the index can't look up are searched for in all
+            # documents
+            doc_ids = data.keys() if found is None else found[0]
+
+            for doc_id in doc_ids:
+                if doc_id in data and (test is None or test(data[doc_id])):
+                    yield doc_id, data[doc_id]
+
+        return probe
+
     def _get_next_id(self):
         """
         Increment the ID used the last time and return it
@@ -398,32 +1205,176 @@ class Table(object):
 
         return self._storage.read()
 
-    def _write(self, values):
+    def _read_for(self, cond):
+        """
+        Read the documents to test against a condition.
+
+        Queries only testing fields don't need :class:`Document` objects and
+        get the stored values, so that only matching documents have to be
+        wrapped (see :meth:`_document`).
+
+        :returns: the documents by their IDs
+        :rtype: DataProxy | dict
+        """
+
+        if self._needs_documents(cond):
+            return self._read()
+
+        return self._storage.read_values()
+
+    @staticmethod
+    def _needs_documents(cond):
+        """
+        Check whether a condition has to be tested against
+        :class:`Document` objects.
+        """
+
+        node = getattr(cond, '_node', None)
+
+        # Opaque tests may need the documents' IDs
+        return node is None or any(n.op == 'call' for n in node.walk())
+
+    def _document(self, data, doc_id, paths=None):
+        """
+        Get a document read by :meth:`_read_for`.
+
+        :param paths: the paths of the fields to project the document to,
+                      ``None`` for the whole document
+        """
+
+        value = data[doc_id]
+        if paths is not None:
+            doc = self._storage._new_projection(doc_id, value, paths)
+        elif isinstance(value, Document):
+            doc = value
+        else:
+            doc = Document(value, doc_id)
+
+        return self._versioned(doc)
+
+    def _version(self, doc_id):
+        """
+        Get the current version of a document.
+
+        Versions count the writes of documents since the table has been
+        opened. Writes of unknown documents and writes by other processes
+        raise the versions of all documents.
+        """
+        return self._versions.get(doc_id, 0) + self._epoch
+
+    def _versioned(self, doc):
+        """
+        Set the version of a document about to be returned.
+        """
+        doc.version = self._version(doc.doc_id)
+        return doc
+
+    def _write(self, values, doc_ids=None):
         """
         Writing access to the DB.
 
         :param values: the new values to write
         :type values: DataProxy | dict
+        :param doc_ids: the IDs of the documents that have been changed,
+                        ``None`` if unknown
         """
 
-        self._query_cache.clear()
         self._storage.write(values)
 
+        # Only once the write succeeded, the versions, cached results and
+        # indexes would describe documents that haven't been stored
+        # otherwise
+        if doc_ids is None:
+            self._epoch += 1
+        else:
+            for doc_id in doc_ids:
+                self._versions[doc_id] = self._versions.get(doc_id, 0) + 1
+
+        self._update_cache(values, doc_ids)
+        self._update_indexes(values, doc_ids)
+
+    def _update_cache(self, data, doc_ids):
+        """
+        Bring the cached query results up to date after a write.
+
+        Only the changed documents are tested against the cached queries,
+        their results are patched: documents that don't match anymore are
+        dropped, changed documents are replaced and documents that match
+        now are added in the order of the table. The cache is cleared if the
+        changed documents aren't known or make up most of the table.
+
+        :param data: the new table contents
+        :param doc_ids: the IDs of the changed documents or ``None`` if
+                        unknown
+        """
+
+        if doc_ids is None or len(doc_ids) * 2 > len(data) or \
+                not self._storage.plain_documents:
+            self._query_cache.clear()
+            return
+
+        changed = set(doc_ids)
+        positions = None
+
+        for cond, docs in self._query_cache.items():
+            test = compile_query(cond)
+            matching = {}
+            try:
+                for doc_id in changed:
+                    if doc_id not in data:
+                        continue
+
+                    doc = self._versioned(Document(data[doc_id], doc_id))
+                    if test(doc):
+                        matching[doc_id] = doc
+            except Exception:
+                # Leave it to the query to raise when it's run again
+                try:
+                    del self._query_cache[cond]
+                except KeyError:
+                    pass
+                continue
+
+            result = []
+            for doc in docs:
+                if doc.doc_id not in changed:
+                    result.append(doc)
+                elif doc.doc_id in matching:
+                    result.append(matching.pop(doc.doc_id))
+
+            if matching:
+                # Documents that didn't match before
+                if positions is None:
+                    positions = dict((doc_id, i)
+                                     for i, doc_id in enumerate(data))
+                result.extend(itervalues(matching))
+                result.sort(key=lambda doc: positions[doc.doc_id])
+
+            docs[:] = result
+            self._query_cache.resize(cond)
+
     def __len__(self):
         """
         Get the total number of documents in the table.
         """
         return len(self._read())
 
-    def all(self):
+    def all(self, fields=None):
         """
         Get all documents stored in the table.
 
+        :param fields: the fields to project the documents to (see
+                       :meth:`search`)
         :returns: a list with all documents.
         :rtype: list[Element]
         """
 
-        return list(itervalues(self._read()))
+        if fields is not None:
+            paths = _field_paths(fields)
+            data = self._storage.read_values()
+            return [self._document(data, doc_id, paths) for doc_id in data]
+
+        return [self._versioned(doc) for doc in itervalues(self._read())]
 
     def __iter__(self):
         """
@@ -434,8 +1385,9 @@ class Table(object):
         """
 
         for value in itervalues(self._read()):
-            yield value
+            yield self._versioned(value)
 
+    @_writing
     def insert(self, document):
         """
         Insert a new document into the table.
@@ -447,10 +1399,11 @@ class Table(object):
         doc_id = self._get_doc_id(document)
         data = self._read()
         data[doc_id] = dict(document)
-        self._write(data)
+        self._write(data, [doc_id])
 
         return doc_id
 
+    @_writing
     def insert_multiple(self, documents):
         """
         Insert multiple documents into the table.
@@ -468,7 +1421,7 @@ class Table(object):
 
             data[doc_id] = dict(doc)
 
-        self._write(data)
+        self._write(data, doc_ids)
 
         return doc_ids
 
@@ -492,7 +1445,9 @@ class Table(object):
             cond, doc_ids
         )
 
-    def update(self, fields, cond=None, doc_ids=None, eids=None):
+    @_writing
+    def update(self, fields, cond=None, doc_ids=None, eids=None,
+               if_version=None):
         """
         Update all matching documents to have a given set of fields.
 
@@ -503,21 +1458,83 @@ class Table(object):
         :type cond: query
         :param doc_ids: a list of document IDs
         :type doc_ids: list
+        :param if_version: only update the documents given by ``doc_ids``
+                           if they all still have this version (see
+                           :meth:`cas`), raise a :class:`VersionConflict`
+                           otherwise
         :returns: a list containing the updated document's ID
         """
         doc_ids = _get_doc_ids(doc_ids, eids)
 
+        if if_version is not None:
+            if doc_ids is None:
+                raise ValueError('if_version needs the documents given by '
+                                 'doc_ids')
+
+            for doc_id in doc_ids:
+                self._check_version(doc_id, if_version)
+
         if callable(fields):
-            return self.process_elements(
-                lambda data, doc_id: fields(data[doc_id]),
-                cond, doc_ids
-            )
+            def perform_update(data, doc_id):
+                if self._storage.snapshotted:
+                    # Functions may change nested values, which snapshots
+                    # share, the document is copied first
+                    data[doc_id] = deepcopy(data[doc_id])
+                fields(data[doc_id])
+
+            return self.process_elements(perform_update, cond, doc_ids)
         else:
             return self.process_elements(
                 lambda data, doc_id: data[doc_id].update(fields),
                 cond, doc_ids
             )
 
+    def _check_version(self, doc_id, version):
+        current = self._version(doc_id)
+        if current != version:
+            raise VersionConflict(doc_id, version, current)
+
+    @_writing
+    def cas(self, doc_id, version, document):
+        """
+        Replace a document if it hasn't been written since it was read
+        (compare and swap).
+
+        Documents carry the version they had when they were read as
+        ``doc.version``, so that a document can be read, changed and written
+        back without holding a lock in the meantime, retrying if another
+        writer got there first:
+
+        >>> while True:
+        ...     doc = table.get(doc_id=1)
+        ...     doc['count'] += 1
+        ...     try:
+        ...         table.cas(1, doc.version, doc)
+        ...         break
+        ...     except VersionConflict:
+        ...         pass
+
+        :param doc_id: the ID of the document to replace
+        :param version: the version the document was read with
+        :param document: the new document
+        :returns: the new version of the document
+        :raises VersionConflict: if the document has been written since or
+                                 doesn't exist anymore
+        """
+        if not isinstance(document, Mapping):
+            raise ValueError('Document is not a Mapping')
+
+        data = self._read()
+        if doc_id not in data:
+            raise VersionConflict(doc_id, version, None)
+        self._check_version(doc_id, version)
+
+        data[doc_id] = dict(document)
+        self._write(data, [doc_id])
+
+        return self._version(doc_id)
+
+    @_writing
     def write_back(self, documents, doc_ids=None, eids=None):
         """
         Write back documents by doc_id
@@ -549,10 +1566,11 @@ class Table(object):
         for doc_id in doc_ids:
             data[doc_id] = dict(documents.pop())
 
-        self._write(data)
+        self._write(data, doc_ids)
 
         return doc_ids
 
+    @_writing
     def upsert(self, document, cond):
         """
         Update a document, if it exist - insert it otherwise.
@@ -570,6 +1588,7 @@ class Table(object):
         else:
             return [self.insert(document)]
 
+    @_writing
     def purge(self):
         """
         Purge the table by removing all documents.
@@ -578,26 +1597,266 @@ class Table(object):
         self._write({})
         self._last_id = 0
 
-    def search(self, cond):
+    @_reading
+    def search(self, cond, limit=None, offset=0, order_by=None, fields=None):
         """
         Search for all documents matching a 'where' cond.
 
+        If ``limit`` or ``offset`` are given, only as many documents as
+        needed are tested. If ``fields`` are given, the documents only hold
+        these fields, other fields are never copied.
+
         :param cond: the condition to check against
         :type cond: Query
+        :param limit: the maximum number of documents to return
+        :param offset: the number of matching documents to skip
+        :param order_by: the field to sort the documents by, a
+                         ``(field, 'asc' | 'desc')`` pair or a list of
+                         these (see :mod:`puchkidb.sorting`)
+        :param fields: the fields (keys or queries like
+                       ``Query().address.city``) to project the documents
+                       to
 
         :returns: list of matching documents
         :rtype: list[Element]
         """
 
-        if cond in self._query_cache:
-            return self._query_cache.get(cond, [])[:]
+        stop = None if limit is None else offset + limit
+
+        if order_by is not None:
+            return list(islice(self._search_sorted(cond, order_by, stop,
+                                                   _field_paths(fields)),
+                               offset, stop))
+
+        if limit is not None or offset or fields is not None:
+            return list(islice(self.search_iter(cond, fields=fields),
+                               offset, stop))
+
+        cached = self._query_cache.get(cond)
+        if cached is not None:
+            return cached[:]
 
-        docs = [doc for doc in self.all() if cond(doc)]
+        data = self._read_for(cond)
+        start = default_timer()
+
+        doc_ids, exact = self._candidates(cond, data)
+        docs = [self._document(data, doc_id)
+                for doc_id in self._select(cond, data, doc_ids, exact)]
+
+        self._record_query(cond, 0 if exact else len(doc_ids), len(docs),
+                           default_timer() - start)
         self._query_cache[cond] = docs
 
         return docs[:]
 
-    def get(self, cond=None, doc_id=None, eid=None):
+    @_reading
+    def search_many(self, conds):
+        """
+        Search for the documents matching each of several conditions.
+
+        The conditions are tested in a single pass over the table, looking
+        up fields tested by several of them only once per document.
+        Results are cached like those of :meth:`search`.
+
+        >>> open_tasks, late_tasks = table.search_many([
+        ...     where('status') == 'open', where('due') < '2018-06-01'])
+
+        :param conds: the conditions to check against
+        :type conds: list[Query]
+        :returns: a list of matching documents for every condition
+        :rtype: list[list[Element]]
+        """
+
+        conds = list(conds)
+        results = [None] * len(conds)
+        missing = []
+
+        for i, cond in enumerate(conds):
+            cached = self._query_cache.get(cond)
+            if cached is not None:
+                results[i] = cached[:]
+            else:
+                missing.append(i)
+
+        if not missing:
+            return results
+
+        pending = [conds[i] for i in missing]
+        if any(self._needs_documents(cond) for cond in pending):
+            data = self._read()
+        else:
+            data = self._storage.read_values()
+
+        # Documents matching several conditions are only wrapped once
+        documents = {}
+        for i, doc_ids in zip(missing, self._match_many(pending, data)):
+            docs = []
+            for doc_id in doc_ids:
+                doc = documents.get(doc_id)
+                if doc is None:
+                    doc = documents[doc_id] = self._document(data, doc_id)
+                docs.append(doc)
+
+            self._query_cache[conds[i]] = docs
+            results[i] = docs[:]
+
+        return results
+
+    @_reading
+    def search_iter(self, cond, order_by=None, fields=None):
+        """
+        Iterate over all documents matching a 'where' cond.
+
+        Documents are tested while iterating, so stopping early skips the
+        remaining ones. Uses the table's contents at the time it is called,
+        writes while iterating don't affect the documents returned.
+
+        :param cond: the condition to check against
+        :type cond: Query
+        :param order_by: the field(s) to sort the documents by (see
+                         :meth:`search`)
+        :param fields: the fields to project the documents to (see
+                       :meth:`search`)
+        :rtype: Iterator[Element]
+        """
+
+        paths = _field_paths(fields)
+
+        if order_by is not None:
+            return self._search_sorted(cond, order_by, paths=paths,
+                                       snapshot=True)
+
+        # Only peeks, results aren't cached here on a miss
+        cached = self._query_cache.get(cond, record=False)
+        if cached is not None:
+            if paths is None:
+                return iter(cached[:])
+            return (self._versioned(
+                self._storage._new_projection(doc.doc_id, doc, paths))
+                for doc in cached[:])
+
+        data = self._read_for(cond)
+        return (self._document(data, doc_id, paths)
+                for doc_id in self._matching(cond, data))
+
+    def _search_sorted(self, cond, order_by, stop=None, paths=None,
+                       snapshot=False):
+        """
+        Iterate over the documents matching a condition in the given order.
+
+        Streams the documents in the order of a sorted index on the field
+        if there is one. Otherwise only the first ``stop`` documents are
+        kept in a heap or, if all documents are needed, they are sorted
+        (see :func:`~puchkidb.sorting.external_sort`).
+
+        :param snapshot: whether to copy the order of the index, so that it
+                         can be iterated without holding the table's lock
+        """
+
+        spec = sort_spec(order_by)
+        data = self._read_for(cond)
+        doc_ids, exact = self._candidates(cond, data)
+
+        index = self._sort_index(spec, data)
+        if index is not None:
+            ordered = index.iter_sorted(reverse=spec[0][1])
+            if snapshot:
+                ordered = list(ordered)
+            if isinstance(doc_ids, Bitmap):
+                # Narrowed down by the indexes
+                ordered = (doc_id for doc_id in ordered if doc_id in doc_ids)
+
+            return (self._document(data, doc_id, paths)
+                    for doc_id in self._select(cond, data, ordered, exact))
+
+        key = sort_key(spec)
+        keys = (key(doc_id, data[doc_id])
+                for doc_id in self._select(cond, data, doc_ids, exact))
+
+        if stop is not None:
+            keys = top_k(keys, stop)
+        else:
+            keys = external_sort(keys)
+
+        return (self._document(data, doc_key[-1], paths) for doc_key in keys)
+
+    def _sort_index(self, spec, data):
+        """
+        Get a sorted index covering all documents that documents can be
+        sorted by, ``None`` if there is none.
+        """
+
+        if len(spec) != 1 or not self._indexes:
+            return None
+
+        for index in self._ready_indexes(data):
+            if index.kind == 'sorted' and index.where is None and \
+                    index.path == spec[0][0]:
+                return index
+
+        return None
+
+    @_guarded
+    def _record_query(self, cond, scanned, matched, elapsed):
+        """
+        Keep statistics about the shape of a query that has been run.
+
+        :param scanned: the number of documents the query was run against
+        :param matched: the number of matching documents
+        :param elapsed: the time taken in seconds
+        """
+
+        hashval = getattr(cond, 'hashval', None)
+        if hashval is None:
+            return
+
+        shape = query_shape(hashval)
+        stats = self._query_stats.get(shape)
+        if stats is None:
+            stats = self._query_stats[shape] = [0, 0, 0, 0.0]
+
+        stats[0] += 1
+        stats[1] += scanned
+        stats[2] += matched
+        stats[3] += elapsed
+
+        if self._auto_index and stats[0] % self.ADVICE_MIN_QUERIES == 0:
+            for advice in self.index_advice():
+                self.create_index(advice['field'], advice['kind'])
+
+    def index_advice(self, min_queries=None, max_selectivity=None):
+        """
+        Suggest indexes based on the queries that have been run.
+
+        Every query run by :meth:`search` or :meth:`count` is recorded by
+        its shape, i.e. the fields and operators it uses regardless of the
+        values it compares with. Indexes are suggested for the fields of
+        shapes that have been run often and matched few of the documents
+        they scanned.
+
+        :param min_queries: how often a query shape has to have been run
+                            (default: :attr:`ADVICE_MIN_QUERIES`)
+        :param max_selectivity: the largest share of the scanned documents
+                                a query shape may match (default:
+                                :attr:`ADVICE_MAX_SELECTIVITY`)
+        :returns: a list of dicts with the ``field`` and ``kind`` to pass
+                  to :meth:`create_index` as well as the number of
+                  ``queries`` using it and the documents they ``scanned``
+                  and ``matched`` in total and the time they took
+                  (``elapsed``), most expensive queries first
+        :rtype: list[dict]
+        """
+
+        if min_queries is None:
+            min_queries = self.ADVICE_MIN_QUERIES
+        if max_selectivity is None:
+            max_selectivity = self.ADVICE_MAX_SELECTIVITY
+
+        return advise(self._query_stats, self._indexes, self._read(),
+                      min_queries, max_selectivity)
+
+    @_reading
+    def get(self, cond=None, doc_id=None, eid=None, fields=None):
         """
         Get exactly one document specified by a query or and ID.
 
@@ -608,6 +1867,9 @@ class Table(object):
 
         :param doc_id: the document's ID
 
+        :param fields: the fields to project the document to (see
+                       :meth:`search`)
+
         :returns: the document or None
         :rtype: Element | None
         """
@@ -616,15 +1878,54 @@ class Table(object):
         # Cannot use process_elements here because we want to return a
         # specific document
 
+        paths = _field_paths(fields)
+
         if doc_id is not None:
             # Document specified by ID
-            return self._read().get(doc_id, None)
+            if paths is None:
+                doc = self._read().get(doc_id, None)
+                return None if doc is None else self._versioned(doc)
+
+            data = self._storage.read_values()
+            if doc_id in data:
+                return self._document(data, doc_id, paths)
+            return None
 
         # Document specified by condition
-        for doc in self.all():
-            if cond(doc):
-                return doc
+        data = self._read_for(cond)
+        for doc_id in self._matching(cond, data):
+            return self._document(data, doc_id, paths)
+
+    @_reading
+    def text_search(self, field, terms):
+        """
+        Search for documents whose field contains any of the given words,
+        best matches first.
+
+        Uses the field's text index if there is one, otherwise ranks all
+        documents on the fly.
+
+        >>> table.text_search('message', 'connection reset')
+
+        :param field: the field to search in
+        :param terms: a string or a list of strings to search for
+        :returns: list of matching documents
+        :rtype: list[Element]
+        """
+
+        path = field_path(field)
+        data = self._read()
+
+        for index in self._ready_indexes(data):
+            if index.path == path and index.kind == 'text':
+                break
+        else:
+            index = INDEX_TYPES['text'](path)
+            index.build(data)
+
+        return [data[doc_id] for doc_id, _ in index.rank(terms)]
 
+    @_reading
     def count(self, cond):
         """
         Count the documents matching a condition.
@@ -633,7 +1934,197 @@ class Table(object):
         :type cond: Query
         """
 
-        return len(self.search(cond))
+        # Only peeks, results aren't cached here on a miss
+        cached = self._query_cache.get(cond, record=False)
+        if cached is not None:
+            return len(cached)
+
+        data = self._read_for(cond)
+        start = default_timer()
+
+        doc_ids, exact = self._candidates(cond, data)
+
+        # Answers of the indexes alone are only checked for being stored
+        count = 0
+        for _ in self._select(cond, data, doc_ids, exact):
+            count += 1
+
+        self._record_query(cond, 0 if exact else len(doc_ids), count,
+                           default_timer() - start)
+
+        return count
+
+    @_reading
+    def count_many(self, conds):
+        """
+        Count the documents matching each of several conditions in a single
+        pass over the table (see :meth:`search_many`).
+
+        :param conds: the conditions to use
+        :type conds: list[Query]
+        :returns: the number of matching documents for every condition
+        :rtype: list[int]
+        """
+
+        conds = list(conds)
+        results = [None] * len(conds)
+        missing = []
+
+        for i, cond in enumerate(conds):
+            # Only peeks, results aren't cached here on a miss
+            cached = self._query_cache.get(cond, record=False)
+            if cached is not None:
+                results[i] = len(cached)
+            else:
+                missing.append(i)
+
+        if not missing:
+            return results
+
+        pending = [conds[i] for i in missing]
+        if any(self._needs_documents(cond) for cond in pending):
+            data = self._read()
+        else:
+            data = self._storage.read_values()
+
+        for i, doc_ids in zip(missing, self._match_many(pending, data)):
+            results[i] = len(doc_ids)
+
+        return results
+
+    @_reading
+    def aggregate(self, cond=None, group_by=None, count=False, sum=None,
+                  min=None, max=None, avg=None):
+        """
+        Compute aggregates over the documents matching a condition in a
+        single pass, optionally for groups of documents with equal values.
+
+        >>> table.aggregate(where('paid') == True, group_by='country',
+        ...                 count=True, sum='amount')
+        [{'country': 'IN', 'count': 2, 'sum': {'amount': 150}}, ...]
+
+        ``sum`` and ``avg`` only take numbers into account, ``min`` and
+        ``max`` numbers and strings (see
+        :class:`~puchkidb.aggregates.Accumulator`). Counting documents by
+        a field with a bitmap index doesn't touch any document if the
+        indexes answer the condition.
+
+        :param cond: the condition to check against, ``None`` for all
+                     documents
+        :param group_by: the field or list of fields to group documents
+                         by, documents without the field are grouped under
+                         ``None``
+        :param count: whether to count the documents, implied if no other
+                      aggregate is given
+        :param sum: the field or list of fields to sum up
+        :param min: the field or list of fields to find the minimum of
+        :param max: the field or list of fields to find the maximum of
+        :param avg: the field or list of fields to average
+        :returns: a dict with the ``count`` and a dict for every other
+                  aggregate mapping field names to their values, with
+                  ``group_by`` a list of such dicts that also hold the
+                  values of the grouped fields
+        :rtype: dict | list[dict]
+        """
+
+        spec = aggregate_spec(count or not (sum or min or max or avg),
+                              sum=sum, min=min, max=max, avg=avg)
+
+        if group_by is None:
+            if [name for name, _, _ in spec] == ['count'] and \
+                    cond is not None:
+                return {'count': self.count(cond)}
+
+            accumulator = Accumulator(spec)
+            data, doc_ids = self._aggregated(cond)
+            for doc_id in doc_ids:
+                accumulator.add(data[doc_id])
+
+            return accumulator.result()
+
+        if isinstance(group_by, string_types) or hasattr(group_by, '_path'):
+            group_by = [group_by]
+        groups = [(field_path(field), field_label(field))
+                  for field in group_by]
+
+        if len(spec) == 1 and len(groups) == 1 and spec[0][0] == 'count':
+            counts = self._group_counts(cond, groups[0][0])
+            if counts is not None:
+                return [{groups[0][1]: value, 'count': found}
+                        for value, found in counts]
+
+        accumulators = {}
+        data, doc_ids = self._aggregated(cond)
+        for doc_id in doc_ids:
+            doc = data[doc_id]
+
+            values = []
+            for path, _ in groups:
+                try:
+                    values.append(resolve_path(doc, path))
+                except (KeyError, TypeError):
+                    values.append(None)
+
+            key = freeze(values)
+            try:
+                found = accumulators.get(key)
+            except TypeError:
+                # Values that can't be hashed are grouped by their repr
+                key = repr(key)
+                found = accumulators.get(key)
+
+            if found is None:
+                found = accumulators[key] = (values, Accumulator(spec))
+            found[1].add(doc)
+
+        results = []
+        for values, accumulator in itervalues(accumulators):
+            result = dict((label, value)
+                          for (_, label), value in zip(groups, values))
+            result.update(accumulator.result())
+            results.append(result)
+
+        return results
+
+    def _aggregated(self, cond):
+        """
+        Get the documents to aggregate and the IDs of the ones matching a
+        condition, in the order they are stored in.
+        """
+
+        if cond is None:
+            data = self._storage.read_values()
+            return data, list(data)
+
+        data = self._read_for(cond)
+        return data, self._matching(cond, data)
+
+    def _group_counts(self, cond, path):
+        """
+        Count the documents matching a condition by their values at a path
+        using a bitmap index, ``None`` if there is none or the indexes
+        can't answer the condition.
+        """
+
+        if not self._indexes:
+            return None
+
+        data = self._storage.read_values()
+        for index in self._ready_indexes(data):
+            if index.kind == 'bitmap' and index.where is None and \
+                    index.path == path:
+                break
+        else:
+            return None
+
+        if cond is None:
+            doc_ids = index.covered
+        else:
+            doc_ids, exact = self._candidates(cond, data)
+            if not exact:
+                return None
+
+        return index.group_counts(doc_ids & index.covered)
 
     def contains(self, cond=None, doc_ids=None, eids=None):
         """
@@ -657,6 +2148,126 @@ class Table(object):
         return self.get(cond) is not None
 
 
+class Snapshot(object):
+    """
+    A read-only view of all tables of a database at one point in time (see
+    :meth:`PuchkiDB.snapshot`).
+
+    Gives access to its tables like :class:`PuchkiDB` does, the methods of
+    the default table are available directly. Has to be closed when done
+    with, which a ``with`` block does.
+    """
+
+    def __init__(self, db, data):
+        self._db = db
+        self._data = data
+        self._names = set(data)
+        self._storage = MemoryStorage()
+        self._storage.memory = data
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def table(self, name=None):
+        """
+        Get the view of a table, the default table if no name is given.
+
+        Tables created after the snapshot are empty.
+
+        :rtype: TableSnapshot
+        """
+        if name is None:
+            name = self._db._table.name
+
+        with self._lock:
+            if self._data is None:
+                raise ValueError('The snapshot has been closed')
+
+            if name not in self._tables:
+                self._data.setdefault(name, {})
+                proxy = self._db._cls_storage_proxy(self._storage, name)
+                self._tables[name] = TableSnapshot(
+                    self._db._cls_table(proxy, name))
+
+            return self._tables[name]
+
+    def tables(self):
+        """
+        Get the names of the tables at the time of the snapshot.
+
+        :rtype: set[str]
+        """
+        return set(self._names)
+
+    def close(self):
+        """
+        Drop the data of the snapshot, writers won't have to copy the
+        documents it shares anymore.
+        """
+        with self._lock:
+            if self._data is None:
+                return
+
+            self._data = None
+            self._tables.clear()
+
+        with self._db._storage_lock:
+            self._db._storage_lock.snapshots -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        """
+        Forward all unknown attribute calls to the default table's view.
+        """
+        return getattr(self.table(), name)
+
+    def __len__(self):
+        return len(self.table())
+
+    def __iter__(self):
+        return iter(self.table())
+
+
+class TableSnapshot(object):
+    """
+    A read-only view of a table in a :class:`Snapshot`, offering the
+    methods of :class:`Table` that don't change the documents.
+    """
+
+    #: The methods of tables changing the documents
+    WRITES = frozenset(['insert', 'insert_multiple', 'update', 'upsert',
+                        'remove', 'purge', 'write_back', 'cas',
+                        'process_elements'])
+
+    def __init__(self, table):
+        self._table = table
+
+    @property
+    def name(self):
+        return self._table.name
+
+    def __repr__(self):
+        return '<{} name={!r}>'.format(type(self).__name__, self.name)
+
+    def __getattr__(self, name):
+        if name in self.WRITES:
+            raise RuntimeError('Snapshots are read-only')
+        return getattr(self._table, name)
+
+    def __len__(self):
+        return len(self._table)
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __contains__(self, doc_id):
+        return self._table.contains(doc_ids=[doc_id])
+
+
 # Set the default table class
 PuchkiDB.table_class = Table
 
@@ -0,0 +1,1115 @@
+"""
+Contains the :class:`base class <puchkidb.indexes.Index>` for indexes and
+implementations.
+
+An index is an optional lookup structure a
+:class:`~puchkidb.database.Table` maintains for one field of its documents.
+When a query is run, the table asks its indexes which documents *may*
+match and only runs the query against those:
+
+>>> table.create_index('message', 'text')
+>>> table.search(where('message').search(r'connection reset'))
+"""
+
+from bisect import bisect_left, bisect_right, insort
+import json
+import math
+import re
+
+from .bitmaps import Bitmap
+from .utils import FrozenDict, fold, freeze, iteritems, regex_literals, \
+    string_types
+
+__all__ = ('Index', 'SortedIndex', 'TextIndex', 'BitmapIndex',
+           'INDEX_TYPES')
+
+#: Marks the missing bound of a range of values
+_UNBOUNDED = object()
+
+
+def field_path(field):
+    """
+    Get the path tuple of a field given as a key, a sequence of keys or a
+    query (``Query().address.city``).
+    """
+    path = getattr(field, '_path', None)
+    if path is not None:
+        return path
+    elif isinstance(field, (tuple, list)):
+        return tuple(field)
+    else:
+        return (field, )
+
+
+def resolve_path(doc, path):
+    """
+    Get the value stored at ``path`` in a document.
+
+    Raises ``KeyError`` or ``TypeError`` if the path doesn't exist.
+    """
+    value = doc
+    for part in path:
+        value = value[part]
+
+    return value
+
+
+class Index(object):
+    """
+    The base class for all indexes.
+
+    An index covers the values found at a single path of the documents of a
+    table. Indexes are built lazily: the table calls :meth:`build` the first
+    time a query could make use of the index and from then on keeps it up to
+    date by calling :meth:`add` and :meth:`remove` for changed documents.
+
+    A *partial* index only covers the documents matching its ``where``
+    query. It is only used for queries that imply this filter.
+    """
+
+    #: The name the index type is registered under in :data:`INDEX_TYPES`
+    kind = None
+
+    def __init__(self, path, where=None):
+        self.path = path
+        self.where = where
+        self.ready = False
+        self.clear()
+
+    def __repr__(self):
+        return '<{} path={!r} ready={}>'.format(type(self).__name__,
+                                                self.path, self.ready)
+
+    def signature(self):
+        """
+        Get a value identifying the definition of the index, used to match
+        persisted indexes with the indexes of a table.
+        """
+
+        if self.where is None:
+            return self.kind, self.path
+
+        return self.kind, self.path, canonical(self.where.hashval)
+
+    def dump(self):
+        """
+        Get the indexed values in a form :func:`dump_indexes` can
+        serialize.
+        """
+
+        return dict((key, value) for key, value in iteritems(self.__dict__)
+                    if key not in ('path', 'where', 'ready'))
+
+    def restore(self, state):
+        """
+        Restore the indexed values returned by :meth:`dump`.
+        """
+
+        self.__dict__.update(state)
+        self.ready = True
+
+    def clear(self):
+        """
+        Drop all indexed values.
+        """
+
+        #: The IDs of all documents the index covers
+        self.covered = Bitmap()
+
+    def build(self, docs):
+        """
+        (Re)build the index from all documents of a table.
+
+        :param docs: a mapping of document IDs to documents
+        """
+
+        self.clear()
+        for doc_id, doc in iteritems(docs):
+            self.add(doc_id, doc)
+
+        self.ready = True
+
+    def reset(self):
+        """
+        Mark the index as outdated so it will be rebuilt on its next use.
+        """
+
+        self.clear()
+        self.ready = False
+
+    def add(self, doc_id, doc):
+        """
+        Index a document.
+        """
+
+        if self.where is not None and not self.where(doc):
+            return
+
+        self.covered.add(doc_id)
+
+        try:
+            value = resolve_path(doc, self.path)
+        except (KeyError, TypeError):
+            return
+
+        self.insert(doc_id, value)
+
+    def insert(self, doc_id, value):
+        """
+        Index the value a document has at the index's path.
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+    def remove(self, doc_id):
+        """
+        Remove a document from the index.
+        """
+
+        self.covered.discard(doc_id)
+        self.delete(doc_id)
+
+    def delete(self, doc_id):
+        """
+        Remove the value of a document from the index.
+        """
+
+        raise NotImplementedError('To be overridden!')
+
+    def lookup(self, hashval):
+        """
+        Find the documents that may match a single query test.
+
+        :param hashval: the hash value of a query testing the index's path
+        :returns: ``None`` if the index can't answer the test, otherwise a
+                  ``(doc_ids, exact)`` tuple of a new bitmap holding a
+                  superset of the IDs of the matching documents and
+                  whether these are exactly the matching documents
+        :rtype: (Bitmap, bool) | None
+        """
+
+        return None
+
+
+def _family(value):
+    """
+    Get the group of types a value can be ordered with, ``None`` if it
+    can't be ordered reliably.
+    """
+    if isinstance(value, (bool, int, float)):
+        # NaN isn't ordered against anything
+        return 'number' if value == value else None
+    elif isinstance(value, string_types):
+        return 'string'
+
+    try:
+        if isinstance(value, long):  # noqa: F821
+            return 'number'
+    except NameError:
+        pass
+
+    return None
+
+
+class SortedIndex(Index):
+    """
+    An index keeping the documents sorted by their value.
+
+    Answers equality, ``one_of``, ``exists`` and range tests (``<``,
+    ``<=``, ``>``, ``>=``) by binary search. Numbers and strings are kept in
+    separate sorted lists, other values (``None``, lists, dicts) can only be
+    found by testing the documents holding them.
+    """
+
+    kind = 'sorted'
+
+    def clear(self):
+        super(SortedIndex, self).clear()
+        self._sorted = {}
+        self._values = {}
+        self._unordered = Bitmap()
+
+    def insert(self, doc_id, value):
+        family = _family(value)
+        self._values[doc_id] = (family, value)
+
+        if family is None:
+            self._unordered.add(doc_id)
+        else:
+            insort(self._sorted.setdefault(family, []), (value, doc_id))
+
+    def delete(self, doc_id):
+        try:
+            family, value = self._values.pop(doc_id)
+        except KeyError:
+            return
+
+        if family is None:
+            self._unordered.discard(doc_id)
+            return
+
+        entries = self._sorted[family]
+        del entries[bisect_left(entries, (value, doc_id))]
+        if not entries:
+            del self._sorted[family]
+
+    def _range(self, family, lower=_UNBOUNDED, lower_incl=True,
+               upper=_UNBOUNDED, upper_incl=True):
+        entries = self._sorted.get(family, [])
+        start, stop = 0, len(entries)
+
+        # Document IDs are positive, so (value, 0) sorts before and
+        # (value, inf) after every entry holding ``value``
+        if lower is not _UNBOUNDED:
+            bound = (lower, 0) if lower_incl else (lower, float('inf'))
+            start = bisect_left(entries, bound)
+        if upper is not _UNBOUNDED:
+            bound = (upper, float('inf')) if upper_incl else (upper, 0)
+            stop = bisect_right(entries, bound)
+
+        return Bitmap(doc_id for _, doc_id in entries[start:stop])
+
+    def _others(self, family):
+        """
+        Get the documents whose values can't be compared with values of the
+        given family.
+        """
+
+        others = self._unordered.copy()
+        for other, entries in iteritems(self._sorted):
+            if other != family:
+                others = others | Bitmap(doc_id for _, doc_id in entries)
+
+        return others
+
+    def iter_sorted(self, reverse=False):
+        """
+        Iterate over the IDs of the covered documents ordered by their
+        values: numbers, then strings (both in reverse order if
+        ``reverse`` is set), then documents with values that can't be
+        ordered and finally documents without a value. Documents with equal
+        values are ordered by their IDs.
+        """
+
+        families = ('string', 'number') if reverse else ('number', 'string')
+        for family in families:
+            entries = self._sorted.get(family, [])
+            if not reverse:
+                for _, doc_id in entries:
+                    yield doc_id
+                continue
+
+            stop = len(entries)
+            while stop:
+                # All entries with the same value, in the order of their IDs
+                start = bisect_left(entries, (entries[stop - 1][0], 0))
+                for _, doc_id in entries[start:stop]:
+                    yield doc_id
+                stop = start
+
+        for doc_id in self._unordered:
+            yield doc_id
+        for doc_id in self.covered - Bitmap(self._values):
+            yield doc_id
+
+    def lookup(self, hashval):
+        op = hashval[0]
+
+        if op in ('path', 'exists'):
+            return Bitmap(self._values), True
+
+        elif op == '==':
+            family = _family(hashval[2])
+            if family is None:
+                return self._unordered.copy(), False
+
+            value = hashval[2]
+            return self._range(family, value, True, value, True), True
+
+        elif op == 'one_of':
+            if isinstance(hashval[2], string_types):
+                # Looks for substrings
+                return None
+
+            candidates, exact = Bitmap(), True
+            for item in hashval[2]:
+                found, item_exact = self.lookup(('==', self.path, item))
+                candidates, exact = candidates | found, exact and item_exact
+
+            return candidates, exact
+
+        elif op in _BOUNDS:
+            family = _family(hashval[2])
+            if family is None:
+                return None
+
+            bounds = _BOUNDS[op](hashval[2])
+            candidates = self._range(family, *bounds)
+
+            # Comparing values of other types raises a TypeError, leave it
+            # to the query to do so
+            others = self._others(family)
+            if others:
+                return candidates | others, False
+
+            return candidates, True
+
+        return None
+
+
+#: Arguments for :meth:`SortedIndex._range` for a comparison with a value
+_BOUNDS = {
+    '<': lambda rhs: (_UNBOUNDED, True, rhs, False),
+    '<=': lambda rhs: (_UNBOUNDED, True, rhs, True),
+    '>': lambda rhs: (rhs, False, _UNBOUNDED, True),
+    '>=': lambda rhs: (rhs, True, _UNBOUNDED, True),
+}
+
+
+def tokenize(text):
+    """
+    Split a text into case-folded words.
+    """
+
+    return _TOKEN.findall(fold(text))
+
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def trigrams(text):
+    """
+    Get all substrings of length three of a case-folded text.
+    """
+
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TextIndex(Index):
+    """
+    A full-text index for string values.
+
+    Keeps an inverted index of the words in every value to rank
+    :meth:`~puchkidb.database.Table.text_search` results and a trigram index
+    to narrow down the candidates for
+    :meth:`~puchkidb.queries.Query.search` and
+    :meth:`~puchkidb.queries.Query.matches`: a document can only match a
+    regex if its value contains every trigram of the literal text the regex
+    requires.
+    """
+
+    kind = 'text'
+
+    def clear(self):
+        super(TextIndex, self).clear()
+        self._words = {}
+        self._trigrams = {}
+        self._docs = {}
+
+    def insert(self, doc_id, value):
+        if not isinstance(value, string_types):
+            return
+
+        counts = {}
+        for word in tokenize(value):
+            counts[word] = counts.get(word, 0) + 1
+
+        grams = trigrams(fold(value))
+
+        for word, count in iteritems(counts):
+            self._words.setdefault(word, {})[doc_id] = count
+        for gram in grams:
+            postings = self._trigrams.get(gram)
+            if postings is None:
+                postings = self._trigrams[gram] = Bitmap()
+            postings.add(doc_id)
+
+        self._docs[doc_id] = (counts, grams)
+
+    def delete(self, doc_id):
+        try:
+            counts, grams = self._docs.pop(doc_id)
+        except KeyError:
+            return
+
+        for word in counts:
+            postings = self._words[word]
+            del postings[doc_id]
+            if not postings:
+                del self._words[word]
+
+        for gram in grams:
+            postings = self._trigrams[gram]
+            postings.discard(doc_id)
+            if not postings:
+                del self._trigrams[gram]
+
+    def lookup(self, hashval):
+        if hashval[0] not in ('search', 'matches'):
+            return None
+
+        _, _, regex, flags = hashval
+        analyzed = regex_literals(regex, flags)
+        if analyzed is None:
+            return None
+
+        _, literals, ignorecase = analyzed
+        postings = []
+
+        for literal in literals:
+            if ignorecase and not _is_ascii(literal):
+                # Unicode case-insensitive matching isn't guaranteed to
+                # agree with case folding
+                continue
+
+            for gram in trigrams(fold(literal)):
+                found = self._trigrams.get(gram)
+                if found is None:
+                    # No document contains the literal
+                    return Bitmap(), True
+                postings.append(found)
+
+        if not postings:
+            return None
+
+        # Intersect the smallest bitmaps first
+        postings.sort(key=len)
+        candidates = postings[0].copy()
+        for found in postings[1:]:
+            candidates = candidates & found
+
+        return candidates, False
+
+    def rank(self, terms):
+        """
+        Rank the indexed documents by how well they match a set of words.
+
+        Scores are computed with TF-IDF: words that occur in fewer documents
+        weigh more.
+
+        :param terms: a string or a list of strings to search for
+        :returns: a list of ``(doc_id, score)`` tuples, best match first
+        """
+
+        if isinstance(terms, string_types):
+            terms = [terms]
+
+        words = set()
+        for term in terms:
+            words.update(tokenize(term))
+
+        total = len(self._docs)
+        scores = {}
+
+        for word in words:
+            postings = self._words.get(word)
+            if not postings:
+                continue
+
+            idf = math.log(1.0 + float(total) / len(postings))
+            for doc_id, count in iteritems(postings):
+                scores[doc_id] = scores.get(doc_id, 0.0) + count * idf
+
+        return sorted(iteritems(scores), key=lambda item: (-item[1], item[0]))
+
+
+def _is_ascii(text):
+    return all(ord(char) < 128 for char in text)
+
+
+#: The types of values that are stored as they are by freeze()
+_SCALARS = (bool, int, float, type(None)) + string_types
+
+
+class BitmapIndex(Index):
+    """
+    An index storing a bitmap of document IDs for every distinct value.
+
+    Meant for fields with few distinct values (status flags, countries,
+    booleans): equality, ``one_of``, ``exists`` and comparison tests are
+    answered exactly by combining the bitmaps of the matching values, so
+    queries made up of these tests don't have to touch any document.
+    """
+
+    kind = 'bitmap'
+
+    def clear(self):
+        super(BitmapIndex, self).clear()
+        self._bitmaps = {}
+        self._keys = {}
+
+    def insert(self, doc_id, value):
+        try:
+            key = freeze(value)
+            bitmap = self._bitmaps.get(key)
+        except TypeError:
+            # Not hashable, the index can't answer tests for this value
+            key = _UNHASHABLE
+            bitmap = self._bitmaps.get(key)
+
+        if bitmap is None:
+            bitmap = self._bitmaps[key] = Bitmap()
+
+        bitmap.add(doc_id)
+        self._keys[doc_id] = key
+
+    def delete(self, doc_id):
+        try:
+            key = self._keys.pop(doc_id)
+        except KeyError:
+            return
+
+        bitmap = self._bitmaps[key]
+        bitmap.discard(doc_id)
+        if not bitmap:
+            del self._bitmaps[key]
+
+    def group_counts(self, doc_ids):
+        """
+        Count documents by their values.
+
+        :param doc_ids: the IDs of the documents to count, all covered by
+                        the index
+        :type doc_ids: Bitmap
+        :returns: a list of ``(value, count)`` pairs ordered by the first
+                  document holding the value, documents without a value
+                  are counted for ``None``. ``None`` if some values aren't
+                  scalars.
+        """
+
+        if any(type(key) not in _SCALARS for key in self._bitmaps):
+            return None
+
+        counts = {}
+        first = {}
+        rest = doc_ids
+        for key, bitmap in iteritems(self._bitmaps):
+            found = bitmap & doc_ids
+            if found:
+                counts[key] = len(found)
+                first[key] = next(iter(found))
+                rest = rest - found
+
+        if rest:
+            counts[None] = counts.get(None, 0) + len(rest)
+            first[None] = min(first.get(None, float('inf')), next(iter(rest)))
+
+        return [(key, counts[key]) for key in sorted(counts, key=first.get)]
+
+    def _union(self, test):
+        if _UNHASHABLE in self._bitmaps:
+            return None
+
+        result = Bitmap()
+        try:
+            for key, bitmap in iteritems(self._bitmaps):
+                if test(key):
+                    result = result | bitmap
+        except TypeError:
+            # Values that cannot be compared with the operand, leave it to
+            # the query to handle them
+            return None
+
+        return result, True
+
+    def lookup(self, hashval):
+        op = hashval[0]
+
+        if op in ('path', 'exists'):
+            return self._union(lambda key: True)
+
+        elif op == '==':
+            rhs = hashval[2]
+            try:
+                bitmap = self._bitmaps.get(rhs)
+            except TypeError:
+                return None
+
+            if bitmap is None and _UNHASHABLE in self._bitmaps:
+                return None
+
+            return (bitmap or Bitmap()).copy(), True
+
+        elif op == '!=':
+            rhs = hashval[2]
+            return self._union(lambda key: key != rhs)
+
+        elif op == 'one_of':
+            items = hashval[2]
+            return self._union(lambda key: key in items)
+
+        elif op in _COMPARISONS:
+            compare, rhs = _COMPARISONS[op], hashval[2]
+            return self._union(lambda key: compare(key, rhs))
+
+        return None
+
+
+_UNHASHABLE = object()
+
+_COMPARISONS = {
+    '<': lambda value, rhs: value < rhs,
+    '<=': lambda value, rhs: value <= rhs,
+    '>': lambda value, rhs: value > rhs,
+    '>=': lambda value, rhs: value >= rhs,
+}
+
+
+def canonical(hashval):
+    """
+    Get a string representation of a query's hash value that is the same
+    in every process.
+    """
+
+    if isinstance(hashval, frozenset):
+        return 'frozenset([{}])'.format(
+            ', '.join(sorted(canonical(item) for item in hashval)))
+    elif isinstance(hashval, tuple):
+        return '({})'.format(', '.join(canonical(item) for item in hashval))
+
+    return repr(hashval)
+
+
+def _interval(hashval):
+    """
+    Get the ``(lower, lower_incl, upper, upper_incl)`` bounds a single
+    comparison test restricts its value to.
+    """
+
+    op = hashval[0]
+    if op == '==':
+        return hashval[2], True, hashval[2], True
+    elif op in _BOUNDS:
+        return _BOUNDS[op](hashval[2])
+
+    return None
+
+
+def _within(inner, outer):
+    lower, lower_incl, upper, upper_incl = inner
+    outer_lower, outer_lower_incl, outer_upper, outer_upper_incl = outer
+
+    if outer_lower is not _UNBOUNDED:
+        if lower is _UNBOUNDED or lower < outer_lower:
+            return False
+        if lower == outer_lower and lower_incl and not outer_lower_incl:
+            return False
+
+    if outer_upper is not _UNBOUNDED:
+        if upper is _UNBOUNDED or upper > outer_upper:
+            return False
+        if upper == outer_upper and upper_incl and not outer_upper_incl:
+            return False
+
+    return True
+
+
+def _compares_none(hashval):
+    if hashval[0] == 'one_of':
+        return any(item is None for item in hashval[2])
+    return len(hashval) > 2 and hashval[2] is None
+
+
+def _substrings(hashval):
+    return hashval[0] == 'one_of' and isinstance(hashval[2], string_types)
+
+
+def _implies_test(query, cond):
+    if query[0] in _COMPOUND or cond[0] in _COMPOUND:
+        return False
+    elif len(query) < 2 or len(cond) < 2:
+        # Custom queries without a path
+        return False
+
+    path = cond[1]
+    if cond[0] in ('path', 'exists'):
+        # All tests fail if their path doesn't exist
+        return query[1][:len(path)] == path
+
+    if query[1] != path:
+        return False
+
+    if _substrings(query) or _substrings(cond):
+        # Tests for substrings of a string aren't compared with others
+        return False
+
+    if _compares_none(query) or _compares_none(cond):
+        # None can't be ordered and only equals itself, leave tests of it
+        # unproven
+        return False
+
+    if query[0] == 'one_of':
+        return all(_implies_test(('==', path, item), cond)
+                   for item in query[2])
+    elif cond[0] == 'one_of':
+        return query[0] == '==' and query[2] in cond[2]
+    elif cond[0] == '!=':
+        return query[0] == '==' and not query[2] == cond[2]
+
+    inner, outer = _interval(query), _interval(cond)
+    if inner is None or outer is None:
+        return False
+
+    return _within(inner, outer)
+
+
+def implies(query, cond):
+    """
+    Check whether every document matching one query matches another.
+
+    The check is conservative: ``False`` means that the implication could
+    not be proven.
+
+    >>> implies(('<', ('age', ), 18), ('<=', ('age', ), 21))
+    True
+
+    :param query: the hash value of the query
+    :param cond: the hash value of the implied query
+    """
+
+    if query == cond:
+        return True
+
+    try:
+        if cond[0] == 'and':
+            return all(implies(query, operand) for operand in cond[1])
+        elif query[0] == 'or':
+            return all(implies(operand, cond) for operand in query[1])
+        elif query[0] == 'and' and any(implies(operand, cond)
+                                       for operand in query[1]):
+            return True
+        elif cond[0] == 'or':
+            return any(implies(query, operand) for operand in cond[1])
+        elif query[0] == 'not' and cond[0] == 'not':
+            return implies(cond[1], query[1])
+
+        return _implies_test(query, cond)
+    except TypeError:
+        # Values that can't be compared
+        return False
+
+
+_COMPOUND = ('and', 'or', 'not')
+
+
+def plan(hashval, indexes, universe):
+    """
+    Use indexes to find the documents that may match a query.
+
+    ``AND``, ``OR`` and ``NOT`` are evaluated as operations on the bitmaps
+    the indexes return. A result is exact if it holds exactly the matching
+    documents, so the query doesn't need to be run against them.
+
+    Partial indexes are only used if the query implies their filter. As
+    all matching documents are covered by the partial index then, the
+    result is restricted to the covered documents.
+
+    :param hashval: the hash value of the query
+    :param indexes: the ready indexes of a table
+    :param universe: a callable returning a bitmap of all document IDs
+    :returns: ``None`` if every document has to be tested, otherwise a
+              ``(doc_ids, exact)`` tuple
+    :rtype: (Bitmap, bool) | None
+    """
+
+    usable, coverage = [], {}
+    for index in indexes:
+        if index.where is None:
+            usable.append(index)
+        elif implies(hashval, index.where.hashval):
+            usable.append(index)
+            coverage[index.where.hashval] = index.covered
+
+    def all_ids():
+        # Every full index covers all documents
+        for index in indexes:
+            if index.where is None:
+                return index.covered
+        return universe()
+
+    found = _plan(hashval, usable, coverage, all_ids)
+
+    for covered in coverage.values():
+        if found is None:
+            found = covered.copy(), False
+        else:
+            found = found[0] & covered, found[1]
+
+    return found
+
+
+def _plan(hashval, indexes, coverage, universe):
+    if hashval in coverage:
+        # The filter of a partial index
+        return coverage[hashval].copy(), True
+
+    op = hashval[0]
+
+    if op == 'and':
+        # Any operand that can be narrowed down narrows down the result
+        candidates, exact = None, True
+        for operand in hashval[1]:
+            found = _plan(operand, indexes, coverage, universe)
+            if found is None:
+                exact = False
+            elif candidates is None:
+                candidates, exact = found[0], exact and found[1]
+            else:
+                candidates, exact = candidates & found[0], exact and found[1]
+
+        if candidates is None:
+            return None
+        return candidates, exact
+
+    elif op == 'or':
+        # All operands have to be narrowed down, otherwise a full scan is
+        # needed anyway
+        candidates, exact = Bitmap(), True
+        for operand in hashval[1]:
+            found = _plan(operand, indexes, coverage, universe)
+            if found is None:
+                return None
+            candidates, exact = candidates | found[0], exact and found[1]
+
+        return candidates, exact
+
+    elif op == 'not':
+        # Only an exact result can be complemented
+        found = _plan(hashval[1], indexes, coverage, universe)
+        if found is None or not found[1]:
+            return None
+
+        return universe() - found[0], True
+
+    elif len(hashval) < 2:
+        return None
+
+    found = None
+    for index in indexes:
+        if index.path == hashval[1]:
+            result = index.lookup(hashval)
+            if result is not None and (found is None or result[1]):
+                found = result
+            if found is not None and found[1]:
+                break
+
+    return found
+
+
+def query_shape(hashval):
+    """
+    Get the structure of a query with all constants stripped, so that
+    ``where('a') == 1`` and ``where('a') == 2`` have the same shape.
+    """
+
+    op = hashval[0]
+    if op in ('and', 'or'):
+        return op, frozenset(query_shape(operand) for operand in hashval[1])
+    elif op == 'not':
+        return op, query_shape(hashval[1])
+
+    # Custom queries may have hash values without a path
+    return op, hashval[1] if len(hashval) > 1 else ()
+
+
+def _shape_tests(shape):
+    op = shape[0]
+    if op in ('and', 'or'):
+        for operand in shape[1]:
+            for test in _shape_tests(operand):
+                yield test
+    elif op != 'not':
+        yield shape
+
+
+#: The tests each type of index can answer
+CAPABILITIES = {
+    'sorted': ('==', 'one_of', '<', '<=', '>', '>=', 'exists', 'path'),
+    'bitmap': ('==', '!=', 'one_of', '<', '<=', '>', '>=', 'exists', 'path'),
+    'text': ('search', 'matches'),
+}
+
+
+def _advised_kind(op, path, docs):
+    if op in CAPABILITIES['text']:
+        return 'text'
+    elif op in ('<', '<=', '>', '>='):
+        return 'sorted'
+    elif op not in ('==', '!=', 'one_of'):
+        return None
+
+    # Equality tests on fields with few distinct values are answered best
+    # by bitmaps
+    values = set()
+    for doc in docs.values():
+        try:
+            values.add(freeze(resolve_path(doc, path)))
+        except (KeyError, TypeError):
+            pass
+
+    if len(values) <= 32 or len(values) * 100 <= len(docs):
+        return 'bitmap'
+    elif op == '!=':
+        return None
+
+    return 'sorted'
+
+
+def advise(stats, indexes, docs, min_queries, max_selectivity):
+    """
+    Suggest indexes for frequently run, selective queries.
+
+    :param stats: a mapping of query shapes (see :func:`query_shape`) to
+                  ``[count, scanned, matched, elapsed]`` lists
+    :param indexes: the existing indexes
+    :param docs: the documents of the table
+    :param min_queries: how often a query shape has to have been run
+    :param max_selectivity: the largest share of the scanned documents a
+                            query shape may match
+    :returns: a list of dicts describing the suggested indexes, most
+              expensive queries first
+    """
+
+    advice = {}
+
+    for shape, (count, scanned, matched, elapsed) in iteritems(stats):
+        if count < min_queries or not scanned:
+            continue
+        elif float(matched) / scanned > max_selectivity:
+            continue
+
+        for op, path in _shape_tests(shape):
+            if any(index.path == path and index.where is None and
+                   op in CAPABILITIES.get(index.kind, ())
+                   for index in indexes):
+                continue
+
+            kind = _advised_kind(op, path, docs)
+            if kind is None:
+                continue
+
+            entry = advice.setdefault((kind, path), {
+                'field': path,
+                'kind': kind,
+                'queries': 0,
+                'scanned': 0,
+                'matched': 0,
+                'elapsed': 0.0,
+            })
+            entry['queries'] += count
+            entry['scanned'] += scanned
+            entry['matched'] += matched
+            entry['elapsed'] += elapsed
+
+    return sorted(advice.values(), key=lambda entry: -entry['elapsed'])
+
+
+#: The version of the layout of persisted indexes
+FORMAT_VERSION = 2
+
+#: The containers persisted indexes can hold, by the tags marking them
+_CONTAINERS = {
+    'list': list,
+    'tuple': tuple,
+    'set': set,
+    'frozenset': frozenset,
+    'bitmap': Bitmap,
+}
+
+
+def _encode(value):
+    """
+    Turn indexed values into JSON. Containers become lists starting with a
+    tag, so that their type and the type of dict keys survive.
+    """
+
+    if value is _UNHASHABLE:
+        return ['unhashable']
+    elif isinstance(value, dict):
+        tag = 'frozendict' if isinstance(value, FrozenDict) else 'dict'
+        return [tag, [[_encode(key), _encode(val)]
+                      for key, val in iteritems(value)]]
+    elif isinstance(value, Bitmap):
+        return ['bitmap', list(value)]
+
+    for tag, container in iteritems(_CONTAINERS):
+        if type(value) is container:
+            return [tag, [_encode(item) for item in value]]
+
+    return value
+
+
+def _decode(value):
+    """
+    Restore indexed values turned into JSON by :func:`_encode`.
+    """
+
+    if not isinstance(value, list):
+        return value
+
+    tag = value[0]
+    if tag == 'unhashable':
+        return _UNHASHABLE
+    elif tag in ('dict', 'frozendict'):
+        items = ((_decode(key), _decode(val)) for key, val in value[1])
+        return FrozenDict(items) if tag == 'frozendict' else dict(items)
+    elif tag == 'bitmap':
+        return Bitmap(value[1])
+
+    return _CONTAINERS[tag](_decode(item) for item in value[1])
+
+
+def dump_indexes(indexes, generation):
+    """
+    Serialize the ready indexes of a table.
+
+    :param indexes: the indexes of the table
+    :param generation: the generation of the stored data the indexes have
+                       been built from (see
+                       :attr:`~puchkidb.storages.Storage.generation`)
+    :rtype: bytes
+    """
+
+    return json.dumps({
+        'version': FORMAT_VERSION,
+        'generation': generation,
+        'indexes': [[_encode(index.signature()), _encode(index.dump())]
+                    for index in indexes if index.ready],
+    }).encode('utf-8')
+
+
+def load_indexes(payload, indexes, generation):
+    """
+    Restore indexes from a payload written by :func:`dump_indexes`.
+
+    The payload is ignored if it is damaged or has been built from another
+    generation of the stored data.
+
+    :returns: whether the payload could be used
+    """
+
+    try:
+        state = json.loads(payload.decode('utf-8'))
+        if state['version'] != FORMAT_VERSION or \
+                state['generation'] != generation:
+            return False
+
+        dumped = dict((_decode(signature), _decode(values))
+                      for signature, values in state['indexes'])
+    except Exception:
+        return False
+
+    for index in indexes:
+        values = dumped.get(index.signature())
+        if values is not None and not index.ready:
+            index.restore(values)
+
+    return True
+
+
+#: The index types :meth:`~puchkidb.database.Table.create_index` knows about
+INDEX_TYPES = {
+    SortedIndex.kind: SortedIndex,
+    TextIndex.kind: TextIndex,
+    BitmapIndex.kind: BitmapIndex,
+}
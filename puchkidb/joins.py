@@ -0,0 +1,134 @@
+"""
+Contains the algorithms :meth:`~puchkidb.database.PuchkiDB.join` relates
+the documents of two tables with.
+
+Both work on ``(doc_id, document)`` rows and return ``(left_id, right_id)``
+pairs in the order of the left rows, pairs with the same left row in the
+order of the right rows. Documents join if the values at their join paths
+are equal, documents without the path join none:
+
+>>> hash_join([(1, {'user': 7}), (2, {})], [(7, {'id': 7})],
+...           ('user', ), ('id', ), 'left')
+[(1, 7), (2, None)]
+"""
+
+from .indexes import resolve_path
+from .utils import freeze
+
+__all__ = ('hash_join', 'index_join')
+
+#: The kinds of joins: ``'inner'`` only keeps left documents joining a right
+#: one, ``'left'`` pairs the others with ``None``
+HOWS = ('inner', 'left')
+
+#: Marks a document without the join path or with a value that can't be
+#: hashed
+_MISSING = object()
+
+
+def join_key(doc, path):
+    """
+    Get the value a document is joined by, :data:`_MISSING` if it has none.
+    """
+    try:
+        key = freeze(resolve_path(doc, path))
+        hash(key)
+    except (KeyError, TypeError):
+        return _MISSING
+
+    return key
+
+
+def _table(rows, path):
+    """
+    Get the IDs of the rows by their join keys.
+    """
+    table = {}
+    for doc_id, doc in rows:
+        key = join_key(doc, path)
+        if key is not _MISSING:
+            table.setdefault(key, []).append(doc_id)
+
+    return table
+
+
+def hash_join(left, right, left_path, right_path, how='inner'):
+    """
+    Join two lists of rows by building a hash table on the smaller one and
+    streaming the larger one through it.
+
+    :param left: the ``(doc_id, document)`` rows of the left table
+    :param right: the rows of the right table
+    :param left_path: the path of the left documents' join values
+    :param right_path: the path of the right documents' join values
+    :param how: ``'inner'`` or ``'left'``
+    :rtype: list[(int, int | None)]
+    """
+
+    if len(right) <= len(left):
+        table = _table(right, right_path)
+        result = []
+        for doc_id, doc in left:
+            key = join_key(doc, left_path)
+            found = table.get(key) if key is not _MISSING else None
+
+            if found:
+                result.extend((doc_id, other) for other in found)
+            elif how == 'left':
+                result.append((doc_id, None))
+
+        return result
+
+    # Built on the left rows, the pairs are collected per left row to
+    # return them in the order of the left rows
+    table = _table(left, left_path)
+    pairs = {}
+    for doc_id, doc in right:
+        key = join_key(doc, right_path)
+        if key is _MISSING:
+            continue
+
+        for other in table.get(key, ()):
+            pairs.setdefault(other, []).append(doc_id)
+
+    result = []
+    for doc_id, _ in left:
+        found = pairs.get(doc_id)
+        if found:
+            result.extend((doc_id, other) for other in found)
+        elif how == 'left':
+            result.append((doc_id, None))
+
+    return result
+
+
+def index_join(outer, probe, outer_path, inner_path, how='inner'):
+    """
+    Join rows with the documents of another table by looking up each row's
+    join value in an index of that table.
+
+    :param outer: the ``(doc_id, document)`` rows to join
+    :param probe: a function taking a join value and returning the IDs and
+                  documents of the candidates of the other table in order,
+                  the join values of which are checked again
+    :param outer_path: the path of the rows' join values
+    :param inner_path: the path of the other table's join values
+    :param how: ``'inner'`` or ``'left'``
+    :rtype: list[(int, int | None)]
+    """
+
+    result = []
+    for doc_id, doc in outer:
+        key = join_key(doc, outer_path)
+
+        found = False
+        if key is not _MISSING:
+            for other_id, other in probe(key):
+                if join_key(other, inner_path) == key:
+                    result.append((doc_id, other_id))
+                    found = True
+
+        if not found and how == 'left':
+            result.append((doc_id, None))
+
+    return result
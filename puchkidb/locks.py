@@ -0,0 +1,159 @@
+"""
+Contains the locks that make a database safe to use from several threads.
+
+Every :class:`~puchkidb.database.Table` has a :class:`RWLock`: any number of
+threads can search a table at the same time while writes to it are
+exclusive. Writes to different tables don't block each other. All tables of
+a database share a :class:`StorageLock` that serializes the short moments
+they actually read or write the storage, as storages like
+:class:`~puchkidb.storages.JSONStorage` keep all tables in one file.
+
+>>> lock = RWLock()
+>>> with lock.reading():
+...     with lock.reading():
+...         pass
+"""
+
+from contextlib import contextmanager
+import threading
+
+try:
+    from threading import get_ident
+except ImportError:  # pragma: no cover
+    # Python 2
+    from thread import get_ident
+
+__all__ = ('RWLock', 'StorageLock')
+
+
+class RWLock(object):
+    """
+    A lock that can be held by many readers or one writer.
+
+    Writers waiting for the lock keep new readers out, so that a steady
+    stream of readers doesn't starve them. Both kinds of access are
+    reentrant and a thread holding the lock for writing can also acquire it
+    for reading. A thread holding it for reading only can't upgrade to
+    writing, as two threads doing so would wait for each other forever.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+
+    def acquire_read(self):
+        me = get_ident()
+
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = get_ident()
+
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+                return
+
+            del self._readers[me]
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+                return
+            elif me in self._readers:
+                raise RuntimeError('Cannot write while holding a read lock')
+
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
+
+    def owned(self):
+        """
+        Whether the current thread holds the lock, for reading or writing.
+        """
+        me = get_ident()
+
+        with self._cond:
+            return self._writer == me or me in self._readers
+
+    @contextmanager
+    def reading(self):
+        """
+        Hold the lock for reading within a ``with`` block.
+        """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        """
+        Hold the lock for writing within a ``with`` block.
+        """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class StorageLock(object):
+    """
+    A reentrant lock serializing the access to a storage that also counts
+    the writes to it, so that data read before another write can be told
+    apart from current data.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+        #: The number of writes so far
+        self.generation = 0
+
+        #: The number of open snapshots of the storage
+        self.snapshots = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+    def written(self):
+        """
+        Count a write, to be called while holding the lock.
+        """
+        self.generation += 1
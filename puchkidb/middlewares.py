@@ -103,6 +103,13 @@ class CachingMiddleware(Middleware):
         if self._cache_modified_count >= self.WRITE_CACHE_SIZE:
             self.flush()
 
+    @property
+    def generation(self):
+        # Indexes built from unflushed writes don't describe the stored data
+        if self._cache_modified_count > 0:
+            return None
+        return getattr(self.storage, 'generation', None)
+
     def flush(self):
         """
         Flush all unwritten data to disk.
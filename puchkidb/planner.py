@@ -0,0 +1,553 @@
+"""
+Contains the planner that decides in which order the tests of a query run.
+
+``and`` and ``or`` stop at the first test that decides their result, so the
+order of their tests matters: an ``and`` should start with the tests that
+are cheap and likely to fail, an ``or`` with the tests that are cheap and
+likely to succeed. The planner estimates what a test costs from its
+operator (equality is cheap, regexes and callables are not) and how many
+documents it matches from :class:`Statistics` about the tests that have
+been run, then reorders the tests of every ``and`` and ``or``:
+
+>>> query = where('name').matches('^J') & (where('age') == 42)
+>>> reorder(query_node(query))
+QueryNode('and', children=(QueryNode('==', ('age',), 42), \
+QueryNode('matches', ('name',), ('^J', 0))))
+
+Only tests that can't raise an exception (see :data:`SAFE`) are moved
+ahead of the tests written before them, so that tests guarding others,
+like ``(where('type') == 'num') & (where('val') > 5)``, keep guarding them.
+Reordering doesn't change which documents match.
+"""
+
+from itertools import islice
+
+from .queries import QueryNode
+from .utils import freeze, string_types
+
+__all__ = ('Statistics', 'cost', 'normalize', 'reorder', 'selectivity')
+
+#: The estimated cost of running a test relative to comparing two values
+COSTS = {
+    'path': 1.0,
+    'exists': 1.0,
+    '==': 1.0,
+    '!=': 1.0,
+    '<': 1.5,
+    '<=': 1.5,
+    '>': 1.5,
+    '>=': 1.5,
+    'one_of': 2.0,
+    'between': 2.0,
+    'any': 8.0,
+    'all': 8.0,
+    'matches': 20.0,
+    'search': 25.0,
+    'test': 50.0,
+    'call': 50.0,
+}
+
+#: The tests that never raise an exception, only they may run before the
+#: tests written in front of them
+SAFE = frozenset(['path', 'exists', '==', '!=', 'one_of'])
+
+#: The cost of looking up a part of a path
+PATH_COST = 0.25
+
+#: The share of documents a test is assumed to match until it has been
+#: observed
+SELECTIVITIES = {
+    'path': 0.9,
+    'exists': 0.9,
+    '==': 0.1,
+    '!=': 0.9,
+    '<': 1 / 3.0,
+    '<=': 1 / 3.0,
+    '>': 1 / 3.0,
+    '>=': 1 / 3.0,
+    'one_of': 0.2,
+    'between': 0.2,
+    'any': 0.5,
+    'all': 0.5,
+    'matches': 0.25,
+    'search': 0.25,
+    'test': 0.5,
+    'call': 0.5,
+}
+
+
+def shape(node):
+    """
+    Get the shape of a test, i.e. its operator and path without the value
+    it compares with.
+    """
+    return node.op, node.path
+
+
+def leaves(node):
+    """
+    Iterate over the tests of a query, i.e. the nodes that aren't ``and``,
+    ``or`` or ``not``.
+    """
+    for found in node.walk():
+        if found.op not in ('and', 'or', 'not'):
+            yield found
+
+
+def leaf_key(node):
+    """
+    Get a hashable description of a test including the value it compares
+    with.
+
+    :raises TypeError: if the value can't be hashed
+    """
+    key = node.op, node.path, freeze(node.operand)
+    hash(key)
+    return key
+
+
+class Statistics(object):
+    """
+    The observed selectivity of tests by their shape.
+
+    A table samples some of its documents to estimate how many of them a
+    test matches (see :meth:`sample`) until :attr:`SAMPLE_LIMIT` documents
+    or all of them have been tested for its shape. Until
+    :attr:`MIN_SAMPLES` documents have been tested, the default from
+    :data:`SELECTIVITIES` is used.
+
+    Statistics aren't thread-safe, tables update them holding their state
+    lock.
+    """
+
+    #: The number of tested documents observed selectivities are used from
+    MIN_SAMPLES = 50
+
+    #: The number of tested documents after which a shape isn't sampled
+    #: anymore
+    SAMPLE_LIMIT = 1000
+
+    #: The number of documents tested per sample
+    SAMPLE_SIZE = 50
+
+    def __init__(self):
+        self._counts = {}
+        # The shapes all documents have been sampled for
+        self._complete = set()
+
+    def observe(self, node, tested, matched):
+        """
+        Record how many documents a test has matched.
+
+        :param node: the test
+        :param tested: the number of documents it has been run against
+        :param matched: the number of documents it has matched
+        """
+        counts = self._counts.get(shape(node))
+        if counts is None:
+            counts = self._counts[shape(node)] = [0, 0]
+
+        counts[0] += tested
+        counts[1] += matched
+
+    def selectivity(self, node):
+        """
+        Get the share of documents a test is expected to match.
+        """
+        counts = self._counts.get(shape(node))
+        if counts is None or counts[0] < self.MIN_SAMPLES:
+            return SELECTIVITIES.get(node.op, 0.5)
+
+        return counts[1] / float(counts[0])
+
+    def wants(self, node):
+        """
+        Check whether any test of a query should be sampled.
+        """
+        return any(self._wants(leaf) for leaf in leaves(node))
+
+    def _wants(self, node):
+        if node.op == 'call':
+            return False
+
+        if shape(node) in self._complete:
+            return False
+
+        counts = self._counts.get(shape(node))
+        return counts is None or counts[0] < self.SAMPLE_LIMIT
+
+    def sample(self, node, docs):
+        """
+        Run the tests of a query that still need samples against some
+        documents on their own and record how many they match.
+
+        Each sample of a test's shape tests the documents following the ones
+        tested before, so the documents have to come in the same order every
+        time.
+
+        :param node: the query's expression tree
+        :param docs: the documents to sample from
+        """
+        from .compiler import compile_node
+
+        wanted = []
+        for leaf in leaves(node):
+            if self._wants(leaf):
+                counts = self._counts.get(shape(leaf))
+                wanted.append((leaf, counts[0] if counts else 0))
+
+        if not wanted:
+            return
+
+        stop = max(start for _, start in wanted) + self.SAMPLE_SIZE
+        docs = list(islice(docs, stop))
+
+        for leaf, start in wanted:
+            sampled = docs[start:start + self.SAMPLE_SIZE]
+            if not sampled:
+                if start:
+                    # All documents have been tested
+                    self._complete.add(shape(leaf))
+                continue
+
+            test = compile_node(leaf)
+            if test is None:
+                continue
+
+            matched = 0
+            for doc in sampled:
+                try:
+                    matched += bool(test(doc))
+                except Exception:
+                    pass
+
+            self.observe(leaf, len(sampled), matched)
+
+    def clear(self):
+        self._counts.clear()
+        self._complete.clear()
+
+
+def selectivity(node, stats=None):
+    """
+    Estimate the share of documents a query matches, assuming its tests are
+    independent.
+    """
+    op = node.op
+
+    if op == 'and':
+        result = 1.0
+        for child in node.children:
+            result *= selectivity(child, stats)
+        return result
+
+    elif op == 'or':
+        result = 1.0
+        for child in node.children:
+            result *= 1.0 - selectivity(child, stats)
+        return 1.0 - result
+
+    elif op == 'not':
+        return 1.0 - selectivity(node.children[0], stats)
+
+    elif stats is not None:
+        return stats.selectivity(node)
+
+    return SELECTIVITIES.get(op, 0.5)
+
+
+def cost(node, stats=None):
+    """
+    Estimate the cost of running a query against a document, taking into
+    account that ``and`` and ``or`` skip the tests following the one that
+    decides their result.
+    """
+    op = node.op
+
+    if op in ('and', 'or'):
+        result, reached = 0.0, 1.0
+        for child in node.children:
+            result += reached * cost(child, stats)
+            passing = selectivity(child, stats)
+            reached *= passing if op == 'and' else 1.0 - passing
+        return result
+
+    elif op == 'not':
+        return cost(node.children[0], stats)
+
+    return COSTS.get(op, COSTS['call']) + PATH_COST * len(node.path)
+
+
+def _chain(node):
+    """
+    Get the operands of nested ``and`` or ``or`` nodes of the same kind as
+    one list, so that ``(a & b) & c`` is ordered as a whole.
+    """
+    operands = []
+    for child in node.children:
+        if child.op == node.op:
+            operands.extend(_chain(child))
+        else:
+            operands.append(child)
+
+    return operands
+
+
+def _rank(node, op, stats):
+    """
+    Get the rank of the operand of an ``and`` or ``or``, the operands with
+    the lowest ranks should run first.
+    """
+    passing = selectivity(node, stats)
+    deciding = 1.0 - passing if op == 'and' else passing
+
+    if deciding <= 0:
+        return float('inf')
+    return cost(node, stats) / deciding
+
+
+def _safe(node):
+    # Looking for a value in a string fails unless it's a string
+    return all(leaf.op in SAFE and not (leaf.op == 'one_of' and
+                                        isinstance(leaf.operand, string_types))
+               for leaf in leaves(node))
+
+
+def _order(operands, op, stats):
+    """
+    Order the operands of an ``and`` or ``or`` by their ranks, keeping the
+    operands that may raise an exception behind the ones written in front
+    of them.
+    """
+    ranks = [_rank(operand, op, stats) for operand in operands]
+    safe = [_safe(operand) for operand in operands]
+
+    ordered = []
+    remaining = list(range(len(operands)))
+    while remaining:
+        # Operands that may raise wait for all operands before them
+        available = [i for i in remaining
+                     if safe[i] or i == remaining[0]]
+        best = min(available, key=lambda i: (ranks[i], i))
+
+        ordered.append(operands[best])
+        remaining.remove(best)
+
+    return ordered
+
+
+def reorder(node, stats=None):
+    """
+    Get the expression tree of a query with the operands of all ``and`` and
+    ``or`` nodes ordered so that the query runs as fast as possible.
+
+    Operands with the same rank keep the order they have been written in.
+    Operands that may raise an exception (those with tests not in
+    :data:`SAFE`) never run before the operands written in front of them.
+
+    :param node: the expression tree (see :func:`~puchkidb.queries.query_node`)
+    :param stats: the observed selectivities, uses defaults if ``None``
+    :type stats: Statistics
+    :rtype: QueryNode
+    """
+    op = node.op
+
+    if op in ('and', 'or'):
+        operands = [reorder(child, stats) for child in _chain(node)]
+        return QueryNode(op, children=tuple(_order(operands, op, stats)))
+
+    elif op == 'not':
+        return QueryNode(op, children=(reorder(node.children[0], stats), ))
+
+    return node
+
+
+def node_key(node):
+    """
+    Get a hashable description of an expression tree. Trees that only differ
+    in the order of the operands of ``and`` and ``or`` get the same key.
+
+    :raises TypeError: if a value the tree compares with can't be hashed
+    """
+    if node.op in ('and', 'or'):
+        return node.op, frozenset(node_key(child) for child in node.children)
+    elif node.op == 'not':
+        return node.op, node_key(node.children[0])
+
+    return leaf_key(node)
+
+
+#: The types of values range tests on the same path are merged for, these
+#: are totally ordered
+_ORDERED = (int, float) + string_types
+
+_LOWER = ('>', '>=')
+_UPPER = ('<', '<=')
+
+
+def _tighter(bound, other, lower):
+    """
+    Get the tighter of two ``(value, inclusive)`` bounds.
+    """
+    if bound is None:
+        return other
+    elif bound[0] == other[0]:
+        return bound[0], bound[1] and other[1]
+    elif (bound[0] > other[0]) == lower:
+        return bound
+
+    return other
+
+
+def _range_bounds(node):
+    """
+    Get the lower and upper ``(value, inclusive)`` bounds of a range test,
+    ``None`` for tests that aren't ranges.
+    """
+    if node.op == 'between':
+        return node.operand[:2], node.operand[2:]
+
+    if node.op not in _LOWER + _UPPER or \
+            type(node.operand) not in _ORDERED:
+        return None
+
+    bound = node.operand, node.op.endswith('=')
+    if node.op in _LOWER:
+        return bound, None
+    return None, bound
+
+
+def _range_node(path, lower, upper):
+    if upper is None:
+        return QueryNode('>=' if lower[1] else '>', path, lower[0])
+    elif lower is None:
+        return QueryNode('<=' if upper[1] else '<', path, upper[0])
+
+    return QueryNode('between', path, lower + upper)
+
+
+def _merge_ranges(operands):
+    """
+    Merge the range tests of an ``and`` on the same path into one test per
+    path, taking the tightest bounds.
+    """
+    merged = {}
+    for child in operands:
+        bounds = _range_bounds(child)
+        if bounds is not None:
+            merged.setdefault(child.path, []).append(bounds)
+
+    result = []
+    for child in operands:
+        bounds = merged.get(child.path) if _range_bounds(child) else None
+        if bounds is not None and not bounds:
+            # Merged into the range test replacing the first one
+            continue
+        elif bounds is None or len(bounds) < 2:
+            result.append(child)
+            continue
+
+        families = set(isinstance(bound[0], string_types)
+                       for pair in bounds for bound in pair
+                       if bound is not None)
+        if len(families) > 1:
+            # Strings and numbers can't be compared, the tests have to fail
+            # or raise in the order they were written
+            merged[child.path] = None
+            result.append(child)
+            continue
+
+        lower = upper = None
+        for low, high in bounds:
+            if low is not None:
+                lower = _tighter(lower, low, True)
+            if high is not None:
+                upper = _tighter(upper, high, False)
+
+        result.append(_range_node(child.path, lower, upper))
+        del bounds[:]
+
+    return result
+
+
+def normalize(node):
+    """
+    Get a simpler expression tree testing the same as the given one.
+
+    - nested ``and`` and ``or`` nodes of the same kind are flattened and
+      tests they contain more than once are removed,
+    - range tests on the same path in an ``and`` are merged into one
+      ``'between'`` test (``a > 1 & a < 5`` becomes ``1 < a < 5``),
+    - ``not`` is pushed down through ``and`` and ``or`` by De Morgan's laws
+      and double negations are removed,
+    - the items of ``one_of`` become a frozenset if they can be hashed,
+      unless they are a string to look for substrings in.
+
+    Negated comparisons stay as they are as ``~(a < 5)`` matches documents
+    without ``a`` while ``a >= 5`` doesn't.
+
+    :rtype: QueryNode
+    """
+    op = node.op
+
+    if op in ('and', 'or'):
+        operands = []
+        for child in _chain(node):
+            child = normalize(child)
+            if child.op == op:
+                operands.extend(child.children)
+            else:
+                operands.append(child)
+
+        try:
+            seen = set()
+            unique = []
+            for child in operands:
+                key = node_key(child)
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(child)
+            operands = unique
+        except TypeError:
+            # Values that can't be hashed, keep all operands
+            pass
+
+        if op == 'and':
+            operands = _merge_ranges(operands)
+
+        if len(operands) == 1:
+            return operands[0]
+        return QueryNode(op, children=tuple(operands))
+
+    elif op == 'not':
+        child = node.children[0]
+        if child.op == 'not':
+            return normalize(child.children[0])
+        elif child.op in ('and', 'or'):
+            return normalize(QueryNode(
+                'or' if child.op == 'and' else 'and',
+                children=tuple(QueryNode('not', children=(operand, ))
+                               for operand in child.children)))
+
+        return QueryNode(op, children=(normalize(child), ))
+
+    elif op == 'one_of' and not isinstance(node.operand, frozenset) and \
+            not isinstance(node.operand, string_types):
+        try:
+            return QueryNode(op, node.path, frozenset(node.operand))
+        except TypeError:
+            return node
+
+    return node
+
+
+def order_key(query, node):
+    """
+    Get a key describing a query and the order its tests run in.
+
+    :param query: the query
+    :param node: its normalized and reordered expression tree
+    :raises TypeError: if the query compares with values that can't be
+                       hashed
+    """
+    return query.hashval, tuple(leaf_key(leaf) for leaf in leaves(node))
@@ -19,28 +19,130 @@ False
 import re
 import sys
 
-from .utils import catch_warning, freeze
+from .utils import catch_warning, freeze, regex_prefilter, string_types
 
-__all__ = ('Query', 'where')
+__all__ = ('Query', 'QueryNode', 'where')
 
 
 def is_sequence(obj):
     return hasattr(obj, '__iter__')
 
 
+class QueryNode(object):
+    """
+    A node of the expression tree of a query.
+
+    The tree describes what a query tests, so queries can be inspected
+    (e.g. to use indexes) instead of only being run. Every node has an
+    operator and, depending on it:
+
+    - ``'and'``, ``'or'``, ``'not'``: the ``children`` nodes
+    - ``'path'``, ``'exists'``: the ``path`` that has to exist
+    - ``'=='``, ``'!='``, ``'<'``, ``'<='``, ``'>'``, ``'>='``: the ``path``
+      and the value to compare with as ``operand``
+    - ``'matches'``, ``'search'``: the ``path`` and a ``(regex, flags)``
+      ``operand``
+    - ``'test'``: the ``path`` and a ``(func, args)`` ``operand``
+    - ``'any'``, ``'all'``: the ``path`` and the query or list to check
+      the elements against as ``operand``
+    - ``'one_of'``: the ``path`` and the items as ``operand``
+    - ``'between'``: the ``path`` and a ``(low, low_inclusive, high,
+      high_inclusive)`` ``operand``, only found in normalized trees (see
+      :func:`~puchkidb.planner.normalize`)
+    - ``'call'``: an opaque callable as ``operand``
+    """
+
+    __slots__ = ('op', 'path', 'operand', 'children')
+
+    def __init__(self, op, path=(), operand=None, children=()):
+        self.op = op
+        self.path = path
+        self.operand = operand
+        self.children = children
+
+    def __repr__(self):
+        if self.children:
+            return 'QueryNode({!r}, children={!r})'.format(self.op,
+                                                            self.children)
+
+        return 'QueryNode({!r}, {!r}, {!r})'.format(self.op, self.path,
+                                                    self.operand)
+
+    def walk(self):
+        """
+        Iterate over this node and all nodes below it, depth-first.
+        """
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
+
+
+def query_node(query):
+    """
+    Get the expression tree of a query, wrapping queries that don't have
+    one into a ``'call'`` node.
+    """
+    node = getattr(query, '_node', None)
+    if node is None:
+        return QueryNode('call', operand=query)
+
+    return node
+
+
+def regex_test(regex, flags, method):
+    """
+    Get a function running a regular expression against a value.
+
+    The expression is compiled once. Strings lacking the literal text every
+    match has to contain are rejected without running it.
+
+    :param method: ``'match'`` or ``'search'``
+    """
+    try:
+        run = getattr(re.compile(regex, flags), method)
+    except Exception:
+        # Invalid expressions fail when the query is run
+        func = getattr(re, method)
+        return lambda value: func(regex, value, flags)
+
+    prefix, literal = regex_prefilter(regex, flags, method == 'match')
+
+    if prefix:
+        def test(value):
+            if isinstance(value, string_types) and \
+                    not value.startswith(prefix):
+                return None
+            return run(value)
+
+    elif literal:
+        def test(value):
+            if isinstance(value, string_types) and literal not in value:
+                return None
+            return run(value)
+
+    else:
+        test = run
+
+    return test
+
+
 class QueryImpl(object):
     """
     A query implementation.
 
     This query implementation wraps a test function which is run when the
-    query is evaluated by calling the object.
+    query is evaluated by calling the object. The structure of the query is
+    described by its expression tree (a :class:`QueryNode`, see
+    :func:`query_node`).
 
     Queries can be combined with logical and/or and modified with logical not.
     """
 
-    def __init__(self, test, hashval):
+    def __init__(self, test, hashval, node=None):
         self._test = test
         self.hashval = hashval
+        self._node = node
 
     def __call__(self, value):
         return self._test(value)
@@ -60,17 +162,22 @@ class QueryImpl(object):
         # We use a frozenset for the hash as the AND operation is commutative
         # (a & b == b & a)
         return QueryImpl(lambda value: self(value) and other(value),
-                         ('and', frozenset([self.hashval, other.hashval])))
+                         ('and', frozenset([self.hashval, other.hashval])),
+                         QueryNode('and', children=(query_node(self),
+                                                    query_node(other))))
 
     def __or__(self, other):
         # We use a frozenset for the hash as the OR operation is commutative
         # (a | b == b | a)
         return QueryImpl(lambda value: self(value) or other(value),
-                         ('or', frozenset([self.hashval, other.hashval])))
+                         ('or', frozenset([self.hashval, other.hashval])),
+                         QueryNode('or', children=(query_node(self),
+                                                   query_node(other))))
 
     def __invert__(self):
         return QueryImpl(lambda value: not self(value),
-                         ('not', self.hashval))
+                         ('not', self.hashval),
+                         QueryNode('not', children=(query_node(self), )))
 
 
 class Query(QueryImpl):
@@ -110,7 +217,8 @@ class Query(QueryImpl):
         self._path = ()
         super(Query, self).__init__(
             self._prepare_test(lambda _: True),
-            ('path', self._path)
+            ('path', self._path),
+            QueryNode('path', self._path)
         )
 
     def __repr__(self):
@@ -123,6 +231,7 @@ class Query(QueryImpl):
         query = Query()
         query._path = self._path + (item, )
         query.hashval = ('path', query._path)
+        query._node = QueryNode('path', query._path)
 
         return query
 
@@ -141,18 +250,20 @@ class Query(QueryImpl):
 
         return runner
 
-    def _generate_test(self, test, hashval):
+    def _generate_test(self, test, hashval, operand=None):
         """
         Generate a query based on a test function.
 
         :param test: The test the query executes.
         :param hashval: The hash of the query.
+        :param operand: The operand of the query's expression tree node.
         :return: A :class:`~puchkidb.queries.QueryImpl` object
         """
         if not self._path:
             raise ValueError('Query has no path')
 
-        return QueryImpl(self._prepare_test(test), hashval)
+        return QueryImpl(self._prepare_test(test), hashval,
+                         QueryNode(hashval[0], self._path, operand))
 
     def __eq__(self, rhs):
         """
@@ -182,7 +293,8 @@ class Query(QueryImpl):
 
         return self._generate_test(
             lambda value: test(value),
-            ('==', self._path, freeze(rhs))
+            ('==', self._path, freeze(rhs)),
+            rhs
         )
 
     def __ne__(self, rhs):
@@ -195,7 +307,8 @@ class Query(QueryImpl):
         """
         return self._generate_test(
             lambda value: value != rhs,
-            ('!=', self._path, freeze(rhs))
+            ('!=', self._path, freeze(rhs)),
+            rhs
         )
 
     def __lt__(self, rhs):
@@ -208,7 +321,8 @@ class Query(QueryImpl):
         """
         return self._generate_test(
             lambda value: value < rhs,
-            ('<', self._path, rhs)
+            ('<', self._path, rhs),
+            rhs
         )
 
     def __le__(self, rhs):
@@ -221,7 +335,8 @@ class Query(QueryImpl):
         """
         return self._generate_test(
             lambda value: value <= rhs,
-            ('<=', self._path, rhs)
+            ('<=', self._path, rhs),
+            rhs
         )
 
     def __gt__(self, rhs):
@@ -234,7 +349,8 @@ class Query(QueryImpl):
         """
         return self._generate_test(
             lambda value: value > rhs,
-            ('>', self._path, rhs)
+            ('>', self._path, rhs),
+            rhs
         )
 
     def __ge__(self, rhs):
@@ -247,7 +363,8 @@ class Query(QueryImpl):
         """
         return self._generate_test(
             lambda value: value >= rhs,
-            ('>=', self._path, rhs)
+            ('>=', self._path, rhs),
+            rhs
         )
 
     def exists(self):
@@ -270,8 +387,9 @@ class Query(QueryImpl):
         :param regex: The regular expression to use for matching
         """
         return self._generate_test(
-            lambda value: re.match(regex, value, flags),
-            ('matches', self._path, regex)
+            regex_test(regex, flags, 'match'),
+            ('matches', self._path, regex, flags),
+            (regex, flags)
         )
 
     def search(self, regex, flags=0):
@@ -284,8 +402,9 @@ class Query(QueryImpl):
         :param regex: The regular expression to use for matching
         """
         return self._generate_test(
-            lambda value: re.search(regex, value, flags),
-            ('search', self._path, regex)
+            regex_test(regex, flags, 'search'),
+            ('search', self._path, regex, flags),
+            (regex, flags)
         )
 
     def test(self, func, *args):
@@ -303,7 +422,8 @@ class Query(QueryImpl):
         """
         return self._generate_test(
             lambda value: func(value, *args),
-            ('test', self._path, func, args)
+            ('test', self._path, func, args),
+            (func, args)
         )
 
     def any(self, cond):
@@ -338,7 +458,8 @@ class Query(QueryImpl):
 
         return self._generate_test(
             lambda value: _cmp(value),
-            ('any', self._path, freeze(cond))
+            ('any', self._path, freeze(cond)),
+            cond
         )
 
     def all(self, cond):
@@ -371,20 +492,44 @@ class Query(QueryImpl):
 
         return self._generate_test(
             lambda value: _cmp(value),
-            ('all', self._path, freeze(cond))
+            ('all', self._path, freeze(cond)),
+            cond
         )
 
     def one_of(self, items):
         """
-        Check if the value is contained in a list or generator.
+        Check if the value is contained in a list or generator, or is a
+        substring of a string.
 
         >>> Query().f1.one_of(['value 1', 'value 2'])
 
         :param items: The list of items to check with
         """
+        if isinstance(items, string_types):
+            # Looked for as a substring, unlike in a set of its characters
+            members = items
+        else:
+            if iter(items) is items:
+                # Generators can only be consumed once
+                items = list(items)
+
+            try:
+                members = frozenset(items)
+            except TypeError:
+                # Items that can't be hashed
+                members = items
+
+        def test(value):
+            try:
+                return value in members
+            except TypeError:
+                # A value that can't be hashed
+                return value in items
+
         return self._generate_test(
-            lambda value: value in items,
-            ('one_of', self._path, freeze(items))
+            test,
+            ('one_of', self._path, freeze(items)),
+            items
         )
 
 
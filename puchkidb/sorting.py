@@ -0,0 +1,210 @@
+"""
+Contains the helpers to sort search results by the values of their fields.
+
+Values are ordered the way a :class:`~puchkidb.indexes.SortedIndex` keeps
+them, so that results can be streamed from an index instead of being
+sorted: numbers come before strings, followed by values that can't be
+ordered (``None``, lists, dicts) and finally documents without the field.
+Sorting in descending order reverses the order of numbers and strings,
+values that can't be ordered and missing fields stay last. Documents with
+equal values are ordered by their IDs.
+
+>>> key = sort_key(sort_spec([('age', 'desc'), 'name']))
+>>> sorted([key(1, {'age': 30, 'name': 'b'}), key(2, {'name': 'a'}),
+...         key(3, {'age': 30, 'name': 'a'})])[0][-1]
+3
+"""
+
+from functools import total_ordering
+import heapq
+from itertools import islice
+import pickle
+import tempfile
+
+from .indexes import _family, field_path, resolve_path
+from .utils import string_types
+
+__all__ = ('sort_spec', 'sort_key', 'top_k', 'external_sort')
+
+#: The directions a field can be sorted in
+DIRECTIONS = ('asc', 'desc')
+
+#: The number of sort keys :func:`external_sort` sorts in memory, larger
+#: results are sorted in runs of this size stored in temporary files
+SORT_BUFFER = 100000
+
+#: The number of sort keys pickled at once when spilling a run
+_BATCH = 1000
+
+
+@total_ordering
+class _Descending(object):
+    """
+    Wraps a value so that it sorts in reverse.
+    """
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return (self.value, )
+
+    def __setstate__(self, state):
+        self.value, = state
+
+
+def sort_spec(order_by):
+    """
+    Get the ``(path, descending)`` pairs to sort by from an ``order_by``
+    argument.
+
+    :param order_by: a field (a key or a query like
+                     ``Query().address.city``), a ``(field, direction)``
+                     pair with a direction of ``'asc'`` or ``'desc'`` or a
+                     list of these
+    :rtype: list[(tuple, bool)]
+    """
+
+    if _is_field(order_by) or _is_pair(order_by):
+        order_by = [order_by]
+
+    spec = []
+    for item in order_by:
+        if isinstance(item, tuple) and len(item) == 2 and \
+                isinstance(item[1], string_types) and not _is_field(item):
+            field, direction = item
+        else:
+            field, direction = item, 'asc'
+
+        if direction not in DIRECTIONS:
+            raise ValueError('Unknown sort direction: {!r}'.format(direction))
+
+        spec.append((field_path(field), direction == 'desc'))
+
+    if not spec:
+        raise ValueError('No fields to sort by')
+
+    return spec
+
+
+def _is_field(item):
+    return isinstance(item, string_types) or hasattr(item, '_path')
+
+
+def _is_pair(item):
+    return isinstance(item, tuple) and len(item) == 2 and \
+        item[1] in DIRECTIONS
+
+
+def sort_key(spec):
+    """
+    Get a function computing the sort key of a document.
+
+    The function takes the ID of a document and the document. Its keys hold
+    a rank and a value for every field and end with the document's ID.
+
+    :param spec: the fields to sort by as returned by :func:`sort_spec`
+    """
+
+    def key(doc_id, doc):
+        result = []
+        for path, descending in spec:
+            try:
+                value = resolve_path(doc, path)
+            except (KeyError, TypeError):
+                result += (3, 0)
+                continue
+
+            family = _family(value)
+            if family is None:
+                result += (2, 0)
+            elif not descending:
+                result += (0 if family == 'number' else 1, value)
+            elif family == 'number':
+                result += (1, -value)
+            else:
+                result += (0, _Descending(value))
+
+        result.append(doc_id)
+        return tuple(result)
+
+    return key
+
+
+def top_k(keys, k):
+    """
+    Get the ``k`` smallest sort keys in order, keeping only ``k`` of them
+    in memory.
+    """
+
+    return heapq.nsmallest(k, keys)
+
+
+def external_sort(keys, buffer_size=None):
+    """
+    Sort keys, spilling sorted runs to temporary files if there are more
+    than ``buffer_size`` of them and merging the runs when iterating.
+
+    :param keys: an iterable of sort keys
+    :param buffer_size: the number of keys to sort in memory (default:
+                        :data:`SORT_BUFFER`)
+    :rtype: Iterator
+    """
+
+    if buffer_size is None:
+        buffer_size = SORT_BUFFER
+
+    keys = iter(keys)
+    runs = []
+
+    chunk = list(islice(keys, buffer_size))
+    while True:
+        chunk.sort()
+        following = list(islice(keys, buffer_size))
+
+        if not runs and not following:
+            # Fits into memory
+            return iter(chunk)
+
+        runs.append(_spill(chunk))
+        if not following:
+            break
+        chunk = following
+
+    return heapq.merge(*[_read_run(run) for run in runs])
+
+
+def _spill(keys):
+    run = tempfile.TemporaryFile()
+    for start in range(0, len(keys), _BATCH):
+        pickle.dump(keys[start:start + _BATCH], run, pickle.HIGHEST_PROTOCOL)
+
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    try:
+        while True:
+            try:
+                batch = pickle.load(run)
+            except EOFError:
+                return
+
+            for key in batch:
+                yield key
+    finally:
+        run.close()
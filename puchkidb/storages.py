@@ -4,17 +4,46 @@ implementations.
 """
 
 from abc import ABCMeta, abstractmethod
+import binascii
 import codecs
+from contextlib import contextmanager
+import hashlib
 import os
+import tempfile
+import threading
+import time
 
 from .utils import with_metaclass
 
+try:
+    from urllib.parse import quote
+except ImportError:  # pragma: no cover
+    from urllib import quote
+
 
 try:
     import ujson as json
 except ImportError:
     import json
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    fcntl = None
+
+
+#: How long after a file has been modified its signature is trusted to
+#: change with the next write, in seconds. Covers the granularity of the
+#: modification times of common file systems.
+RACY_WINDOW = 2.0
+
+
+def _digest(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).digest()
+
 
 def touch(fname, create_dirs):
     if create_dirs:
@@ -71,13 +100,113 @@ class Storage(with_metaclass(ABCMeta, object)):
 
         pass
 
+    #: The number of times the storage has noticed the stored data being
+    #: changed by someone else (see :meth:`refresh`)
+    external_writes = 0
+
+    def refresh(self):
+        """
+        Optional: Check whether the stored data has been changed by someone
+        else, e.g. another process, since the storage read or wrote it the
+        last time.
+
+        Storages doing so count these changes in :attr:`external_writes`, so
+        that tables know to drop what they derived from the data before.
+
+        :returns: whether the data has been changed
+        """
+
+        return False
+
+    #: Whether the storage can keep the indexes of tables (see
+    #: :meth:`read_index` and :meth:`write_index`)
+    persists_indexes = False
+
+    def read_index(self, table):
+        """
+        Optional: Read the serialized indexes of a table.
+
+        Return ``None`` if no indexes have been stored.
+
+        :param table: The name of the table.
+        :rtype: bytes
+        """
+
+        return None
+
+    def write_index(self, table, payload):
+        """
+        Optional: Store the serialized indexes of a table.
+
+        Has to replace the previously stored indexes atomically, so a crash
+        never leaves a partially written payload behind.
+
+        :param table: The name of the table.
+        :param payload: The serialized indexes.
+        :type payload: bytes
+        """
+
+        pass
+
+    @property
+    def generation(self):
+        """
+        Optional: Get a string identifying the data last read or written,
+        which changes whenever the data does. Stored indexes are only used
+        for the generation they have been built from.
+
+        Return ``None`` if unknown, so that stored indexes are never used.
+        """
+
+        return None
+
+
+def replace_file(fname, payload):
+    """
+    Atomically replace the contents of a file.
+    """
+
+    handle, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or '.',
+                                   prefix=os.path.basename(fname),
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+        try:
+            os.replace(tmp, fname)
+        except AttributeError:  # pragma: no cover
+            # Python 2 has no os.replace
+            os.rename(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
 
 class JSONStorage(Storage):
     """
     Store the data in a JSON file.
+
+    Table indexes are stored in files next to the JSON file, named
+    ``<path>.<table>.idx``. They are tied to a digest of the file's text, so
+    they are rebuilt once the file has been written without updating them.
+
+    With ``locking=True`` several processes can use the same file: the file
+    is locked with ``fcntl.flock``, shared while reading and exclusively
+    while writing (see :meth:`exclusive`). The data read is kept until the
+    file changes, so that a process only parses the file again after
+    another process has written it. Changes are noticed by the size,
+    modification time and inode of the file or, within :data:`RACY_WINDOW`
+    of its last modification, by a digest of its contents.
     """
 
-    def __init__(self, path, create_dirs=False, encoding=None, **kwargs):
+    persists_indexes = True
+
+    def __init__(self, path, create_dirs=False, encoding=None, locking=False,
+                 **kwargs):
         """
         Create a new instance.
 
@@ -85,35 +214,213 @@ class JSONStorage(Storage):
 
         :param path: Where to store the JSON data.
         :type path: str
+        :param locking: Whether to lock the file so that several processes
+                        can use it at once. Needs :mod:`fcntl`, which
+                        Windows doesn't have.
         """
 
         super(JSONStorage, self).__init__()
+        if locking and fcntl is None:
+            raise ValueError('File locking needs the fcntl module, which '
+                             'is not available on this platform')
+
         touch(path, create_dirs=create_dirs)  # Create file if not exists
         self.kwargs = kwargs
+        self._path = path
         self._handle = codecs.open(path, 'r+', encoding=encoding)
 
+        self.locking = locking
+        self.external_writes = 0
+
+        # flock locks belong to the open file, so the threads of this
+        # process take turns holding them
+        self._mutex = threading.RLock()
+        self._exclusive = 0
+
+        # The data last read, the digest of the text it was read from or
+        # last written and the signature of the file holding that text
+        self._data = None
+        self._digest = None
+        self._signature = self._mtime = self._stamp = None
+
+        # Without locking, the digest is only computed for the generation
+        self._unhashed = False
+
+        # The text the last change check read, for the read following it
+        self._checked = None
+
     def close(self):
         self._handle.close()
 
+    def _index_file(self, table):
+        return '{}.{}.idx'.format(self._path, quote(table, safe=''))
+
+    def read_index(self, table):
+        try:
+            with open(self._index_file(table), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def write_index(self, table, payload):
+        replace_file(self._index_file(table), payload)
+
+    @property
+    def generation(self):
+        # The digest of the file's text, computed anyway with locking
+        if self._unhashed:
+            self._digest = _digest(self._read_text())
+            self._unhashed = False
+
+        if self._digest is None:
+            return None
+        return binascii.hexlify(self._digest).decode('ascii')
+
+    def _stat(self):
+        """
+        Get the signature of the file, which changes when it is written
+        unless the write happens within the granularity of its modification
+        time, and its modification time.
+        """
+        stat = os.fstat(self._handle.fileno())
+        mtime = getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+        return (stat.st_ino, stat.st_size, mtime), stat.st_mtime
+
+    def _remember(self, digest):
+        """
+        Remember the signature of the file holding the data with the given
+        digest.
+        """
+        self._signature, self._mtime = self._stat()
+        self._stamp = time.time()
+        self._digest = digest
+
+    def _unchanged(self):
+        """
+        Whether the file certainly still holds the data last read or
+        written, going by its signature alone: the signature has to be the
+        same and it has to have been remembered long enough after the file
+        was modified, as another write within the granularity of the
+        modification time wouldn't change it.
+        """
+        signature, _ = self._stat()
+        return signature == self._signature and \
+            self._stamp - self._mtime >= RACY_WINDOW
+
+    def _read_text(self):
+        self._handle.seek(0)
+        return self._handle.read()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Lock the file exclusively within a ``with`` block, so that reading,
+        changing and writing the data can't interleave with other processes
+        doing the same. Reentrant, does nothing without ``locking``.
+        """
+        with self._mutex:
+            if not self.locking:
+                yield
+                return
+
+            if not self._exclusive:
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+            self._exclusive += 1
+
+            try:
+                yield
+            finally:
+                self._exclusive -= 1
+                if not self._exclusive:
+                    fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def _shared(self):
+        with self._mutex:
+            if not self.locking or self._exclusive:
+                # Not locking or already locked exclusively
+                yield
+                return
+
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+
+    def refresh(self):
+        if not self.locking:
+            return False
+
+        with self._shared():
+            if self._digest is None or self._unchanged():
+                return False
+
+            text = self._read_text()
+            digest = _digest(text)
+            changed = digest != self._digest
+            if changed:
+                self._data = None
+                self.external_writes += 1
+
+            self._remember(digest)
+            self._checked = text
+            return changed
+
     def read(self):
-        # Get the file size
-        self._handle.seek(0, os.SEEK_END)
-        size = self._handle.tell()
+        if self.locking:
+            return self._read_locked()
+
+        text = self._read_text()
+        self._unhashed = True
 
-        if not size:
+        if not text:
             # File is empty
             return None
         else:
-            self._handle.seek(0)
-            return json.load(self._handle)
+            return json.loads(text)
+
+    def _read_locked(self):
+        with self._shared():
+            if self._data is not None and self._unchanged():
+                return self._data
+
+            text, self._checked = self._checked, None
+            if text is not None and self._stat()[0] == self._signature:
+                # Just read by the change check
+                digest = self._digest
+            else:
+                text = self._read_text()
+                digest = _digest(text)
+
+            if digest != self._digest:
+                if self._digest is not None:
+                    self.external_writes += 1
+                self._data = None
+
+            if self._data is None and text:
+                self._data = json.loads(text)
+
+            self._remember(digest)
+            return self._data
 
     def write(self, data):
-        self._handle.seek(0)
-        serialized = json.dumps(data, **self.kwargs)
-        self._handle.write(serialized)
-        self._handle.flush()
-        os.fsync(self._handle.fileno())
-        self._handle.truncate()
+        with self.exclusive():
+            # The data read before may be what is being written
+            self._data = self._checked = None
+
+            self._handle.seek(0)
+            serialized = json.dumps(data, **self.kwargs)
+            self._handle.write(serialized)
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._handle.truncate()
+
+            if self.locking:
+                self._remember(_digest(serialized))
+            else:
+                self._unhashed = True
 
 
 class MemoryStorage(Storage):
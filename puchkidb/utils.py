@@ -2,14 +2,29 @@
 Utility functions.
 """
 
+import re
 import warnings
 from collections import OrderedDict
 from contextlib import contextmanager
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # pragma: no cover
+    import sre_parse
+
 # Python 2/3 independant dict iteration
 iteritems = getattr(dict, 'iteritems', dict.items)
 itervalues = getattr(dict, 'itervalues', dict.values)
 
+# Python 2/3 independant string type check
+try:
+    string_types = (basestring, )  # noqa: F821
+except NameError:
+    string_types = (str, )
+
+
+_MISSING = object()
+
 
 class LRUCache:
     # @param capacity, an integer
@@ -43,17 +58,20 @@ class LRUCache:
     def __getitem__(self, key):
         return self.get(key)
 
+    # Single dict operations only, so that threads sharing a cache never
+    # see a key vanish between checking for it and using it
+
     def get(self, key, default=None):
-        value = self.__cache.get(key)
-        if value:
-            del self.__cache[key]
-            self.__cache[key] = value
-            return value
-        return default
+        try:
+            value = self.__cache.pop(key)
+        except KeyError:
+            return default
+
+        self.__cache[key] = value
+        return value
 
     def set(self, key, value):
-        if self.__cache.get(key):
-            del self.__cache[key]
+        if self.__cache.pop(key, _MISSING) is not _MISSING:
             self.__cache[key] = value
         else:
             self.__cache[key] = value
@@ -61,7 +79,11 @@ class LRUCache:
             # If the queue is of unlimited size, self.capacity is NaN and
             # x > NaN is always False in Python and the cache won't be cleared.
             if self.capacity is not None and self.length > self.capacity:
-                self.__cache.popitem(last=False)
+                try:
+                    self.__cache.popitem(last=False)
+                except KeyError:
+                    # Emptied by another thread
+                    pass
 
 
 # Source: https://github.com/PythonCharmers/python-future/blob/466bfb2dfa36d865285dc31fe2b0c0a53ff0f181/future/utils/__init__.py#L102-L134
@@ -136,3 +158,124 @@ def freeze(obj):
         return frozenset(obj)
     else:
         return obj
+
+
+def fold(text):
+    """
+    Case-fold a string so that caseless comparisons become plain ones.
+    """
+    try:
+        return text.casefold()
+    except AttributeError:  # pragma: no cover
+        # Python 2 has no str.casefold
+        return text.lower()
+
+
+_REPEATS = tuple(getattr(sre_parse, name) for name in
+                 ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                 if hasattr(sre_parse, name))
+_GROUPS = tuple(getattr(sre_parse, name) for name in
+                ('SUBPATTERN', 'ATOMIC_GROUP')
+                if hasattr(sre_parse, name))
+_AT_START = (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING)
+
+
+def regex_literals(regex, flags=0):
+    """
+    Find the literal text every match of a regular expression contains.
+
+    Returns a ``(prefix, literals, ignorecase)`` tuple: ``prefix`` is the
+    text a match has to start with, ``literals`` is a list of substrings
+    every match has to contain and ``ignorecase`` tells whether any part of
+    the pattern is matched case-insensitively. Returns ``None`` if the
+    pattern cannot be analyzed.
+
+    >>> regex_literals(r'^error: .* timed out')
+    ('error: ', ['error: ', ' timed out'], False)
+    """
+    if not isinstance(regex, string_types):
+        return None
+
+    try:
+        parsed = sre_parse.parse(regex, flags)
+    except Exception:
+        return None
+
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    ignorecase = [bool(state.flags & re.IGNORECASE)]
+    literals = []
+    try:
+        prefix = _walk_regex(parsed, literals, ignorecase)
+    except Exception:
+        # Parse trees differ between Python versions
+        return None
+
+    return prefix, [lit for lit in literals if lit], ignorecase[0]
+
+
+def regex_prefilter(regex, flags=0, anchored=False):
+    """
+    Find a cheap test rejecting most of the strings a regular expression
+    can't match.
+
+    Returns a ``(prefix, literal)`` tuple: if ``prefix`` isn't empty, every
+    string the expression matches at its start begins with it (only used if
+    the match is ``anchored``, i.e. for :func:`re.match`), if ``literal``
+    isn't empty, every matching string contains it. Both are empty for
+    case-insensitive expressions.
+
+    >>> regex_prefilter(r'error: .* timed out', anchored=True)
+    ('error: ', ' timed out')
+    """
+    found = regex_literals(regex, flags)
+    if found is None or found[2]:
+        return '', ''
+
+    prefix, literals, _ = found
+    if not anchored:
+        prefix = ''
+
+    literal = max(literals, key=len) if literals else ''
+    if prefix and literal == prefix:
+        # Checked by the prefix already
+        literal = ''
+
+    return prefix, literal
+
+
+def _walk_regex(items, literals, ignorecase):
+    run = []
+    prefix = None
+
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+
+        if op is sre_parse.AT and av in _AT_START and not run \
+                and prefix is None:
+            # Zero-width anchor in front of the first literal
+            continue
+
+        # Anything else ends the current run of literals
+        if prefix is None:
+            prefix = ''.join(run)
+        literals.append(''.join(run))
+        run = []
+
+        if op is sre_parse.SUBPATTERN:
+            if av[1] & re.IGNORECASE:
+                ignorecase[0] = True
+            _walk_regex(av[-1], literals, ignorecase)
+        elif op in _GROUPS:
+            # Atomic groups hold the grouped pattern itself
+            _walk_regex(av, literals, ignorecase)
+        elif op in _REPEATS and av[0] >= 1:
+            # The repeated pattern has to match at least once
+            _walk_regex(av[2], literals, ignorecase)
+
+    if prefix is None:
+        prefix = ''.join(run)
+    literals.append(''.join(run))
+
+    return prefix
@@ -1,9 +1,15 @@
+import sys
+
 import pytest
 
 from puchkidb.middlewares import CachingMiddleware
 from puchkidb.storages import MemoryStorage
 from puchkidb import PuchkiDB
 
+if sys.version_info < (3, 5):
+    # Needs async and await
+    collect_ignore = ['test_aio.py']
+
 
 @pytest.fixture
 def db():
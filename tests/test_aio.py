@@ -0,0 +1,118 @@
+import asyncio
+import datetime
+
+import pytest
+
+from puchkidb import VersionConflict, where
+from puchkidb.aio import AsyncPuchkiDB
+from puchkidb.storages import MemoryStorage
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super(CountingStorage, self).__init__()
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        super(CountingStorage, self).write(data)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_db():
+    async def main():
+        async with AsyncPuchkiDB(storage=MemoryStorage) as db:
+            assert await db.insert({'int': 1, 'char': 'a'}) == 1
+            assert await db.insert_multiple(
+                [{'int': 1, 'char': 'b'}, {'int': 2}]) == [2, 3]
+
+            assert await db.count(where('int') == 1) == 2
+            assert await db.get(where('int') == 2) == {'int': 2}
+            assert await db.search(where('char') == 'b') == [
+                {'int': 1, 'char': 'b'}]
+            assert await db.contains(doc_ids=[3])
+            assert await db.length() == 3
+
+            assert await db.update({'int': 3}, where('int') == 2) == [3]
+            assert await db.remove(where('char') == 'a') == [1]
+            assert await db.all() == [{'int': 1, 'char': 'b'}, {'int': 3}]
+
+            table = db.table('other')
+            await table.insert({'int': 4})
+            assert await db.tables() == {'_default', 'other'}
+            assert await table.all() == [{'int': 4}]
+
+            doc = await db.get(doc_id=2)
+            assert await db.cas(2, doc.version, {'int': 5}) == 2
+            with pytest.raises(VersionConflict):
+                await db.cas(2, doc.version, {'int': 6})
+
+            with pytest.raises(ValueError):
+                await db.insert([1])
+
+            # Documents can be passed by keyword as well
+            assert await table.insert(document={'int': 5}) == 2
+            assert await table.insert_multiple(
+                documents=[{'int': 6}]) == [3]
+            with pytest.raises(TypeError):
+                await table.insert()
+
+    run(main())
+
+
+def test_async_db_coalesces_writes():
+    async def main():
+        db = AsyncPuchkiDB(storage=CountingStorage)
+        await db.length()
+        storage = db.db._storage
+        writes = storage.writes
+
+        doc_ids = await asyncio.gather(*(db.insert({'int': i})
+                                         for i in range(100)))
+        assert doc_ids == list(range(1, 101))
+        assert storage.writes == writes + 1
+
+        # Writes are applied in order, errors only fail their own write
+        results = await asyncio.gather(
+            db.insert({'int': 100}),
+            db.update({'int': 0}, where('int') == 100),
+            db.update({'int': 1}, doc_ids=[1], if_version=0),
+            db.insert_multiple([{'int': 101}, {'int': 102}]),
+            return_exceptions=True)
+        assert results[0] == 101
+        assert results[1] == [101]
+        assert isinstance(results[2], VersionConflict)
+        assert results[3] == [102, 103]
+        assert await db.count(where('int') == 0) == 2
+
+        await db.close()
+
+    run(main())
+
+
+def test_async_db_failing_coalesced_insert(tmpdir):
+    async def main():
+        db = AsyncPuchkiDB(str(tmpdir.join('db.json')))
+        await db.length()
+
+        # Only the failing insert of the ones applied together fails
+        results = await asyncio.gather(
+            db.insert({'int': 1}),
+            db.insert({'date': datetime.date.today()}),
+            db.insert_multiple([{'int': 2}, {'int': 3}]),
+            return_exceptions=True)
+        assert isinstance(results[0], int)
+        assert isinstance(results[1], TypeError)
+        assert len(results[2]) == 2
+        assert await db.count(where('int').exists()) == 3
+
+        await db.close()
+
+    run(main())
@@ -0,0 +1,117 @@
+import pytest
+
+from puchkidb.cache import FrequencySketch, QueryCache, estimate_size
+
+
+def test_query_cache():
+    cache = QueryCache(capacity=2)
+    cache['a'] = []
+    cache['b'] = [{'x': 1}]
+
+    # Empty results are hits as well
+    assert cache.get('a') == []
+    assert cache.get('c') is None
+
+    cache['c'] = [{'x': 2}]
+    assert cache.lru == ['a', 'c']
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 1, 1)
+    assert stats['entries'] == 2
+    assert stats['bytes'] == estimate_size([]) + estimate_size([{'x': 2}])
+
+    del cache['a']
+    cache.clear()
+    assert cache.stats()['bytes'] == 0
+    assert cache.stats()['hits'] == 1
+
+
+def test_query_cache_bytes():
+    small, large = [{'x': 1}], [{'x': 'y' * 1000}] * 10
+    cache = QueryCache(max_bytes=estimate_size(large) + estimate_size(small))
+
+    cache['small'] = small
+    cache['large'] = large
+    assert cache.lru == ['small', 'large']
+
+    cache['other'] = small
+    assert cache.lru == ['large', 'other']
+
+    # Results larger than the whole budget aren't cached
+    cache['huge'] = large * 2
+    assert 'huge' not in cache
+    assert cache.stats()['rejections'] == 1
+
+    # Results changed in place are measured again
+    small.extend(large)
+    cache.resize('other')
+    assert cache.stats()['bytes'] == estimate_size(large) + \
+        estimate_size(small)
+
+
+def test_query_cache_tinylfu():
+    cache = QueryCache(capacity=2, admission='tinylfu')
+    for key in ['hot', 'warm', 'hot']:
+        cache.get(key)
+        cache[key] = []
+
+    # Asked for once, less often than the least recently used result
+    cache.get('cold')
+    cache['cold'] = []
+    assert cache.lru == ['warm', 'hot']
+
+    for _ in range(2):
+        cache.get('cold')
+    cache['cold'] = []
+    assert cache.lru == ['hot', 'cold']
+
+    # Lookups of results that won't be cached don't count
+    for _ in range(3):
+        cache.get('warm', record=False)
+    cache['warm'] = []
+    assert cache.lru == ['hot', 'cold']
+    assert cache.stats()['misses'] == 5
+
+    with pytest.raises(ValueError):
+        QueryCache(admission='lru')
+
+
+def test_frequency_sketch():
+    sketch = FrequencySketch(width=16)
+    for _ in range(5):
+        sketch.record('a')
+    sketch.record('b')
+
+    assert sketch.frequency('a') >= 5
+    assert sketch.frequency('a') > sketch.frequency('b')
+
+    # Counts are halved regularly
+    for _ in range(200):
+        sketch.record('c')
+    assert sketch.frequency('a') < 5
+
+
+def test_query_cache_views():
+    cache = QueryCache(capacity=3)
+    users, orders = cache.view('users'), cache.view('orders')
+
+    users['a'] = [{'x': 1}]
+    orders['a'] = []
+    assert users.get('a') == [{'x': 1}]
+    assert 'a' not in cache
+
+    # The least recently used result goes, whichever view it belongs to
+    users['b'] = []
+    users['c'] = []
+    assert orders.lru == []
+    assert users.lru == ['a', 'b', 'c']
+    assert orders.stats()['evictions'] == 1
+
+    # Clearing a view leaves the others alone
+    orders['a'] = []
+    users.clear()
+    assert len(users) == 0
+    assert orders.lru == ['a']
+    assert cache.stats()['entries'] == 1
+    assert cache.bytes == orders.stats()['bytes']
+    assert users.stats()['hits'] == 1
@@ -0,0 +1,123 @@
+import re
+
+import pytest
+
+from puchkidb.compiler import compile_queries, compile_query
+from puchkidb.queries import Query, QueryImpl, where
+
+DOCS = [
+    {},
+    {'a': 1},
+    {'a': 2, 'b': 3},
+    {'a': 'text', 'b': [1, 2]},
+    {'a': {'b': 3}, 'c': None},
+    {'a': [{'b': 1}, {'b': 2}], 'c': 'Some Text'},
+    {'b': 5, 'c': 'other'},
+]
+
+QUERIES = [
+    where('a') == 1,
+    where('a') != 1,
+    (where('a') == 1) | (where('a') == 2),
+    ((where('a') == 2) & (where('b') > 2)) | where('c').exists(),
+    ~(where('a') == 1) & ~where('b').exists(),
+    where('a').b == 3,
+    Query().a.b.exists() | Query().c,
+    where('c').search('text', flags=re.IGNORECASE),
+    where('c').matches(r'\w+'),
+    where('c').matches('Some'),
+    where('c').search('Text|other'),
+    where('a').search('ex'),
+    where('b').one_of([3, 5]),
+    where('b').any([2, 7]),
+    where('b').all([1, 2]),
+    where('a').any(where('b') == 2),
+    where('a').all(Query().b.exists()),
+    where('b').test(lambda value, n: value == n, 5),
+    where('b').exists() & ~(where('a') == 2),
+    (Query().a.b == 3) & Query().a.c.exists(),
+    (where('a') >= 1) & (where('a') < 2) & (where('b') > 2),
+    (where('a') > 0) & (where('a') > 1) & (where('a') <= 'z'),
+    ~((where('a') == 1) | ~(where('b') == 3)),
+    (where('a') == 1) | (where('b') == 5) | (where('a') == 1),
+    where('b').one_of([3, 5, [1, 2]]),
+    where('a').one_of('text'),
+    (Query().a.b == 1) | (Query().a == 2) | (Query().a.b.c == 3),
+]
+
+
+def outcome(test, doc):
+    try:
+        return bool(test(doc))
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_compiled_query_matches(query):
+    compiled = compile_query(query)
+
+    assert compiled is not query
+    for doc in DOCS:
+        assert outcome(compiled, doc) == outcome(query, doc), doc
+
+
+def test_shared_lookups():
+    query = ((where('a') == 1) & (where('b') > 2)) | (where('a') == 5)
+    source = compile_query(query).source
+
+    assert source.count("doc['a']") == 1
+    assert source.count("doc['b']") == 1
+
+
+def test_shared_prefixes():
+    address = Query().profile.address
+    query = ((address.city == 'Kolkata') & (address.zip > 700000)) | \
+        (Query().profile.name == 'Ray')
+    source = compile_query(query).source
+
+    assert source.count("['profile']") == 1
+    assert source.count("['address']") == 1
+
+    compiled = compile_query(query)
+    assert compiled({'profile': {'address': {'city': 'Kolkata',
+                                             'zip': 700019}}})
+    assert compiled({'profile': {'name': 'Ray', 'address': None}})
+    assert not compiled({'profile': {'address': 'Kolkata'}})
+    assert not compiled({'profile': None})
+
+
+def test_compile_cache():
+    query = (where('x') == 1) & (where('y') == 2)
+    same = (where('y') == 2) & (where('x') == 1)
+
+    assert compile_query(query) is compile_query(same)
+
+
+def test_uncompilable_queries():
+    opaque = QueryImpl(lambda doc: doc.get('a') == 1, ('opaque', ))
+    assert compile_query(opaque) is opaque
+
+    # Opaque parts of a query are called as they are
+    compiled = compile_query(opaque | (where('b') == 2))
+    assert compiled({'a': 1}) and compiled({'b': 2})
+    assert not compiled({'a': 2})
+
+    # Invalid patterns fail when the query is run, like before compiling
+    query = where('c').search('(')
+    assert compile_query(query) is query
+
+    assert compile_query(lambda doc: True)({})
+
+
+def test_compile_queries():
+    queries = [where('a') == 1, (where('a') > 0) & (where('b') == 2),
+               where('c').exists()]
+    test = compile_queries(queries)
+
+    for doc in [{'a': 1}, {'a': 2, 'b': 2}, {'c': None}, {}]:
+        assert test(doc) == tuple(bool(query(doc)) for query in queries)
+
+    # Paths are looked up once for all queries
+    assert test.source.count("doc['a']") == 1
+    assert compile_queries(queries) is test
@@ -0,0 +1,520 @@
+import datetime
+import hashlib
+import json
+import re
+
+import pytest
+
+from puchkidb import PuchkiDB, Query, where
+from puchkidb.queries import QueryImpl
+from puchkidb.bitmaps import Bitmap
+from puchkidb.indexes import BitmapIndex, Index, SortedIndex, TextIndex, \
+    _UNHASHABLE, dump_indexes, implies, load_indexes, query_shape
+from puchkidb.database import Table
+
+
+@pytest.fixture
+def logs(db):
+    table = db.table('logs')
+    table.insert_multiple({'message': msg} for msg in [
+        'connection reset by peer',
+        'Connection timed out',
+        'disk full',
+        'connection reset, retrying connection',
+        42,
+    ])
+    return table
+
+
+def test_text_index_lookup():
+    index = TextIndex(('message', ))
+    index.build({1: {'message': 'disk full'},
+                 2: {'message': 'disk quota exceeded'},
+                 3: {'other': 'disk full'}})
+
+    def lookup(regex):
+        found = index.lookup(('search', ('message', ), regex, 0))
+        return found and (list(found[0]), found[1])
+
+    assert lookup('full') == ([1], False)
+    assert lookup('disk') == ([1, 2], False)
+    assert lookup('nothing') == ([], True)
+
+    # No literal long enough to narrow down the candidates
+    assert lookup(r'd\w+') is None
+
+
+def test_text_index_remove():
+    index = TextIndex(('message', ))
+    index.build({1: {'message': 'disk full'}})
+    index.remove(1)
+
+    assert not index._words and not index._trigrams
+
+
+def test_text_index_search(logs):
+    logs.create_index('message', 'text')
+
+    query = where('message').search('reset')
+    assert [doc.doc_id for doc in logs.search(query)] == [1, 4]
+
+    query = where('message').search('connection', flags=re.IGNORECASE)
+    assert [doc.doc_id for doc in logs.search(query)] == [1, 2, 4]
+
+    query = where('message').matches(r'connection \w+ (by|out)')
+    assert [doc.doc_id for doc in logs.search(query)] == [1]
+
+    query = where('message').search('reset') & (where('message') != '')
+    assert len(logs.search(query)) == 2
+
+    query = where('message').search('disk') | where('message').search('out')
+    assert [doc.doc_id for doc in logs.search(query)] == [2, 3]
+
+
+def test_text_index_is_maintained(logs):
+    logs.create_index('message', 'text')
+    query = where('message').search('full')
+
+    assert len(logs.search(query)) == 1
+
+    logs.insert({'message': 'memory full'})
+    assert len(logs.search(query)) == 2
+
+    logs.update({'message': 'disk ok'}, where('message') == 'disk full')
+    assert [doc['message'] for doc in logs.search(query)] == ['memory full']
+
+    logs.remove(query)
+    assert logs.search(query) == []
+
+    logs.purge()
+    logs.insert({'message': 'still full'})
+    assert len(logs.search(query)) == 1
+
+
+def test_create_index(logs):
+    index = logs.create_index('message', 'text')
+
+    assert logs.create_index(where('message'), 'text') is index
+    assert logs.indexes() == [index]
+
+    logs.drop_index('message')
+    assert logs.indexes() == []
+
+    with pytest.raises(ValueError):
+        logs.create_index('message', 'unknown')
+
+
+def test_text_search(logs):
+    expected = [4, 1, 2]
+    results = logs.text_search('message', 'connection reset')
+    assert [doc.doc_id for doc in results] == expected
+
+    logs.create_index('message', 'text')
+    results = logs.text_search('message', ['connection', 'reset'])
+    assert [doc.doc_id for doc in results] == expected
+
+    assert logs.text_search('message', 'nothing') == []
+
+
+@pytest.fixture
+def orders(db):
+    table = db.table('orders')
+    table.insert_multiple({'status': status, 'country': country}
+                          for status in ('open', 'closed', 'void')
+                          for country in ('de', 'fr', 'in'))
+    table.insert({'note': 'no status'})
+    return table
+
+
+def test_bitmap():
+    bitmap = Bitmap([5, 1, 70000, 3])
+    assert list(bitmap) == [1, 3, 5, 70000]
+    assert len(bitmap) == 4
+    assert 70000 in bitmap and 2 not in bitmap
+
+    bitmap.discard(70000)
+    bitmap.discard(2)
+    assert list(bitmap) == [1, 3, 5]
+
+    other = Bitmap([3, 4])
+    assert list(bitmap & other) == [3]
+    assert list(bitmap | other) == [1, 3, 4, 5]
+    assert list(bitmap - other) == [1, 5]
+    assert list(bitmap) == [1, 3, 5]
+
+
+def test_bitmap_dense():
+    evens = Bitmap(range(0, 20000, 2))
+    odds = Bitmap(range(1, 20000, 2))
+
+    assert not isinstance(evens._chunks[0], set)
+    assert len(evens | odds) == 20000
+    assert not (evens & odds)
+    assert list(evens - Bitmap(range(4, 20000))) == [0, 2]
+    assert isinstance((evens - Bitmap(range(4, 20000)))._chunks[0], set)
+
+    evens.discard(0)
+    assert 0 not in evens and 2 in evens
+
+
+def test_bitmap_index_lookup():
+    index = BitmapIndex(('status', ))
+    index.build({1: {'status': 'open'}, 2: {'status': 'closed'},
+                 3: {'status': 'open'}, 4: {}})
+
+    def lookup(*hashval):
+        found = index.lookup(hashval)
+        return found and (list(found[0]), found[1])
+
+    assert lookup('==', ('status', ), 'open') == ([1, 3], True)
+    assert lookup('==', ('status', ), 'void') == ([], True)
+    assert lookup('!=', ('status', ), 'open') == ([2], True)
+    assert lookup('one_of', ('status', ), ('closed', 'void')) == ([2], True)
+    assert lookup('exists', ('status', )) == ([1, 2, 3], True)
+    assert lookup('<', ('status', ), 'd') == ([2], True)
+    assert lookup('<', ('status', ), 1) is None
+    assert list(index.covered) == [1, 2, 3, 4]
+
+    index.remove(1)
+    assert lookup('==', ('status', ), 'open') == ([3], True)
+
+
+def test_bitmap_index_search(orders):
+    orders.create_index('status', 'bitmap')
+    orders.create_index('country', 'bitmap')
+
+    query = (where('status') == 'open') & (where('country') != 'fr')
+    assert [doc.doc_id for doc in orders.search(query)] == [1, 3]
+
+    query = ~(where('status') == 'open') | (where('country') == 'de')
+    assert [doc.doc_id for doc in orders.search(query)] == \
+        [1, 4, 5, 6, 7, 8, 9, 10]
+
+    assert orders.count(where('status').one_of(['closed', 'void'])) == 6
+    assert orders.count(where('status').one_of('reopened')) == 3
+    assert orders.count(~where('status').exists()) == 1
+    assert orders.get(where('country') == 'in')['status'] == 'open'
+
+
+def test_bitmap_index_exact_results(orders):
+    orders.create_index('status', 'bitmap')
+
+    def fail(value):
+        raise AssertionError('query should not be run')
+
+    # Not answerable by the index, the query has to run
+    query = (where('status') == 'open') & ~where('status').test(fail)
+    with pytest.raises(AssertionError):
+        orders.count(query)
+
+    query = (where('status') == 'open') | (where('status') == 'void')
+    query._test = fail
+    assert orders.count(query) == 6
+    assert len(orders.search(query)) == 6
+
+    orders.update({'status': 'void'}, doc_ids=[1])
+    assert orders.count(query) == 6
+    orders.remove(doc_ids=[1])
+    assert orders.count(query) == 5
+
+
+def test_bitmap_index_exact_count(orders):
+    orders.create_index('status', 'bitmap')
+    query = where('status') == 'open'
+    assert orders.count(query) == 3
+
+    # Counted queries are recorded for the advisor
+    assert orders._query_stats[query_shape(query.hashval)][:3] == [1, 0, 3]
+
+    # Only documents still stored are counted
+    index = orders.indexes()[0]
+    index._bitmaps['open'].add(99)
+    assert orders.count(query) == 3
+
+
+def _open_logs(path):
+    db = PuchkiDB(str(path))
+    table = db.table('logs')
+    table.create_index('message', 'text')
+    table.create_index('level', 'bitmap')
+    return db, table
+
+
+def test_persisted_indexes(tmpdir, monkeypatch):
+    path = tmpdir.join('db.json')
+    db, table = _open_logs(path)
+    table.insert_multiple({'message': 'disk {} full'.format(i), 'level': i % 2}
+                          for i in range(10))
+    assert table.count(where('level') == 1) == 5
+    db.close()
+
+    assert tmpdir.join('db.json.logs.idx').check()
+
+    def fail(self, docs):
+        raise AssertionError('index should have been loaded')
+
+    monkeypatch.setattr(Index, 'build', fail)
+
+    db, table = _open_logs(path)
+    assert table.count(where('level') == 1) == 5
+    assert len(table.search(where('message').search('disk 3'))) == 1
+    assert all(index.ready for index in table.indexes())
+
+    # Keep the stored indexes up to date
+    table.insert({'message': 'disk ok', 'level': 1})
+    db.close()
+
+    db, table = _open_logs(path)
+    assert table.count(where('level') == 1) == 6
+
+
+def test_persisted_indexes_format(tmpdir, monkeypatch):
+    path = tmpdir.join('db.json')
+    db = PuchkiDB(str(path))
+    table = db.table('logs')
+    table.create_index('tags', 'bitmap')
+    table.create_index('size', 'sorted')
+    table.insert_multiple([{'tags': ['a', 'b'], 'size': 1},
+                           {'tags': {'a': 1}, 'size': 2.5},
+                           {'tags': None}])
+    assert table.count(where('tags') == ['a', 'b']) == 1
+    assert table.count(where('size') > 2) == 1
+    db.close()
+
+    # Stored as JSON, which can't run code when it is loaded
+    state = json.loads(tmpdir.join('db.json.logs.idx').read())
+    assert state['generation'] == hashlib.sha1(path.read_binary()).hexdigest()
+
+    monkeypatch.setattr(Index, 'build', lambda self, docs: 1 / 0)
+
+    db = PuchkiDB(str(path))
+    table = db.table('logs')
+    table.create_index('tags', 'bitmap')
+    table.create_index('size', 'sorted')
+    assert table.count(where('tags') == ['a', 'b']) == 1
+    assert table.count(where('tags') == {'a': 1}) == 1
+    assert table.count(where('size') > 2) == 1
+    assert table.count(where('size') == 1) == 1
+
+
+def test_persisted_indexes_markers():
+    index = BitmapIndex(('tags', ))
+    index.build({1: {'tags': [1]}, 2: {'tags': 'x'}})
+    index._bitmaps[_UNHASHABLE] = Bitmap([3])
+
+    restored = BitmapIndex(('tags', ))
+    assert load_indexes(dump_indexes([index], 'a'), [restored], 'a')
+    assert _UNHASHABLE in restored._bitmaps
+    assert restored._bitmaps[(1, )] == Bitmap([1])
+    assert restored.lookup(('==', ('tags', ), 'y')) is None
+
+    # Payloads of other generations are ignored
+    assert not load_indexes(dump_indexes([index], 'a'),
+                            [BitmapIndex(('tags', ))], 'b')
+
+
+def test_stale_persisted_indexes(tmpdir):
+    path = tmpdir.join('db.json')
+    db, table = _open_logs(path)
+    table.insert({'message': 'disk full', 'level': 1})
+    table.count(where('level') == 1)
+    db.close()
+
+    # Change the data behind the indexes' back
+    db = PuchkiDB(str(path))
+    db.table('logs').insert({'message': 'disk full', 'level': 1})
+    db.close()
+
+    db, table = _open_logs(path)
+    assert table.count(where('level') == 1) == 2
+    db.close()
+
+    # Damaged index files are rebuilt as well
+    tmpdir.join('db.json.logs.idx').write('garbage')
+    db, table = _open_logs(path)
+    assert table.count(where('level') == 1) == 2
+
+
+def test_sorted_index_lookup():
+    index = SortedIndex(('age', ))
+    index.build({1: {'age': 30}, 2: {'age': 18}, 3: {'age': 42.5},
+                 4: {'age': 18}, 5: {}})
+
+    def lookup(*hashval):
+        found = index.lookup(hashval)
+        return found and (list(found[0]), found[1])
+
+    assert lookup('==', ('age', ), 18) == ([2, 4], True)
+    assert lookup('<', ('age', ), 30) == ([2, 4], True)
+    assert lookup('<=', ('age', ), 30) == ([1, 2, 4], True)
+    assert lookup('>', ('age', ), 18) == ([1, 3], True)
+    assert lookup('>=', ('age', ), 42.5) == ([3], True)
+    assert lookup('one_of', ('age', ), (30, 42.5)) == ([1, 3], True)
+    assert index.lookup(('one_of', ('age', ), '30')) is None
+    assert lookup('exists', ('age', )) == ([1, 2, 3, 4], True)
+    assert lookup('!=', ('age', ), 18) is None
+
+    # Values of other types have to be tested by the query
+    index.add(6, {'age': 'old'})
+    index.add(7, {'age': None})
+    assert lookup('<', ('age', ), 30) == ([2, 4, 6, 7], False)
+    assert lookup('==', ('age', ), 'old') == ([6], True)
+
+    index.remove(2)
+    index.remove(6)
+    assert lookup('<', ('age', ), 30) == ([4, 7], False)
+
+
+def test_sorted_index_order():
+    index = SortedIndex(('age', ))
+    index.build({1: {'age': 30}, 2: {'age': 'old'}, 3: {'age': 18},
+                 4: {}, 5: {'age': None}, 6: {'age': 18}, 7: {'age': 'new'}})
+
+    assert list(index.iter_sorted()) == [3, 6, 1, 7, 2, 5, 4]
+    assert list(index.iter_sorted(reverse=True)) == [2, 7, 1, 3, 6, 5, 4]
+
+
+def test_sorted_index_search(db):
+    table = db.table('people')
+    table.insert_multiple({'age': age} for age in [30, 18, 42, 18, 65])
+    table.create_index('age')
+
+    query = (where('age') >= 18) & (where('age') < 42)
+    assert [doc['age'] for doc in table.search(query)] == [30, 18, 18]
+    assert table.count(where('age') > 40) == 2
+
+    table.insert({'age': 41})
+    assert table.count(where('age') > 40) == 3
+
+
+def test_implies():
+    status = Query().status == 'open'
+    due = Query().due
+
+    assert implies(((due < 5) & status).hashval, status.hashval)
+    assert implies(status.hashval, Query().status.exists().hashval)
+    assert implies((Query().status.one_of(['open'])).hashval, status.hashval)
+    assert implies(status.hashval,
+                   Query().status.one_of(['open', 'new']).hashval)
+    assert not implies(Query().status.one_of('op').hashval, status.hashval)
+    assert implies(status.hashval, (Query().status != 'closed').hashval)
+    assert implies((due < 5).hashval, (due <= 5).hashval)
+    assert implies((due == 3).hashval, ((due > 1) & (due < 4)).hashval)
+    assert implies(((due < 2) | (due == 4)).hashval, (due < 5).hashval)
+
+    assert not implies((due <= 5).hashval, (due < 5).hashval)
+    assert not implies((due < 5).hashval, status.hashval)
+    assert not implies((due == 'x').hashval, (due < 5).hashval)
+    assert not implies(((due < 2) | status).hashval, (due < 5).hashval)
+
+
+def test_partial_index(db):
+    table = db.table('tasks')
+    table.insert_multiple({'status': 'open' if i % 10 == 0 else 'archived',
+                           'due': i % 7} for i in range(100))
+
+    is_open = where('status') == 'open'
+    index = table.create_index('due', where=is_open)
+
+    assert table.count(is_open & (where('due') < 3)) == 4
+    assert len(index.covered) == 10
+    assert len(index._values) == 10
+
+    # The filter isn't implied, so all documents have to be searched
+    assert table.count(where('due') < 3) == 44
+    assert table.count(~is_open & (where('due') < 3)) == 40
+
+    table.update({'status': 'open'}, doc_ids=[2])
+    assert table.count(is_open & (where('due') < 3)) == 5
+    assert len(index.covered) == 11
+
+
+def test_partial_index_on_none(db):
+    table = db.table('tasks')
+    table.insert_multiple([{'due': 1, 'deleted': None},
+                           {'due': 2, 'deleted': '2020'},
+                           {'due': 3, 'deleted': '2021'}])
+    table.create_index('due', where=where('deleted') == None)  # noqa: E711
+
+    deleted = Query().deleted
+    unset = (deleted == None).hashval  # noqa: E711
+    assert not implies((deleted == 5).hashval, unset)
+    assert not implies((deleted > 3).hashval, unset)
+
+    query = (where('deleted') == '2020') & (where('due') < 5)
+    assert [doc.doc_id for doc in table.search(query)] == [2]
+    assert table.count(query) == 1
+
+
+def test_partial_index_custom_query(db):
+    table = db.table('tasks')
+    table.insert_multiple({'due': i, 'open': i % 2} for i in range(4))
+    table.create_index('due', where=where('open') == 1)
+
+    custom = QueryImpl(lambda doc: doc['due'] > 1, ('custom', ))
+    assert [doc['due'] for doc in table.search(custom)] == [2, 3]
+    assert [doc['due'] for doc in
+            table.search(custom & (where('open') == 1))] == [3]
+
+
+def test_query_shape():
+    query = (where('a') == 1) & ~where('b').search('x')
+    other = (where('a') == 2) & ~where('b').search('y')
+
+    assert query_shape(query.hashval) == query_shape(other.hashval)
+    assert query_shape((where('a') == 1).hashval) == ('==', ('a', ))
+
+
+def test_index_advice(db):
+    table = db.table('events')
+    table.insert_multiple({'kind': 'click' if i % 20 else 'error',
+                           'user': i, 'message': 'msg {}'.format(i)}
+                          for i in range(200))
+
+    for i in range(20):
+        table.search((where('kind') == 'error') & (where('user') > 150 + i))
+        table.search(where('message').search('msg'))
+        table.search(where('user') != i)
+        table.clear_cache()
+
+    advice = table.index_advice()
+    assert set((entry['field'], entry['kind']) for entry in advice) == {
+        (('kind', ), 'bitmap'),
+        (('user', ), 'sorted'),
+    }
+    assert all(entry['queries'] == 20 for entry in advice)
+
+    assert table.index_advice(min_queries=21) == []
+    assert len(table.index_advice(max_selectivity=1)) == 3
+
+    table.create_index('kind', 'bitmap')
+    assert [entry['field'] for entry in table.index_advice()] == [('user', )]
+
+
+def test_auto_index(db):
+    table = db.table('events', auto_index=True)
+    table.insert_multiple({'user': i} for i in range(100))
+
+    for i in range(Table.ADVICE_MIN_QUERIES):
+        assert table.count(where('user') == i) == 1
+
+    index, = table.indexes()
+    assert (index.path, index.kind) == (('user', ), 'sorted')
+    assert table.count(where('user') == 3) == 1
+
+
+def test_indexes_after_failed_write(tmpdir):
+    db = PuchkiDB(str(tmpdir.join('db.json')))
+    db.insert({'k': 1})
+    db.create_index('k', 'bitmap')
+    db.create_index('k')
+    assert db.count(where('k') == 1) == 1
+    assert db.count(where('k') >= 1) == 1
+
+    # Dates can't be stored as JSON
+    with pytest.raises(TypeError):
+        db.insert({'k': 1, 'd': datetime.date.today()})
+
+    assert db.count(where('k') == 1) == 1
+    assert db.count(where('k') >= 1) == 1
+    db.close()
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from puchkidb import PuchkiDB, where
+from puchkidb.locks import RWLock
+from puchkidb.storages import JSONStorage, MemoryStorage
+
+
+def run_threads(*targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+
+
+def test_rwlock_shared_reads():
+    lock = RWLock()
+    inside = []
+    both = threading.Event()
+
+    def read():
+        with lock.reading():
+            inside.append(1)
+            if len(inside) == 2:
+                both.set()
+            # Both readers hold the lock at the same time
+            assert both.wait(5)
+
+    run_threads(read, read)
+
+
+def test_rwlock_exclusive_writes():
+    lock = RWLock()
+    events = []
+
+    def write():
+        with lock.writing():
+            events.append('start')
+            time.sleep(0.01)
+            events.append('end')
+
+    def read():
+        with lock.reading():
+            events.append('read')
+
+    run_threads(write, read, write)
+
+    # Nothing happened while a writer held the lock
+    for i, event in enumerate(events):
+        if event == 'start':
+            assert events[i + 1] == 'end'
+
+
+def test_rwlock_reentrant():
+    lock = RWLock()
+
+    with lock.writing():
+        with lock.writing():
+            with lock.reading():
+                pass
+
+    with lock.reading():
+        with lock.reading():
+            with pytest.raises(RuntimeError):
+                lock.acquire_write()
+
+    # Released completely
+    with lock.writing():
+        pass
+
+
+@pytest.mark.parametrize('storage', ['memory', 'json'])
+def test_concurrent_access(storage, tmpdir):
+    if storage == 'json':
+        db = PuchkiDB(str(tmpdir.join('db.json')), storage=JSONStorage)
+    else:
+        db = PuchkiDB(storage=MemoryStorage)
+
+    names = ['a', 'b']
+    for name in names:
+        db.table(name).create_index('n')
+
+    errors = []
+
+    def writer(name, start):
+        def write():
+            table = db.table(name)
+            for i in range(start, start + 50):
+                table.insert({'n': i})
+                table.update({'seen': True}, where('n') == i)
+        return write
+
+    def reader(name):
+        def read():
+            table = db.table(name)
+            try:
+                for _ in range(50):
+                    found = table.search(where('n') >= 0)
+                    assert all('n' in doc for doc in found)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+        return read
+
+    run_threads(*([writer(name, start) for name in names
+                   for start in (0, 1000)] +
+                  [reader(name) for name in names]))
+
+    assert not errors
+    for name in names:
+        table = db.table(name)
+        # No write got lost, neither within a table nor between tables
+        assert len(table) == 100
+        assert table.count(where('seen') == True) == 100  # noqa: E712
+        assert sorted(doc['n'] for doc in table.search(where('n') >= 0)) \
+            == list(range(50)) + list(range(1000, 1050))
+
+    db.close()
@@ -1,6 +1,6 @@
 import os
 
-from puchkidb import PuchkiDB
+from puchkidb import PuchkiDB, where
 from puchkidb.middlewares import CachingMiddleware
 from puchkidb.storages import MemoryStorage, JSONStorage
 
@@ -107,3 +107,20 @@ def test_caching_json_write(tmpdir):
     # Repoen database
     with PuchkiDB(path, storage=CachingMiddleware(JSONStorage)) as db:
         assert db.all() == [{'key': 'value'}]
+
+
+def test_caching_unflushed_indexes(tmpdir):
+    path = str(tmpdir.join('test.db'))
+
+    db = PuchkiDB(path, storage=CachingMiddleware(JSONStorage))
+    db.insert({'status': 'open'})
+    db._storage.flush()
+
+    db.update({'status': 'closed'})
+    db.create_index('status', 'bitmap')
+    assert db.search(where('status') == 'closed') == [{'status': 'closed'}]
+    # Exits without flushing the update
+
+    db = PuchkiDB(path, storage=CachingMiddleware(JSONStorage))
+    db.create_index('status', 'bitmap')
+    assert db.search(where('status') == 'open') == [{'status': 'open'}]
@@ -0,0 +1,184 @@
+from puchkidb import PuchkiDB, where
+from puchkidb.planner import (Statistics, cost, normalize, reorder,
+                              selectivity)
+from puchkidb.queries import Query, query_node
+from puchkidb.storages import MemoryStorage
+
+
+def ops(node):
+    return [child.op for child in node.children]
+
+
+def test_reorder_by_cost():
+    query = where('name').matches('^J') & (where('age') == 42)
+    assert ops(reorder(query_node(query))) == ['==', 'matches']
+
+    query = where('age').test(lambda age: age > 18) | where('name').exists()
+    assert ops(reorder(query_node(query))) == ['exists', 'test']
+
+
+def test_reorder_by_selectivity():
+    # An 'and' starts with the test most likely to fail ...
+    query = (where('a') != 1) & (where('b') == 1)
+    assert ops(reorder(query_node(query))) == ['==', '!=']
+
+    # ... an 'or' with the test most likely to succeed
+    query = (where('a') == 1) | (where('b') != 1)
+    assert ops(reorder(query_node(query))) == ['!=', '==']
+
+
+def test_reorder_chains():
+    query = ((where('a').search('x') & (where('b') == 1)) &
+             (where('c').matches('y') | (where('d') == 1)))
+    node = reorder(query_node(query))
+
+    # Tests that may raise stay behind the tests written before them
+    assert ops(node) == ['==', 'search', 'or']
+    assert ops(node.children[2]) == ['==', 'matches']
+
+
+def test_reorder_keeps_written_order():
+    query = (where('a') == 1) & (where('b') == 1) & (where('c') == 1)
+    node = reorder(query_node(query))
+
+    assert [child.path for child in node.children] == [('a', ), ('b', ),
+                                                        ('c', )]
+
+
+def test_reorder_keeps_guards(db):
+    table = db.table('values')
+    table.insert_multiple({'type': 'num', 'val': i} for i in range(60))
+    table.insert({'type': 'str', 'val': 'abc'})
+
+    is_num = where('type') == 'num'
+    node = reorder(query_node(is_num & (where('val') > 5)))
+    assert ops(node) == ['==', '>']
+
+    for _ in range(3):
+        assert table.count(is_num & (where('val') > 5)) == 54
+        assert table.count(is_num & where('val').test(
+            lambda value: value + 1 > 5)) == 55
+        assert len(table.search(is_num & (where('val') > 5))) == 54
+
+
+def test_cost_and_selectivity():
+    cheap = query_node(where('a') == 1)
+    expensive = query_node(where('a').search('x'))
+    both = query_node((where('a') == 1) & where('a').search('x'))
+
+    assert cost(cheap) < cost(expensive)
+    assert cost(both) < cost(cheap) + cost(expensive)
+    assert selectivity(both) < selectivity(cheap)
+
+
+def test_observed_selectivity():
+    stats = Statistics()
+    rare = query_node(where('a') != 1)
+    common = query_node(where('b') == 1)
+
+    stats.observe(rare, 100, 1)
+    stats.observe(common, 100, 99)
+    assert stats.selectivity(rare) == 0.01
+
+    query = (where('a') != 1) & (where('b') == 1)
+    assert ops(reorder(query_node(query), stats)) == ['!=', '==']
+
+
+def test_sample():
+    stats = Statistics()
+    docs = [{'a': i % 10} for i in range(100)]
+    node = query_node((where('a') == 1) & Query().a.exists())
+
+    assert stats.wants(node)
+    stats.sample(node, iter(docs))
+
+    assert stats.selectivity(node.children[0]) == 0.1
+    assert stats.selectivity(node.children[1]) == 1.0
+
+    # Later samples test the following documents until all are tested
+    docs[50:] = [{'a': 1}] * 50
+    stats.sample(node, iter(docs))
+    assert stats.selectivity(node.children[0]) == 0.55
+    stats.sample(node, iter(docs))
+    assert not stats.wants(node)
+
+
+def test_normalize_flattens():
+    query = ((where('a') == 1) & ((where('b') == 2) & (where('a') == 1))) | \
+        ((where('c') == 3) | (where('d') == 4))
+    node = normalize(query_node(query))
+
+    assert ops(node) == ['and', '==', '==']
+    assert [child.path for child in node.children[0].children] == [('a', ),
+                                                                    ('b', )]
+
+
+def test_normalize_ranges():
+    query = (where('a') > 1) & (where('b') == 1) & (where('a') <= 5) & \
+        (where('a') >= 2)
+    node = normalize(query_node(query))
+
+    assert ops(node) == ['between', '==']
+    assert node.children[0].operand == (2, True, 5, True)
+
+    # Only tight bounds are kept
+    node = normalize(query_node((where('a') < 5) & (where('a') <= 3)))
+    assert (node.op, node.operand) == ('<=', 3)
+
+    # Strings and numbers are not compared
+    node = normalize(query_node((where('a') < 5) & (where('a') < 'x')))
+    assert ops(node) == ['<', '<']
+
+    query = (where('b') <= 'a') & (where('b') > 1.5)
+    node = normalize(query_node(query))
+    assert ops(node) == ['<=', '>']
+
+    # The first test fails before the second one could raise
+    db = PuchkiDB(storage=MemoryStorage)
+    db.insert({'b': 'xyz'})
+    assert db.search(query) == []
+
+
+def test_normalize_negations():
+    query = ~((where('a') == 1) & ~(where('b') < 2))
+    node = normalize(query_node(query))
+
+    assert ops(node) == ['not', '<']
+    assert node.children[0].children[0].op == '=='
+
+
+def test_normalize_one_of():
+    node = normalize(query_node(where('a').one_of([1, 2])))
+    assert node.operand == frozenset([1, 2])
+
+    node = normalize(query_node(where('a').one_of([[1], 2])))
+    assert node.operand == [[1], 2]
+
+    node = normalize(query_node(where('a').one_of('abc')))
+    assert node.operand == 'abc'
+
+
+def test_table_reorders_tests():
+    db = PuchkiDB(storage=MemoryStorage)
+    db.insert_multiple({'int': i, 'text': 'value {}'.format(i)}
+                       for i in range(200))
+    calls = []
+
+    def expensive(value):
+        calls.append(value)
+        return value.endswith('7')
+
+    # Tests that can't raise run before the callable written in front of
+    # them
+    query = (where('text').test(expensive) &
+             where('int').one_of(range(100, 200)) &
+             (where('text') != 'value 107'))
+    expected = [doc for doc in db.all()
+                if doc['int'] >= 100 and doc['text'] != 'value 107' and
+                doc['text'].endswith('7')]
+
+    assert db.search(query) == expected
+
+    # The callable runs only for documents the other tests matched, apart
+    # from the sample estimating how many documents it matches
+    assert len(calls) < 200
@@ -1,6 +1,7 @@
 import pytest
 import re
-from puchkidb.queries import Query, where
+import sys
+from puchkidb.queries import Query, QueryImpl, query_node, where
 
 
 def test_no_path():
@@ -166,6 +167,33 @@ def test_regex():
     assert hash(query)
 
 
+def test_regex_prefilter():
+    query = Query().val.matches(r'error: .* timed out')
+
+    assert query({'val': 'error: request timed out'})
+    assert not query({'val': 'warning: request timed out'})
+    assert not query({'val': 'error: request failed'})
+    with pytest.raises(TypeError):
+        query({'val': 42})
+
+    query = Query().val.search(r'time[ds] out')
+    assert query({'val': 'request timed out'})
+    assert not query({'val': 'request failed'})
+
+    # Invalid expressions fail when the query is run
+    query = Query().val.search(r'(')
+    with pytest.raises(re.error):
+        query({'val': ''})
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11),
+                    reason="Atomic groups are new in Python 3.11")
+def test_regex_atomic_group():
+    query = Query().val.search(r'(?>abc)d')
+    assert query({'val': 'xabcd'})
+    assert not query({'val': 'abc d'})
+
+
 def test_custom():
     def test(value):
         return value == 42
@@ -328,6 +356,17 @@ def test_one_of():
     assert query({'key1': 'value 2'})
     assert not query({'key1': 'value 3'})
 
+    query = Query().key1.one_of(value for value in ('value 1', ['value 2']))
+    assert query({'key1': 'value 1'})
+    assert query({'key1': ['value 2']})
+    assert query({'key1': 'value 1'})
+
+    # Strings are looked for as substrings
+    query = Query().key1.one_of('abc')
+    assert query({'key1': 'ab'})
+    assert query({'key1': 'c'})
+    assert not query({'key1': 'ac'})
+
 
 def test_hash():
     d = {
@@ -363,3 +402,33 @@ def test_repr():
 
     assert repr(Fruit) == "Query()"
     assert repr(Fruit.type == 'peach') == "QueryImpl('==', ('type',), 'peach')"
+
+
+def test_query_tree():
+    query = (where('a') == [1]) & ~where('b').c.matches(r'\d+', re.I)
+
+    node = query._node
+    assert node.op == 'and'
+
+    eq, inverted = node.children
+    assert (eq.op, eq.path, eq.operand) == ('==', ('a', ), [1])
+    assert inverted.op == 'not'
+
+    matches, = inverted.children
+    assert (matches.op, matches.path) == ('matches', ('b', 'c'))
+    assert matches.operand == (r'\d+', re.I)
+
+    assert [n.op for n in node.walk()] == ['and', '==', 'not', 'matches']
+
+    path = Query().a.b
+    assert (path._node.op, path._node.path) == ('path', ('a', 'b'))
+    assert Query()['node']._node.path == ('node', )
+
+
+def test_query_tree_opaque():
+    opaque = QueryImpl(lambda value: True, ('opaque', ))
+    node = query_node(opaque | (where('a') == 1))
+
+    assert node.op == 'or'
+    assert node.children[0].op == 'call'
+    assert node.children[0].operand is opaque
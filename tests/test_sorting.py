@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from puchkidb import Query
+from puchkidb.sorting import external_sort, sort_key, sort_spec, top_k
+
+
+def test_sort_spec():
+    assert sort_spec('ts') == [(('ts', ), False)]
+    assert sort_spec(('ts', 'desc')) == [(('ts', ), True)]
+    assert sort_spec([('ts', 'desc'), Query().user.name]) == \
+        [(('ts', ), True), (('user', 'name'), False)]
+
+    with pytest.raises(ValueError):
+        sort_spec([('ts', 'up')])
+    with pytest.raises(ValueError):
+        sort_spec([])
+
+
+def test_sort_key():
+    docs = [{'v': 'b'}, {'v': 2}, {}, {'v': None}, {'v': 'a'}, {'v': 1},
+            {'v': 1.0}, {'v': [1]}]
+
+    def order(spec):
+        key = sort_key(sort_spec(spec))
+        return [k[-1] for k in sorted(key(i, doc)
+                                      for i, doc in enumerate(docs))]
+
+    # Numbers, strings, values that can't be ordered, missing values
+    assert order('v') == [5, 6, 1, 4, 0, 3, 7, 2]
+    assert order(('v', 'desc')) == [0, 4, 1, 5, 6, 3, 7, 2]
+
+
+def test_top_k():
+    keys = [(random.random(), i) for i in range(1000)]
+    assert top_k(iter(keys), 10) == sorted(keys)[:10]
+
+
+def test_external_sort():
+    keys = [(random.random(), i) for i in range(1000)]
+
+    assert list(external_sort(iter(keys))) == sorted(keys)
+    # Sorted in runs stored in temporary files
+    assert list(external_sort(iter(keys), buffer_size=64)) == sorted(keys)
+
+
+def test_external_sort_descending():
+    key = sort_key(sort_spec([('name', 'desc')]))
+    keys = [key(i, {'name': 'name {}'.format(i % 50)}) for i in range(300)]
+
+    assert list(external_sort(iter(keys), buffer_size=32)) == sorted(keys)
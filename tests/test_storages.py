@@ -9,6 +9,7 @@ import pytest
 
 from puchkidb import PuchkiDB, where
 from puchkidb.database import Document
+from puchkidb import storages
 from puchkidb.storages import JSONStorage, MemoryStorage, Storage, touch
 
 random.seed()
@@ -256,3 +257,134 @@ def test_encoding(tmpdir):
 
     jap_storage = JSONStorage(path, encoding="cp936")
     assert japanese_doc == jap_storage.read()
+
+
+def test_json_generation(tmpdir, monkeypatch):
+    digests = []
+    digest = storages._digest
+    monkeypatch.setattr(storages, '_digest',
+                        lambda text: digests.append(text) or digest(text))
+
+    storage = JSONStorage(str(tmpdir.join('test.db')))
+    storage.write({'a': 1})
+    for _ in range(3):
+        storage.read()
+    # Only hashed once the generation is needed
+    assert digests == []
+
+    generation = storage.generation
+    assert generation == storage.generation
+    assert len(digests) == 1
+
+    storage.write({'a': 2})
+    assert storage.generation != generation
+
+
+needs_fcntl = pytest.mark.skipif(storages.fcntl is None,
+                                 reason='needs fcntl')
+
+
+@needs_fcntl
+def test_json_locking(tmpdir):
+    path = str(tmpdir.join('test.db'))
+    first = JSONStorage(path, locking=True)
+    second = JSONStorage(path, locking=True)
+
+    first.write({'a': 1})
+    assert second.read() == {'a': 1}
+    # Not parsed again as long as nobody writes
+    assert second.read() is second.read()
+    assert not second.refresh()
+
+    # Written right away with the same size and modification time
+    first.write({'a': 2})
+    assert second.refresh()
+    assert second.external_writes == 1
+    assert second.read() == {'a': 2}
+
+    # Own writes don't count
+    second.write({'a': 3})
+    assert not second.refresh()
+    assert second.read() == {'a': 3}
+    assert second.external_writes == 1
+
+    with first.exclusive():
+        with first.exclusive():
+            assert first.read() == {'a': 3}
+
+    first.close()
+    second.close()
+
+
+@needs_fcntl
+def test_json_locking_reads_once(tmpdir, monkeypatch):
+    path = str(tmpdir.join('test.db'))
+    first = JSONStorage(path, locking=True)
+    second = JSONStorage(path, locking=True)
+    first.write({'a': 1})
+    second.read()
+
+    reads = []
+    read_text = JSONStorage._read_text
+    monkeypatch.setattr(JSONStorage, '_read_text',
+                        lambda self: reads.append(1) or read_text(self))
+
+    # Within the racy window, checking for changes reads the file, the
+    # read following the check doesn't read it again
+    first.write({'a': 2})
+    assert second.refresh()
+    assert second.read() == {'a': 2}
+    assert not second.refresh()
+    assert second.read() == {'a': 2}
+    assert len(reads) == 2
+
+    first.close()
+    second.close()
+
+
+@needs_fcntl
+def test_json_locking_databases(tmpdir):
+    path = str(tmpdir.join('test.db'))
+    first = PuchkiDB(path, locking=True)
+    second = PuchkiDB(path, locking=True)
+
+    first.insert({'int': 1})
+    assert second.search(where('int') == 1) == [{'int': 1}]
+
+    # The cached result and the last ID are noticed to be outdated
+    first.insert({'int': 1})
+    assert len(second.search(where('int') == 1)) == 2
+    assert second.insert({'int': 2}) == 3
+
+    first.table('other').insert({'int': 3})
+    assert second.table('other').all() == [{'int': 3}]
+    assert first.count(where('int') > 0) == 3
+
+    first.close()
+    second.close()
+
+
+def _insert_many(path, worker):
+    with PuchkiDB(path, locking=True) as db:
+        for i in range(50):
+            db.insert({'worker': worker, 'i': i})
+
+
+@needs_fcntl
+def test_json_locking_processes(tmpdir):
+    multiprocessing = pytest.importorskip('multiprocessing')
+    path = str(tmpdir.join('test.db'))
+    PuchkiDB(path).close()
+
+    processes = [multiprocessing.Process(target=_insert_many,
+                                         args=(path, worker))
+                 for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with PuchkiDB(path) as db:
+        assert len(db) == 200
+        assert sorted(doc.doc_id for doc in db) == list(range(1, 201))
@@ -1,7 +1,8 @@
+import datetime
 import pytest
 import re
 
-from puchkidb import where
+from puchkidb import PuchkiDB, where
 
 
 def test_tables_list(db):
@@ -66,10 +67,39 @@ def test_query_cache_size(db):
     table.insert({'int': 1})
     table.insert({'int': 1})
 
-    assert table.count(query) == 2
-    assert table.count(where('int') == 2) == 0
+    assert len(table.search(query)) == 2
+    assert len(table.search(where('int') == 2)) == 0
     assert len(table._query_cache) == 1
 
+    # Counting doesn't create documents to cache
+    table.clear_cache()
+    assert table.count(query) == 2
+    assert len(table._query_cache) == 0
+
+
+def test_cache_stats(db):
+    table = db.table('table3', cache_bytes=10 ** 6)
+    table.insert({'int': 1})
+
+    # Queries matching nothing are answered from the cache as well
+    tested = []
+    query = where('int').test(lambda value: tested.append(value) or False)
+    assert table.search(query) == []
+    del tested[:]
+    assert table.search(query) == []
+    assert table.count(query) == 0
+    assert not tested
+
+    stats = table.cache_stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 1, 1)
+    assert 0 < stats['bytes'] <= 10 ** 6
+
+    # Counts don't cache their results, so they don't count as misses
+    assert table.count(where('int') == 1) == 1
+    assert table.count_many([where('int') == 2]) == [0]
+    assert list(table.search_iter(where('int') == 3)) == []
+    assert table.cache_stats()['misses'] == 1
+
 
 def test_lru_cache(db):
     # Test integration into PuchkiDB
@@ -81,16 +111,58 @@ def test_lru_cache(db):
     table.search(where('int') == 3)
     assert query not in table._query_cache
 
+    # Writes keep the cached results instead of dropping them
     table.remove(where('int') == 1)
-    assert not table._query_cache.lru
+    assert table._query_cache.lru == [where('int') == 2, where('int') == 3]
 
     table.search(query)
 
-    assert len(table._query_cache) == 1
+    assert len(table._query_cache) == 2
     table.clear_cache()
     assert len(table._query_cache) == 0
 
 
+def test_cache_maintained_on_writes(db):
+    table = db.table('table3')
+    table.insert_multiple({'int': i % 3, 'char': c} for i, c in
+                          enumerate('abcdefgh'))
+    queries = [where('int') == 1, where('char') > 'd', where('int') == 5]
+    for query in queries:
+        table.search(query)
+
+    def check():
+        cached = [table._query_cache.get(query, []) for query in queries]
+        table.clear_cache()
+        assert cached == [table.search(query) for query in queries]
+        for query in queries:
+            table.search(query)
+
+    table.insert({'int': 1, 'char': 'z'})
+    check()
+
+    table.update({'int': 5}, where('char') == 'e')
+    check()
+
+    table.update({'int': 1}, doc_ids=[1])
+    check()
+
+    table.remove(where('char') == 'g')
+    check()
+
+    table.write_back([{'int': 5, 'char': 'g'}], doc_ids=[7])
+    check()
+
+    # Only the changed documents are tested
+    tested = []
+    query = where('int').test(lambda value: tested.append(value) or True)
+    docs = table.search(query)
+    del tested[:]
+
+    table.insert({'int': 42})
+    assert tested == [42]
+    assert len(table.search(query)) == len(docs) + 1
+
+
 def test_table_is_iterable(db):
     table = db.table('table1')
 
@@ -117,3 +189,17 @@ def test_table_repr(db):
         r"<Table name=\'table4\', total=0, "
         "storage=<puchkidb\.database\.StorageProxy object at [a-zA-Z0-9]+>>",
         repr(table))
+
+
+def test_cache_after_failed_write(tmpdir):
+    db = PuchkiDB(str(tmpdir.join('db.json')))
+    db.insert({'k': 1})
+    assert db.search(where('k') == 1) == [{'k': 1}]
+
+    # Dates can't be stored as JSON
+    with pytest.raises(TypeError):
+        db.insert({'k': 1, 'd': datetime.date.today()})
+
+    assert db.search(where('k') == 1) == [{'k': 1}]
+    assert db.all() == [{'k': 1}]
+    db.close()
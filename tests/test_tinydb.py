@@ -1,10 +1,13 @@
 # coding=utf-8
+import datetime
 import sys
 import re
+import threading
 
 import pytest
 
-from puchkidb import PuchkiDB, where
+from puchkidb import PuchkiDB, Query, VersionConflict, where
+from puchkidb.queries import QueryImpl
 from puchkidb.storages import MemoryStorage
 from puchkidb.middlewares import Middleware
 
@@ -319,6 +322,133 @@ def test_search_no_results_cache(db):
     assert len(db.search(where('missing'))) == 0
 
 
+def test_search_limit(db):
+    db.insert_multiple({'int': 2, 'char': c} for c in 'defg')
+    query = where('int') == 2
+
+    assert [doc['char'] for doc in db.search(query, limit=2)] == ['d', 'e']
+    assert [doc['char'] for doc in db.search(query, limit=2, offset=3)] == \
+        ['g']
+    assert [doc['char'] for doc in db.search(query, offset=1)] == \
+        ['e', 'f', 'g']
+
+    # Only full results are cached, but limits are applied to them
+    assert not db._query_cache
+    assert len(db.search(query)) == 4
+    assert [doc['char'] for doc in db.search(query, limit=1, offset=1)] == \
+        ['e']
+
+
+def test_search_iter(db):
+    db.insert_multiple({'int': i} for i in range(1000))
+    tested = []
+
+    def test(value):
+        tested.append(value)
+        return True
+
+    found = db.search_iter(where('int').test(test))
+    first = next(found)
+
+    assert first == {'int': 1, 'char': 'a'}
+    assert first.doc_id == 1
+
+    # Apart from a small sample estimating its selectivity, the test only
+    # ran for the first document
+    assert len(tested) < 100
+
+    assert len(list(found)) == 1002
+
+
+def test_search_limit_indexed(db):
+    db.insert_multiple({'int': i} for i in range(100))
+    db.create_index('int')
+
+    docs = db.search(where('int') >= 10, limit=5, offset=2)
+    assert [doc['int'] for doc in docs] == [12, 13, 14, 15, 16]
+
+
+def test_search_order_by(db):
+    db.purge()
+    db.insert_multiple({'ts': ts % 7, 'name': 'doc {}'.format(ts)}
+                       for ts in range(20))
+    db.insert({'name': 'no ts'})
+    docs = db.all()
+
+    def expected(reverse):
+        return [doc.doc_id for doc in sorted(
+            docs[:20], key=lambda doc: -doc['ts'] if reverse else doc['ts'])]
+
+    query = where('name').exists()
+    found = db.search(query, order_by='ts')
+    assert [doc.doc_id for doc in found] == expected(False) + [21]
+
+    found = db.search(query, order_by=[('ts', 'desc')])
+    assert [doc.doc_id for doc in found] == expected(True) + [21]
+
+    # Top-k selection
+    found = db.search(query, order_by=[('ts', 'desc')], limit=3, offset=2)
+    assert [doc.doc_id for doc in found] == expected(True)[2:5]
+
+    found = db.search(query, order_by=[('ts', 'desc'), ('name', 'desc')],
+                      limit=3)
+    assert [doc['name'] for doc in found] == ['doc 6', 'doc 13', 'doc 5']
+
+    # Streamed from a sorted index
+    searches = [(cond, order_by, limit)
+                for cond in (query, where('ts') > 3)
+                for order_by in ('ts', ('ts', 'desc'))
+                for limit in (None, 4)]
+    expected = [db.search(cond, order_by=order_by, limit=limit)
+                for cond, order_by, limit in searches]
+
+    db.create_index('ts')
+    assert [db.search(cond, order_by=order_by, limit=limit)
+            for cond, order_by, limit in searches] == expected
+
+    found = list(db.search_iter(where('ts') < 2, order_by='ts'))
+    assert [doc['ts'] for doc in found] == [0, 0, 0, 1, 1, 1]
+
+
+def test_search_fields(db):
+    db.purge()
+    db.insert_multiple({'name': name, 'age': age, 'address': {
+        'city': city, 'zip': 700000 + age}}
+        for name, age, city in [('John', 22, 'Kolkata'), ('Bob', 42, 'Pune'),
+                                ('Jane', 37, 'Kolkata')])
+    User = Query()
+
+    found = db.search(User.address.city == 'Kolkata',
+                      fields=['name', User.address.zip])
+    assert found == [{'name': 'John', 'address': {'zip': 700022}},
+                     {'name': 'Jane', 'address': {'zip': 700037}}]
+    assert [doc.doc_id for doc in found] == [1, 3]
+
+    # Projected documents are copies
+    found[0]['address']['zip'] = 0
+    assert db.get(doc_id=1)['address']['zip'] == 700022
+
+    assert db.search(User.age > 30, fields='name', order_by='age',
+                     limit=1) == [{'name': 'Jane'}]
+    assert db.get(User.name == 'Bob', fields=['age', 'missing']) == \
+        {'age': 42}
+    assert db.get(doc_id=2, fields=['address', User.address.city]) == \
+        {'address': {'city': 'Pune', 'zip': 700042}}
+    assert db.all(fields='age') == [{'age': 22}, {'age': 42}, {'age': 37}]
+
+    # Projected from cached results
+    db.search(User.age > 30)
+    assert db.search(User.age > 30, fields='age') == [{'age': 42},
+                                                      {'age': 37}]
+
+
+def test_search_documents(db):
+    # Queries testing whole documents get Document objects
+    query = where('int').exists() & \
+        QueryImpl(lambda doc: doc.doc_id > 1, ('doc_id', ))
+    assert [doc.doc_id for doc in db.search(query)] == [2, 3]
+
+
 def test_get(db):
     item = db.get(where('char') == 'b')
     assert item['char'] == 'b'
@@ -767,6 +897,9 @@ def test_string_key2():
     assert table.get(doc_id='1')['abc'] == 10
     assert table._last_id == 1
 
+    # Reset default storage proxy class
+    PuchkiDB.storage_proxy_class = StorageProxy
+
 
 def test_repr(tmpdir):
     path = str(tmpdir.join('db.json'))
@@ -785,3 +918,369 @@ def test_insert_multiple_with_single_dict(db):
         d = {'first': 'John', 'last': 'smith'}
         db.insert_multiple(d)
         db.close()
+
+
+def test_aggregate(db):
+    db.purge()
+    db.insert_multiple([
+        {'country': 'IN', 'amount': 100, 'paid': True},
+        {'country': 'US', 'amount': 20, 'paid': True},
+        {'country': 'IN', 'amount': 50, 'paid': False},
+        {'country': 'IN', 'amount': 'n/a', 'paid': True},
+        {'amount': 5, 'paid': True},
+    ])
+    paid = where('paid') == True  # noqa: E712
+
+    assert db.aggregate(paid) == {'count': 4}
+    assert db.aggregate() == {'count': 5}
+    assert db.aggregate(paid, sum='amount', avg=['amount'], min='amount',
+                        max='amount', count=True) == {
+        'count': 4,
+        'sum': {'amount': 125},
+        'min': {'amount': 5},
+        'max': {'amount': 'n/a'},
+        'avg': {'amount': 125 / 3.0},
+    }
+
+    assert db.aggregate(paid, group_by='country', sum='amount') == [
+        {'country': 'IN', 'sum': {'amount': 100}},
+        {'country': 'US', 'sum': {'amount': 20}},
+        {'country': None, 'sum': {'amount': 5}},
+    ]
+    assert db.aggregate(group_by=['country', where('paid')],
+                        max='amount') == [
+        {'country': 'IN', 'paid': True, 'max': {'amount': 'n/a'}},
+        {'country': 'US', 'paid': True, 'max': {'amount': 20}},
+        {'country': 'IN', 'paid': False, 'max': {'amount': 50}},
+        {'country': None, 'paid': True, 'max': {'amount': 5}},
+    ]
+    assert db.aggregate(where('paid') == 'never', sum='amount', min='amount',
+                        avg='amount') == {
+        'sum': {'amount': 0}, 'min': {'amount': None},
+        'avg': {'amount': None}}
+
+    with pytest.raises(TypeError):
+        db.aggregate(median='amount')
+
+
+def test_aggregate_indexed_counts(db):
+    db.purge()
+    countries = 'IN US IN UK IN US'.split()
+    db.insert_multiple({'country': country, 'paid': i % 2 == 0}
+                       for i, country in enumerate(countries))
+    db.insert({'paid': True})
+
+    expected = db.aggregate(where('paid') == True,  # noqa: E712
+                            group_by='country')
+    assert expected == [{'country': 'IN', 'count': 3},
+                        {'country': None, 'count': 1}]
+
+    db.create_index('country', 'bitmap')
+    db.create_index('paid', 'bitmap')
+
+    def fail(value):
+        raise AssertionError('query should not be run')
+
+    # Counted by the indexes alone
+    query = where('paid') == True  # noqa: E712
+    query._test = fail
+    query._node = None
+    assert db.aggregate(query, group_by='country') == expected
+    assert db.aggregate(group_by='country') == [
+        {'country': 'IN', 'count': 3}, {'country': 'US', 'count': 2},
+        {'country': 'UK', 'count': 1}, {'country': None, 'count': 1}]
+
+
+def test_search_many(db):
+    db.insert_multiple({'int': i, 'char': 'abc'[i % 3]} for i in range(100))
+    conds = [where('int') < 10, where('char') == 'b',
+             (where('int') == 1) & (where('char') == 'a'),
+             where('char') == 'x']
+    expected = [db.search(cond) for cond in conds]
+    db.clear_cache()
+
+    assert db.search_many(conds) == expected
+    assert db.count_many(conds) == [len(docs) for docs in expected]
+
+    # Cached like single searches
+    assert db.search(conds[0]) == expected[0]
+
+    query = where('int') == 1
+    query._test = fail_test
+    query._node = None
+    db._query_cache[query] = expected[2]
+    assert db.search_many([query]) == [expected[2]]
+
+    # Queries testing whole documents get Document objects
+    query = QueryImpl(lambda doc: doc.doc_id == 2, ('doc_id', ))
+    docs, = db.search_many([query])
+    assert [doc.doc_id for doc in docs] == [2]
+
+
+def test_search_many_indexed(db):
+    db.insert_multiple({'int': i} for i in range(100))
+    conds = [where('int') >= 95, where('int') == 1, where('char') == 'c']
+    expected = [db.search(cond) for cond in conds]
+
+    db.create_index('int')
+    db.clear_cache()
+    assert db.search_many(conds) == expected
+    assert db.count_many(conds) == [len(docs) for docs in expected]
+
+
+def fail_test(value):
+    raise AssertionError('query should not be run')
+
+
+def join_db():
+    db = PuchkiDB(storage=MemoryStorage)
+    db.table('users').insert_multiple(
+        {'id': i, 'name': name} for i, name in enumerate(['John', 'Bob',
+                                                          'Ann']))
+    db.table('orders').insert_multiple([
+        {'user_id': 1, 'total': 120},
+        {'user_id': 0, 'total': 80},
+        {'user_id': 7, 'total': 300},
+        {'total': 50},
+        {'user_id': 1, 'total': 200},
+    ])
+
+    return db
+
+
+def joined(pairs):
+    return [(left['total'], right and right['name']) for left, right in pairs]
+
+
+@pytest.mark.parametrize('index', [None, 'users', 'orders'])
+def test_join(index):
+    db = join_db()
+    if index == 'users':
+        db.table('users').create_index('id', 'bitmap')
+    elif index == 'orders':
+        db.table('orders').create_index('user_id')
+
+    pairs = db.join('orders', 'users', on=('user_id', 'id'))
+    assert joined(pairs) == [(120, 'Bob'), (80, 'John'), (200, 'Bob')]
+    assert pairs[0][0].doc_id == 1
+    assert pairs[0][1].doc_id == 2
+
+    pairs = db.join(db.table('orders'), db.table('users'),
+                    on=('user_id', 'id'), how='left')
+    assert joined(pairs) == [(120, 'Bob'), (80, 'John'), (300, None),
+                             (50, None), (200, 'Bob')]
+
+    pairs = db.join('orders', 'users', on=(where('user_id'), 'id'),
+                    where=where('total') > 100)
+    assert joined(pairs) == [(120, 'Bob'), (200, 'Bob')]
+
+    pairs = db.join('orders', 'users', on=('user_id', 'id'),
+                    where=(where('total') < 150, where('name') == 'Bob'))
+    assert joined(pairs) == [(120, 'Bob')]
+
+    # Joining a smaller table with a larger one
+    pairs = db.join('users', 'orders', on=('id', 'user_id'), how='left')
+    assert [(left['name'], right and right['total'])
+            for left, right in pairs] == [('John', 80), ('Bob', 120),
+                                          ('Bob', 200), ('Ann', None)]
+
+    with pytest.raises(ValueError):
+        db.join('orders', 'users', on='id', how='outer')
+
+
+def test_join_index_lookups():
+    db = join_db()
+    users = db.table('users')
+    users.insert_multiple({'id': i} for i in range(3, 100))
+    users.create_index('id')
+
+    calls = []
+    query = where('name').test(lambda name: calls.append(name) or True)
+
+    pairs = db.join('orders', 'users', on=('user_id', 'id'),
+                    where=(None, query))
+    assert joined(pairs) == [(120, 'Bob'), (80, 'John'), (200, 'Bob')]
+
+    # Only the partners looked up in the index have been tested
+    assert calls == ['Bob', 'John', 'Bob']
+
+
+def test_shared_query_cache():
+    from puchkidb.cache import QueryCache
+
+    cache = QueryCache(capacity=4)
+    db = PuchkiDB(storage=MemoryStorage, query_cache=cache)
+    users, orders = db.table('users'), db.table('orders')
+    users.insert_multiple({'id': i} for i in range(10))
+    orders.insert_multiple({'user_id': i % 3} for i in range(10))
+
+    for i in range(3):
+        users.search(where('id') == i)
+    orders.search(where('user_id') == 1)
+    assert cache.stats()['entries'] == 4
+
+    # Writes only affect the results of their table
+    orders.purge()
+    assert orders.cache_stats()['entries'] == 0
+    assert users.cache_stats()['entries'] == 3
+
+    # The tables queried most keep most of the results
+    for i in range(3, 6):
+        users.search(where('id') == i)
+    assert users.cache_stats()['entries'] == 4
+
+    db.purge_table('users')
+    assert cache.stats()['entries'] == 0
+    assert db.table('users').search(where('id') == 1) == []
+
+
+def test_query_cache_shared_by_databases():
+    from puchkidb.cache import QueryCache
+
+    cache = QueryCache()
+    db1 = PuchkiDB(storage=MemoryStorage, query_cache=cache)
+    db2 = PuchkiDB(storage=MemoryStorage, query_cache=cache)
+    db1.insert({'int': 1})
+    db2.insert({'int': 2})
+
+    assert db1.search(where('int') > 0) == [{'int': 1}]
+    assert db2.search(where('int') > 0) == [{'int': 2}]
+
+    # Purging a database leaves the results of the other one alone
+    db2.purge_tables()
+    assert cache.stats()['entries'] == 1
+    assert db1.search(where('int') > 0) == [{'int': 1}]
+
+
+def test_snapshot(db):
+    db.table('other').insert({'int': 4})
+
+    with db.snapshot() as snap:
+        docs = iter(snap)
+        assert next(docs) == {'int': 1, 'char': 'a'}
+
+        # Writers aren't blocked and don't change what the snapshot sees
+        db.insert({'int': 2, 'char': 'd'})
+        db.update({'int': 3}, where('char') == 'b')
+        db.remove(where('char') == 'c')
+        db.table('other').purge()
+        db.table('new').insert({'int': 5})
+
+        assert list(docs) == [{'int': 1, 'char': 'b'},
+                              {'int': 1, 'char': 'c'}]
+        assert len(snap) == 3
+        assert snap.count(where('int') == 1) == 3
+        assert snap.get(doc_id=2) == {'int': 1, 'char': 'b'}
+        assert 3 in snap.table()
+        assert snap.table('other').all() == [{'int': 4}]
+        assert snap.table('new').all() == []
+        assert snap.tables() == {'_default', 'other'}
+
+        with pytest.raises(RuntimeError):
+            snap.insert({'int': 6})
+        with pytest.raises(RuntimeError):
+            snap.table('other').update({'int': 6})
+        with pytest.raises(RuntimeError):
+            snap.cas(1, snap.get(doc_id=1).version, {'int': 6})
+
+    assert db.count(where('int') == 1) == 1
+    assert db.table('other').all() == []
+    with pytest.raises(ValueError):
+        snap.table()
+
+
+def test_snapshot_copy_on_write(db):
+    db.insert({'nested': {'int': 1}})
+
+    def change(doc):
+        doc['nested']['int'] = 2
+
+    with db.snapshot() as snap:
+        db.update(change, where('nested').exists())
+        assert snap.get(where('nested').exists())['nested'] == {'int': 1}
+
+    assert db.get(where('nested').exists())['nested'] == {'int': 2}
+    assert not db._table._storage.snapshotted
+
+
+def test_versions(db):
+    assert db.get(doc_id=1).version == 1
+
+    db.update({'int': 2}, doc_ids=[1])
+    db.update({'int': 3}, where('char') == 'a')
+    assert db.get(doc_id=1).version == 3
+    assert db.get(where('char') == 'b').version == 1
+    assert [doc.version for doc in db] == [3, 1, 1]
+    assert db.insert({'int': 4}) == 4
+    assert db.search(where('int') == 4)[0].version == 1
+
+    # Cached results are kept up to date
+    assert db.search(where('int') > 1)[0].version == 3
+    db.update({'char': 'x'}, doc_ids=[1])
+    assert db.search(where('int') > 1)[0].version == 4
+
+    with pytest.raises(VersionConflict) as conflict:
+        db.update({'int': 5}, doc_ids=[2, 1], if_version=1)
+    assert (conflict.value.doc_id, conflict.value.actual) == (1, 4)
+    assert db.get(doc_id=2)['int'] == 1
+
+    db.update({'int': 5}, doc_ids=[2, 3], if_version=1)
+    assert db.count(where('int') == 5) == 2
+
+    with pytest.raises(ValueError):
+        db.update({'int': 6}, where('int') == 5, if_version=2)
+
+    # Unknown changes count for all documents, the versions of IDs used
+    # again keep counting
+    db.purge()
+    assert db.insert({'int': 1}) == 1
+    assert db.get(doc_id=1).version == 6
+
+
+def test_cas(db):
+    doc = db.get(doc_id=1)
+    doc['int'] = 2
+    assert db.cas(1, doc.version, doc) == 2
+    assert db.get(doc_id=1) == {'int': 2, 'char': 'a'}
+
+    # The document has been written since it was read
+    with pytest.raises(VersionConflict):
+        db.cas(1, doc.version, {'int': 3})
+    assert db.get(doc_id=1)['int'] == 2
+
+    db.remove(doc_ids=[2])
+    with pytest.raises(VersionConflict):
+        db.cas(2, 1, {'int': 3})
+
+
+def test_cas_threads(db):
+    def increment():
+        for _ in range(50):
+            while True:
+                doc = db.get(doc_id=1)
+                doc['int'] += 1
+                try:
+                    db.cas(1, doc.version, doc)
+                    break
+                except VersionConflict:
+                    pass
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert db.get(doc_id=1)['int'] == 201
+
+
+def test_versions_after_failed_write(tmpdir):
+    db = PuchkiDB(str(tmpdir.join('db.json')))
+    doc_id = db.insert({'k': 1})
+    version = db.get(doc_id=doc_id).version
+    # Dates can't be stored as JSON
+    with pytest.raises(TypeError):
+        db.update({'d': datetime.date.today()}, doc_ids=[doc_id])
+    assert db.get(doc_id=doc_id).version == version
+    db.cas(doc_id, version, {'k': 2})
+    db.close()
@@ -1,7 +1,9 @@
+import sys
 import warnings
 import pytest
 
-from puchkidb.utils import LRUCache, catch_warning, freeze, FrozenDict
+from puchkidb.utils import LRUCache, catch_warning, freeze, FrozenDict, \
+    regex_literals, regex_prefilter
 
 
 def test_lru_cache():
@@ -120,3 +122,39 @@ def test_freeze():
 
     with pytest.raises(TypeError):
         frozen[3]['a'] = 10
+
+
+def test_regex_literals():
+    assert regex_literals(r'^error: .* timed out') == \
+        ('error: ', ['error: ', ' timed out'], False)
+    assert regex_literals(r'a(?:bcd)+e') == ('a', ['a', 'bcd', 'e'], False)
+    assert regex_literals(r'x*yz') == ('', ['yz'], False)
+    assert regex_literals(r'foo|bar') == ('', [], False)
+    assert regex_literals(r'a(?i:bc)')[2]
+    assert regex_literals(r'(') is None
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11),
+                    reason="Atomic groups are new in Python 3.11")
+def test_regex_literals_atomic_group():
+    assert regex_literals(r'(?>abc)d') == ('', ['abc', 'd'], False)
+    assert regex_prefilter(r'(?>abc)d') == ('', 'abc')
+
+
+def test_regex_prefilter():
+    assert regex_prefilter(r'error: .* timed out', anchored=True) == \
+        ('error: ', ' timed out')
+    assert regex_prefilter(r'error: .* timed out') == ('', ' timed out')
+    assert regex_prefilter(r'abc', anchored=True) == ('abc', '')
+    assert regex_prefilter(r'(?i)abc') == ('', '')
+    assert regex_prefilter(r'a|b') == ('', '')
+
+
+def test_lru_cache_falsy_values():
+    cache = LRUCache(capacity=2)
+    cache['a'] = []
+    cache['b'] = 0
+    assert cache.get('a', 'default') == []
+
+    cache['c'] = None
+    assert cache.lru == ['a', 'c']